@@ -2,5 +2,20 @@
 
 . /virtualenv/bin/activate
 cd /appenv
-python butlercam.py
 
+# BUTLERCAM_SERVER=dev runs the Werkzeug development server instead.
+if [ "${BUTLERCAM_SERVER:-wsgi}" == "dev" ]; then
+    python butlercam.py
+else
+    # Each gunicorn worker saves its metrics here so that /metrics can sum
+    # them; counters start again from zero with the server.
+    export BUTLERCAM_METRICS_DIR="${BUTLERCAM_METRICS_DIR:-/tmp/butlercam-metrics}"
+    rm -rf "$BUTLERCAM_METRICS_DIR"
+    mkdir -p "$BUTLERCAM_METRICS_DIR"
+    # Each open page's event stream holds a thread, so every worker has
+    # more threads than SSE_MAX_STREAMS.
+    exec gunicorn --bind 0.0.0.0:5000 \
+        --workers "${BUTLERCAM_WORKERS:-4}" \
+        --threads "${BUTLERCAM_THREADS:-16}" \
+        wsgi:application
+fi
@@ -0,0 +1,129 @@
+"""
+A cache of Jenkins build documents in front of Redis. Completed builds
+never change, so the most recently used ones are also kept in process,
+and concurrent misses for the same build share a single fetch from
+Jenkins.
+"""
+# pylint: disable=C0103
+
+import threading
+from collections import OrderedDict
+
+
+class _Flight(object):
+    """
+    A fetch in progress that other callers asking for the same key wait on.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class BuildCache(object):
+    """
+    Looks build documents up in a small in-process LRU, then in `cache`
+    (anything with walrus Cache's `get` and `set`), and only then calls
+    `fetch(key)`. Documents of completed builds are kept in Redis for
+    `timeout` seconds; documents of running builds are returned but not
+    cached. The same document object is handed to every caller, so it
+    must not be modified.
+    """
+
+    def __init__(self, cache, fetch, size=256, timeout=600):
+        self.cache = cache
+        self.fetch = fetch
+        self.size = size
+        self.timeout = timeout
+        self.local = OrderedDict()
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key):
+        """
+        Return the build document for `key`, fetching it at most once no
+        matter how many threads ask for it at the same time.
+        """
+
+        leader = False
+        with self.lock:
+            if key in self.local:
+                self.hits += 1
+                value = self.local.pop(key)
+                self.local[key] = value
+                return value
+
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = _Flight()
+                leader = True
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = self.load(key)
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+        return flight.value
+
+    def load(self, key):
+        """
+        Read `key` from Redis, or fetch it and save it there if the build
+        has completed, then remember completed builds in process.
+        """
+
+        value = self.cache.get(key)
+        if value is not None:
+            with self.lock:
+                self.hits += 1
+        else:
+            with self.lock:
+                self.misses += 1
+            value = self.fetch(key)
+            if not value.get('building'):
+                self.cache.set(key, value, self.timeout)
+
+        if not value.get('building'):
+            self.remember(key, value)
+
+        return value
+
+    def remember(self, key, value):
+        """
+        Add a document to the in-process LRU, evicting the least recently
+        used one if it is full.
+        """
+
+        with self.lock:
+            self.local.pop(key, None)
+            self.local[key] = value
+            while len(self.local) > self.size:
+                self.local.popitem(last=False)
+
+    def stats(self):
+        """
+        Return the hit, miss and coalesced counters and the number of
+        documents held in process.
+        """
+
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'coalesced': self.coalesced,
+                    'local_size': len(self.local)}
@@ -0,0 +1,88 @@
+import build_cache
+import unittest
+import threading
+import time
+
+
+class DictCache(object):
+    """
+    The `get`/`set` interface of a walrus Cache, backed by a dict.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.gets = 0
+
+    def get(self, key):
+        self.gets += 1
+        return self.data.get(key)
+
+    def set(self, key, value, timeout):
+        self.data[key] = value
+
+
+class buildCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = DictCache()
+        self.fetched = []
+        self.release = threading.Event()
+        self.release.set()
+        self.cache = build_cache.BuildCache(self.redis, self.fetch, size=2)
+
+    def fetch(self, key):
+        self.fetched.append(key)
+        self.release.wait()
+        return {'url': key, 'building': key.startswith('running')}
+
+    def test_completed_builds_are_kept_in_process(self):
+        first = self.cache.get('a')
+        assert self.cache.get('a') is first
+        assert self.fetched == ['a']
+        assert self.redis.gets == 1
+        assert self.redis.data['a'] == first
+        stats = self.cache.stats()
+        assert (stats['hits'], stats['misses']) == (1, 1)
+
+    def test_running_builds_are_not_cached(self):
+        self.cache.get('running')
+        self.cache.get('running')
+        assert self.fetched == ['running', 'running']
+        assert 'running' not in self.redis.data
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.get('a')
+        self.cache.get('b')
+        self.cache.get('a')
+        self.cache.get('c')
+        assert self.cache.local.keys() == ['a', 'c']
+        self.cache.get('b')
+        assert self.fetched == ['a', 'b', 'c']
+        assert self.redis.gets == 4
+
+    def test_concurrent_misses_are_coalesced(self):
+        self.release.clear()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get('a')))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while self.cache.stats()['coalesced'] < 4:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        assert self.fetched == ['a']
+        assert len(results) == 5
+        assert all(result is results[0] for result in results)
+
+    def test_fetch_errors_are_raised(self):
+        def fail(key):
+            raise IOError(key)
+        cache = build_cache.BuildCache(self.redis, fail)
+        self.assertRaises(IOError, cache.get, 'a')
+        assert cache.flights == {}
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+"""
+A compact record of the handful of build fields that the dashboard
+charts and tables use, so that the full Jenkins build document only has
+to be loaded when a single build is being shown.
+"""
+# pylint: disable=C0103
+
+import json
+from collections import namedtuple
+
+SUMMARY_FIELDS = ('number', 'result', 'timestamp', 'duration', 'building',
+                  'description', 'display_name', 'causes', 'failures',
+                  'failure_paths')
+
+
+class BuildSummary(namedtuple('BuildSummary', SUMMARY_FIELDS)):
+    """
+    A tuple-backed summary of a build. Fields can also be read with
+    `summary['result']` and `summary.get('result')` so that summaries can
+    be used anywhere a Jenkins build dict was used before.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            if key not in self._fields:
+                raise KeyError(key)
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        """
+        Return the named field, or `default` if there is no such field.
+        Only fields are looked up, not the tuple's methods.
+        """
+
+        if key not in self._fields:
+            return default
+        return getattr(self, key)
+
+    def to_json(self):
+        """
+        Serialize the summary as a JSON list in field order.
+        """
+
+        return json.dumps(list(self))
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Load a summary serialized with `to_json`.
+        """
+
+        fields = json.loads(data)
+        fields[7] = tuple(fields[7])
+        fields[8] = tuple(fields[8])
+        # Summaries saved before failure paths were recorded have none.
+        if len(fields) < len(SUMMARY_FIELDS):
+            fields.append([[name] for name in fields[8]])
+        fields[9] = tuple(tuple(path) for path in fields[9])
+        return cls(*fields)
+
+
+def summarize_build(build):
+    """
+    Given a full Jenkins build document, extract its BuildSummary.
+    """
+
+    causes = []
+    for action in build.get('actions') or []:
+        for cause in action.get('causes') or []:
+            causes.append(cause.get('shortDescription'))
+
+    paths = []
+    if build.get('result') == 'FAILURE':
+        paths = find_failure_paths(build.get('subBuilds') or [])
+
+    return BuildSummary(number=build['number'],
+                        result=build.get('result'),
+                        timestamp=build['timestamp'],
+                        duration=build.get('duration'),
+                        building=build.get('building', False),
+                        description=build.get('description'),
+                        display_name=build.get('displayName'),
+                        causes=tuple(causes),
+                        failures=tuple(path[-1] for path in paths),
+                        failure_paths=tuple(paths))
+
+
+def find_failure_paths(build):
+    """
+    Take a dict or a list of (sub)builds and return the path of job names
+    down to each job that caused the failure, as a list of tuples in the
+    order the jobs appear. The failing jobs are the ones that have
+    result = 'FAILURE' and no subBuilds of their own. The tree is walked
+    with an explicit stack, so however deeply jobs are nested it can't
+    overflow the Python stack.
+    """
+
+    paths = []
+    stack = [((), build)]
+    while stack:
+        parents, node = stack.pop()
+        if isinstance(node, list):
+            for child in reversed(node):
+                stack.append((parents, child))
+        elif node.get('result') == 'FAILURE':
+            path = parents + (node.get('jobName'),)
+            if node.get('subBuilds'):
+                stack.append((path, node['subBuilds']))
+            elif node.get('build') and node['build'].get('subBuilds'):
+                stack.append((path, node['build']['subBuilds']))
+            else:
+                paths.append(path)
+
+    return paths
+
+
+def find_failed_jobs(build, acc):
+    """
+    Take a dict or a list of (sub)builds and append the names of the jobs
+    that caused the failure to `acc` (see `find_failure_paths`).
+    """
+
+    acc.extend(path[-1] for path in find_failure_paths(build))
+    return acc
+
+
+def get_failed_jobs(build):
+    """
+    Return the names of the jobs that caused a build to fail, for either a
+    BuildSummary or a full build document.
+    """
+
+    if isinstance(build, BuildSummary):
+        return list(build.failures)
+    return find_failed_jobs(build.get('subBuilds') or [], [])
@@ -3,137 +3,583 @@ An application to monitor pipelines in multiple Jenkins instances
 """
 # pylint: disable=C0103
 
+import cProfile
+import csv
+import pstats
 import json
-import os
-import urllib2
+import hashlib
+import hmac
+import time
 import datetime
 import threading
-import copy
-import ssl
-from collections import OrderedDict, defaultdict
-from flask import Flask
-from flask import render_template, send_from_directory
-from walrus import Database
+from collections import defaultdict
+from StringIO import StringIO
+from flask import Blueprint, Flask, Response
+from flask import abort, current_app, g, request
+from flask import render_template as flask_render_template
 
 from custom_charts import percentage_chart, buildtime_chart, \
-    failure_chart, get_percentages, week_chart
-from jenkins_persistence import get_all_builds
-import default_settings
-
-# Instantiate our app
-app = Flask(__name__)
-
-# Configure our app
-app.config.from_object(default_settings)
-if 'BUTLERCAM_SETTINGS_FILE' in os.environ:
-    app.config.from_envvar('BUTLERCAM_SETTINGS_FILE')
-PIPELINES = app.config['PIPELINES']
-CSV_DIRECTORY = 'csvs'
-
-# Setup the Redis cache
-db = Database(host=app.config['REDIS_HOST'], db=0)
-cache = db.cache(default_timeout=app.config['CACHE_TIMEOUT'])
-
-# These are used to control the automatic build updating. As long as `continuous`
-# is true, `get_all_builds` will be run every `WAIT_S` seconds to update the Redis
-# database with any new builds that may have been added since the last update.
-WAIT_S = 300 if ("UPDATE_INTERVAL_S" not in app.config.keys()) else app.config["UPDATE_INTERVAL_S"]
+    failure_chart, get_count_percentages, get_day_boundaries, week_chart
+from build_summary import find_failed_jobs, get_failed_jobs
+from jenkins_persistence import get_last_builds, get_builds_between, get_build_before, \
+    get_build_document, get_stats, get_status_snapshot, get_build_info, \
+    get_top_failures, get_versions, iter_builds, sync_all_builds, \
+    enqueue_build, find_notified_pipeline, process_build_queue, \
+    subscribe_status_changes, iter_status_changes, load_config, init_app
+import jenkins_persistence
+import metrics
+import request_timing
+from page_cache import PageCache
+
+# The routes are registered on a blueprint so that importing this module
+# doesn't create or configure an app; see `create_app`.
+views = Blueprint('butlercam', __name__)
+
+HTTP_REQUESTS = metrics.registry.counter(
+    'butlercam_http_requests_total',
+    'Requests answered, by route, method and status.', ('route', 'method', 'status'))
+HTTP_SECONDS = metrics.registry.histogram(
+    'butlercam_http_request_seconds',
+    'Time taken to answer requests, by route and method. Streamed responses '
+    'are timed until they start streaming.', ('route', 'method'))
+
+# How many seconds browsers wait before reconnecting to an event stream,
+# including one that was refused because too many were open.
+STREAM_RETRY_S = 5
+
+# The columns of the build CSV, in their default order.
+CSV_FIELDS = ('number', 'result', 'start', 'duration', 'description')
+
+# This is used to control the automatic build updating. As long as `continuous`
+# is true, `sync_builds` will be run every UPDATE_INTERVAL_S seconds to update
+# the Redis database with any new builds that may have been added since the
+# last update.
 continuous = True
 
+
+def create_app(settings=None):
+    """
+    Create and configure the Butlercam app, with the Redis database and
+    Jenkins client set up from its config. `settings` overrides the loaded
+    settings, e.g. in tests. This is the entry point for WSGI servers.
+    """
+
+    app = Flask(__name__)
+    load_config(app)
+    if settings:
+        app.config.update(settings)
+    init_app(app)
+    # Rendered pages, shared by every web process. Keys include the version
+    # of the pipeline data that the page shows.
+    app.extensions['page_cache'] = PageCache(jenkins_persistence.db,
+                                             app.config['PAGE_CACHE_SIZE'])
+    # Each open event stream holds a server thread, so only SSE_MAX_STREAMS
+    # of them are served at once by each process.
+    app.extensions['event_streams'] = threading.BoundedSemaphore(
+        app.config['SSE_MAX_STREAMS'])
+    app.register_blueprint(views)
+    if app.config['METRICS_DIR']:
+        metrics.registry.share(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_S'])
+
+    return app
+
+
+def get_page_cache():
+    """
+    Return the page cache of the current app.
+    """
+
+    return current_app.extensions['page_cache']
+
+
+def get_stale_after(config):
+    """
+    Return how many seconds old a pipeline's status can get before it is
+    shown as stale. The worker polls idle pipelines as rarely as every
+    POLL_MAX_INTERVAL_S, so that is twice the longest poll interval.
+    """
+
+    return 2 * max(config['UPDATE_INTERVAL_S'], config['POLL_MAX_INTERVAL_S'])
+
+
+@views.before_request
+def start_request_timer():
+    """
+    Note when the request started and start timing its spans, for
+    `add_server_timing` and `record_request_metrics`. With
+    PROFILE_REQUESTS set, `?profile=1` also profiles the request.
+    """
+
+    g.request_started = time.time()
+    request_timing.start()
+    if current_app.config['PROFILE_REQUESTS'] and request.args.get('profile') == '1':
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@views.after_request
+def add_server_timing(response):
+    """
+    Break the time taken by the request down in the Server-Timing header,
+    and note its status for `record_request_metrics`. A profiled request
+    is answered with its profile instead.
+    """
+
+    profiler = g.get('profiler')
+    if profiler is not None:
+        profiler.disable()
+        g.profiler = None
+        response = profile_response(profiler)
+
+    g.response_status = response.status_code
+    response.headers['Server-Timing'] = request_timing.header(
+        request_timing.stop(), time.time() - g.request_started)
+
+    return response
+
+
+@views.teardown_request
+def record_request_metrics(_):
+    """
+    Count the request and how long it took under its route's rule, so
+    that every build of a pipeline is timed under the same route. This
+    runs even when the view raised, which after_request hooks don't, so
+    those requests are counted as 500s, and their profiler and spans are
+    stopped here.
+    """
+
+    started = g.get('request_started')
+    if started is None:
+        return
+
+    profiler = g.get('profiler')
+    if profiler is not None:
+        profiler.disable()
+    request_timing.stop()
+
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    HTTP_SECONDS.observe(time.time() - started, route=route, method=request.method)
+    HTTP_REQUESTS.inc(route=route, method=request.method,
+                      status=g.get('response_status', 500))
+
+
+def profile_response(profiler):
+    """
+    Return a plain text response listing the PROFILE_TOP_FUNCTIONS
+    functions that took the most cumulative time in a profiled request.
+    """
+
+    out = StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(current_app.config['PROFILE_TOP_FUNCTIONS'])
+
+    return Response(out.getvalue(), mimetype='text/plain')
+
+
+def render_template(template_name, **context):
+    """
+    Render a template, timed as the request's templating span.
+    """
+
+    with request_timing.span('template'):
+        return flask_render_template(template_name, **context)
+
+
 # Home
-@app.route("/")
+@views.route("/")
 def show_home():
     """
     Displays configured pipeline lights on "/"
     """
 
-    return render_template("index.html", build_lights=get_build_lights())
+    pipelines = current_app.config['PIPELINES']
+    snapshot = get_status_snapshot(pipelines.keys())
+    versions = get_versions(sorted(pipelines.keys()))
+    key = 'home:' + hashlib.sha1(json.dumps(sorted(pipelines.items()) + versions))\
+        .hexdigest()
+    lights = get_page_cache().render(key, lambda: render_template(
+        "lights.html", build_lights=get_build_lights(pipelines, snapshot)))
+
+    return render_template("index.html",
+                           lights=lights,
+                           has_pipelines=bool(pipelines),
+                           status_age=get_status_age(snapshot),
+                           stale_after=get_stale_after(current_app.config))
 
 
 # Pipelines
-@app.route("/pipeline/<pipeline>")
+@views.route("/pipeline/<pipeline>")
 def show_pipeline(pipeline):
     """
-    Shows the pipelines dashboard
+    Shows the pipelines dashboard from the saved builds; the worker keeps
+    them up to date.
     """
 
     pipeline = str(pipeline)
-    all_builds = get_all_builds(pipeline)
-    overall_earliest = \
-        datetime.datetime.fromtimestamp(\
-        all_builds[all_builds.keys()[0]]['timestamp'] / 1000)\
-        .strftime("%A, %d %b %Y, at %H:%M:%S")
-    time_data = get_time_data(all_builds)
-    w_c = week_chart(time_data)
-
-    top_failing_jobs = get_top_failing_jobs(all_builds, pipeline)
-    latest_build_status = get_latest_build_status(PIPELINES[pipeline][1])
-
-    building = False
-
-    if latest_build_status['building']:
-        latest_build_status = get_last_complete_status(PIPELINES[pipeline][1])
-        building = True
+    if pipeline not in current_app.config['PIPELINES']:
+        abort(404)
+    version = get_versions([pipeline])[0]
+
+    return get_page_cache().render('pipeline:%s:%d' % (pipeline, version),
+                                   lambda: render_pipeline(pipeline))
+
+def render_pipeline(pipeline):
+    """
+    Render the dashboard page of a pipeline.
+    """
+
+    stats = get_stats(pipeline)
+
+    overall_earliest = None
+    if stats['earliest']:
+        overall_earliest = \
+            datetime.datetime.fromtimestamp(stats['earliest'] / 1000)\
+            .strftime("%A, %d %b %Y, at %H:%M:%S")
+    with request_timing.span('analytics'):
+        time_data = format_time_data([],
+                                     float(stats['green_s']),
+                                     float(stats['red_s']),
+                                     stats['earliest'] / 1000 if stats['earliest'] else None)
+
+        top_failing_jobs = get_top_failures(pipeline)
+        percentages = get_count_percentages(stats['passing'],
+                                            stats['failing'],
+                                            stats['aborted'])
+    status = get_status_snapshot([pipeline])[pipeline] or {}
+    building = status.get('building', False)
+    latest_build_status = {
+        'result': status.get('last_complete_result' if building else 'result'),
+        'duration': status.get('last_complete_duration' if building else 'duration') or 0
+    }
 
-    latest_keys = all_builds.keys()[-20:]
-    latest_builds = OrderedDict()
-    for i in latest_keys:
-        latest_builds[i] = all_builds[i]
+    latest_builds = get_last_builds(pipeline, 20)
 
     return render_template('pipeline.html',
                            builds=latest_builds,
                            pipeline=pipeline,
-                           pipeline_info=PIPELINES[pipeline],
+                           pipeline_info=current_app.config['PIPELINES'][pipeline],
                            building=building,
                            latest_build_status=latest_build_status,
-                           passing_percent=get_percentages(all_builds)[0],
+                           passing_percent=percentages[0],
                            overall_earliest=overall_earliest,
-                           buildtime_chart=buildtime_chart(latest_builds, pipeline),
                            top_failing_jobs=top_failing_jobs,
-                           top_failures_chart=failure_chart(top_failing_jobs),
-                           percentage_chart=percentage_chart(all_builds),
-                           time_data=time_data,
-                           week_chart=w_c)
+                           time_data=time_data)
+
+# Chart data for a pipeline page.
+@views.route("/api/pipeline/<pipeline>/charts/<name>")
+def serve_chart(pipeline, name):
+    """
+    Returns the HighCharts options of one of a pipeline's charts as JSON.
+    The ETag changes whenever the pipeline's builds or stats change, and a
+    request whose If-None-Match still matches gets an empty 304.
+    """
+
+    pipeline = str(pipeline)
+    if pipeline not in current_app.config['PIPELINES'] or name not in CHART_BUILDERS:
+        abort(404)
+
+    etag = chart_etag(pipeline, name, get_versions([pipeline])[0],
+                      days=request.args.get('days', type=int))
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        with request_timing.span('analytics'):
+            chart = json.dumps(CHART_BUILDERS[name](pipeline))
+        response = Response(chart, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+
+    return response
+
+def chart_etag(pipeline, name, version, today=None, days=None):
+    """
+    Given a pipeline, a chart name, the pipeline's version counter from
+    `get_versions` and the `days` window asked for, if any, return the
+    chart's ETag. Charts that cover a window of days (the week chart
+    always does) change at midnight, so their ETag includes the date.
+    """
+
+    etag = '%s-%s-%d' % (pipeline, name, version)
+    if days:
+        etag += '-%dd' % days
+    if name == 'week' or days:
+        etag += '-' + (today or datetime.date.today()).isoformat()
+
+    return etag
+
+def make_percentage_chart(pipeline):
+    """
+    The donut chart of the share of builds that passed, failed or were
+    aborted.
+    """
+
+    stats = get_stats(pipeline)
+    return percentage_chart(get_count_percentages(stats['passing'],
+                                                  stats['failing'],
+                                                  stats['aborted']))
+
+def make_buildtime_chart(pipeline):
+    """
+    The bar chart of the durations of the latest builds.
+    """
+
+    return buildtime_chart(get_last_builds(pipeline, 20), pipeline)
+
+def make_failures_chart(pipeline):
+    """
+    The pie chart of the jobs that caused failures, over the last `days`
+    query parameter days if it is given and over all time otherwise.
+    """
+
+    days = request.args.get('days', type=int)
+    since = get_day_boundaries(days)[0] * 1000 if days else None
+
+    return failure_chart(get_top_failures(pipeline, since))
+
+def make_week_chart(pipeline):
+    """
+    The bar chart of the time spent green and red on each day of the last
+    week. The last build before the week decides the colour of the week up
+    to its first build, so it is included with its slice clipped at the
+    start of the week.
+    """
+
+    week_start = get_day_boundaries(7)[0]
+    week_builds = get_builds_between(pipeline, week_start * 1000, '+inf')
+    week_builds.update(get_build_before(pipeline, week_start * 1000))
+
+    build_slices = calculate_build_slices(week_builds)
+    if build_slices and build_slices[0]['start'] < week_start:
+        build_slices[0]['start'] = week_start
+        build_slices[0]['duration'] = build_slices[0]['end'] - week_start
+
+    return week_chart({'build_slices': build_slices})
+
+CHART_BUILDERS = {
+    'percentage': make_percentage_chart,
+    'buildtime': make_buildtime_chart,
+    'failures': make_failures_chart,
+    'week': make_week_chart
+}
 
 # Builds
-@app.route("/pipeline/<pipeline>/<build_number>")
+@views.route("/pipeline/<pipeline>/<int:build_number>")
 def show_build(pipeline, build_number):
     """
     TODO
     Shows information about a specific run of the pipeline
     """
 
-    builds = get_all_builds(pipeline)
-    build_info = get_build_info(PIPELINES[pipeline][1] + "/" + str(build_number))
-
-    return render_template("build.html",
+    pipeline = str(pipeline)
+    if pipeline not in current_app.config['PIPELINES']:
+        abort(404)
+
+    key = 'build:%s:%d' % (pipeline, build_number)
+    page = get_page_cache().lookup(key)
+    if page is not None:
+        return page
+
+    build_info, stale = get_build_document(pipeline, build_number)
+    if build_info is None:
+        abort(404)
+    page = render_template("build.html",
                            build=build_info,
-                           builds=builds,
-                           pipeline=pipeline)
+                           pipeline=pipeline,
+                           stale=stale)
+
+    # A completed build never changes, so its page is kept until evicted,
+    # unless it was rendered from the saved summary while Jenkins was down.
+    if not build_info['building'] and not stale:
+        get_page_cache().store(key, page)
+
+    return page
 
 # The downloadable CSV data for a pipeline.
-@app.route("/pipeline/<pipeline>/csv")
+@views.route("/pipeline/<pipeline>/csv")
 def serve_csv(pipeline):
     """
-    Serves a CSV file containing all of the known builds for the pipeline.
+    Streams a CSV file containing the known builds for the pipeline. The
+    `since` and `until` query parameters (YYYY-MM-DD or
+    YYYY-MM-DD HH:MM:SS) restrict the builds by start time, a date `until`
+    including the whole of that day; `limit` keeps only the most recent
+    ones, and `fields` is a comma separated list of the columns to include.
+    """
+
+    pipeline = str(pipeline)
+    if pipeline not in current_app.config['PIPELINES']:
+        abort(404)
+
+    try:
+        since = parse_csv_time(request.args['since']) if 'since' in request.args else '-inf'
+        until = parse_csv_time(request.args['until'], end=True) \
+            if 'until' in request.args else '+inf'
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError as error:
+        abort(400, str(error))
+    if limit is not None and limit < 0:
+        abort(400, 'limit must not be negative')
+
+    fields = CSV_FIELDS
+    if 'fields' in request.args:
+        fields = tuple(request.args['fields'].split(','))
+        if not set(fields) <= set(CSV_FIELDS):
+            abort(400, 'fields must be chosen from ' + ','.join(CSV_FIELDS))
+
+    builds = iter_builds(pipeline, since, until, limit)
+    return Response(iter_build_csv(builds, fields),
+                    mimetype='text/csv',
+                    headers={'Content-Disposition':
+                                 'attachment; filename=%s_builds.csv' % pipeline})
+
+# Live status updates for the home page.
+@views.route("/events")
+def stream_events():
+    """
+    Streams the status of every pipeline as server-sent events: the
+    current status first, then each change as it happens.
+    """
+
+    return status_event_response(current_app.config['PIPELINES'].keys(), None)
+
+# Live status updates for a pipeline page.
+@views.route("/pipeline/<pipeline>/events")
+def stream_pipeline_events(pipeline):
+    """
+    Streams the status of one pipeline as server-sent events.
     """
 
     pipeline = str(pipeline)
-    all_builds = get_all_builds(pipeline)
-    csv_data = generate_build_csv(all_builds)
+    if pipeline not in current_app.config['PIPELINES']:
+        abort(404)
+
+    return status_event_response([pipeline], pipeline)
+
+def status_event_response(pipelines, pipeline):
+    """
+    Subscribe to the status changes of `pipeline` (or of every pipeline
+    if it is None) and return the event stream response for `pipelines`.
+    If this process already serves SSE_MAX_STREAMS streams, answer 503 so
+    that the server's threads are kept for other requests; the browser
+    tries again later.
+    """
+
+    config = current_app.config
+    streams = current_app.extensions['event_streams']
+    if not streams.acquire(False):
+        return Response('Too many open event streams\n', 503, mimetype='text/plain',
+                        headers={'Retry-After': str(STREAM_RETRY_S)})
+
+    try:
+        changes = iter_status_changes(subscribe_status_changes(pipeline),
+                                      config['SSE_HEARTBEAT_S'])
+        events = iter_status_events(get_status_snapshot(pipelines), changes,
+                                    config['SSE_MAX_AGE_S'])
+    except Exception: # pylint: disable=W0703
+        streams.release()
+        raise
+
+    response = Response(events, mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+    response.call_on_close(streams.release)
+
+    return response
+
+def iter_status_events(snapshot, changes, max_age, clock=time.time):
+    """
+    Given a status snapshot, an iterator of status changes (None for a
+    quiet period) and how many seconds to stream for, yield server-sent
+    events: a `status` event for each pipeline in the snapshot, then one
+    for each change, with comments to keep the connection open. Streams
+    end after `max_age` so that long-lived clients reconnect and release
+    their server thread now and then.
+    """
+
+    started = clock()
+    yield 'retry: %d\n\n' % (STREAM_RETRY_S * 1000)
+    for name, status in sorted(snapshot.iteritems()):
+        if status:
+            yield format_event('status', {'pipeline': name, 'status': status})
+
+    try:
+        for change in changes:
+            if change is None:
+                yield ': keepalive\n\n'
+            else:
+                yield format_event('status', change)
+            if clock() - started >= max_age:
+                return
+    finally:
+        if hasattr(changes, 'close'):
+            changes.close()
+
+def format_event(event, data):
+    """
+    Format one server-sent event with JSON data.
+    """
+
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data))
+
+# Jenkins build notifications.
+@views.route("/hooks/jenkins", methods=['POST'])
+def receive_jenkins_hook():
+    """
+    Accepts a Notification plugin build event and queues the build to be
+    ingested. The `token` query parameter must match HOOK_TOKEN; without
+    a HOOK_TOKEN, notifications are refused, since anyone who can reach
+    the hook could otherwise make the worker call Jenkins.
+    """
+
+    token = current_app.config['HOOK_TOKEN']
+    if not token:
+        abort(403, 'Set HOOK_TOKEN to accept build notifications')
+    if not hmac.compare_digest(str(request.args.get('token', '')), str(token)):
+        abort(403)
+
+    notification = request.get_json(force=True, silent=True)
+    if notification is None:
+        abort(400, 'Expected a JSON build notification')
+
+    notified = find_notified_pipeline(notification, current_app.config['PIPELINES'])
+    if notified is None:
+        abort(404, 'Not a build of a configured pipeline')
+
+    enqueue_build(*notified)
+
+    return '', 202
+
+# Metrics for Prometheus.
+@views.route("/metrics")
+def serve_metrics():
+    """
+    Serves the metrics of this web process in the Prometheus text format.
+    """
+
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
 
-    if not os.path.exists(CSV_DIRECTORY):
-        os.makedirs(CSV_DIRECTORY)
 
-    fn = pipeline + "_builds.csv"
-    csv_file = open(CSV_DIRECTORY + '/' + fn, "w")
-    csv_file.write(csv_data)
-    csv_file.close()
+def collect_status_metrics():
+    """
+    Return the age of each pipeline's status snapshot entry, which is how
+    far its light may be behind Jenkins, when the metrics are scraped.
+    """
+
+    ages = metrics.Gauge('butlercam_pipeline_status_age_seconds',
+                         'Seconds since the status of each pipeline was last '
+                         'refreshed from Jenkins.', ('pipeline',))
+    now = time.time()
+    pipelines = current_app.config['PIPELINES']
+    for name, status in get_status_snapshot(pipelines.keys()).iteritems():
+        if status:
+            ages.set(now - status['updated'], pipeline=name)
 
-    return send_from_directory(CSV_DIRECTORY, fn, as_attachment=True)
+    return [ages]
+
+
+metrics.registry.add_collector(collect_status_metrics, shared=True)
 
 # ms Filter
-@app.template_filter('ms_to_time')
+@views.app_template_filter('ms_to_time')
 def ms_to_time(milliseconds):
     """
     Transform milliseconds to 00d:00h:00m:00s
@@ -177,10 +623,11 @@ def get_top_failing_jobs(builds, pipeline):
             failing_builds.append(build_info)
 
     for build in failing_builds:
-        if not build.get('subBuilds'):
+        failed_jobs = get_failed_jobs(build)
+        if not failed_jobs:
             failing_jobs[pipeline] += 1
-        else:
-            get_build_failure(build, failing_jobs)
+        for job_name in failed_jobs:
+            failing_jobs[job_name] += 1
 
     return_list = []
     for name, failures in failing_jobs.iteritems():
@@ -196,73 +643,56 @@ def get_build_failure(build, acc):
     result = 'FAILURE' and no subBuilds
     """
 
-    # If it's a list, we need to iterate through it
-    if isinstance(build, list) and len(build) > 0:
-        for potential_failure in build:
-            get_build_failure(potential_failure, acc)
-    else:
-        if build.get('result') == 'FAILURE':
-            if build.get("subBuilds"):
-                get_build_failure(build.get("subBuilds"), acc)
-            elif build.get("build") and build['build'].get('subBuilds'):
-                get_build_failure(build['build'].get('subBuilds'), acc)
-            else:
-                acc[build['jobName']] += 1
+    for job_name in find_failed_jobs(build, []):
+        acc[job_name] += 1
 
     return acc
 
-def get_build_lights():
+def get_build_lights(pipelines, snapshot=None):
     """
-    Generate a build light status for each of the pipelines and sort by
-    system_name, name and return it in a list.
+    Generate a build light status for each of the given pipelines from the
+    status snapshot and sort by system_name, name and return it in a list.
     """
 
+    if snapshot is None:
+        snapshot = get_status_snapshot(pipelines.keys())
+
     build_light_status = []
-    for name, metadata in PIPELINES.iteritems():
+    for name, metadata in pipelines.iteritems():
         system_name = metadata[0]
-        parsed_current_status = get_latest_build_status(metadata[1])
-        parsed_previous_status = get_last_complete_status(metadata[1])
+        status = snapshot.get(name) or {}
 
-        current_status = parsed_current_status['result']
-        current_build_time = ms_to_time(parsed_current_status['duration'])
-        building = parsed_current_status['building']
+        current_status = status.get('result')
+        current_build_time = ms_to_time(status.get('duration') or 0)
+        building = status.get('building', False)
 
-        previous_status = parsed_previous_status['result']
+        previous_status = status.get('last_complete_result')
+        stale = status.get('stale', False)
 
         build_status = (name,
                         current_status,
                         previous_status,
                         building,
                         system_name,
-                        current_build_time)
+                        current_build_time,
+                        stale)
 
         build_light_status.append(build_status)
 
     return sorted(build_light_status, key=lambda x: (x[4], x[0]))
 
 
-def get_latest_build_status(pipeline_url):
+def get_status_age(snapshot):
     """
-    Get the status and result of the latest build.
+    Return how many seconds old the oldest entry in the status snapshot is,
+    or None if no pipeline has a status yet.
     """
 
-    url = pipeline_url + "/lastBuild/api/json?tree=result[*],building[*],duration[*]"
-    context = ssl._create_unverified_context()
-    data = urllib2.urlopen(url, context=context).read()
-
-    return json.loads(data)
+    updated = [status['updated'] for status in snapshot.values() if status]
+    if not updated:
+        return None
 
-
-def get_last_complete_status(pipeline_url):
-    """
-    Get the result of the latest completed build (inherently it is complete).
-    """
-
-    url = pipeline_url + "/lastCompletedBuild/api/json?tree=result[*],duration[*]"
-    context = ssl._create_unverified_context()
-    data = urllib2.urlopen(url, context=context).read()
-
-    return json.loads(data)
+    return int(time.time() - min(updated))
 
 
 def get_build_status(build_url):
@@ -273,26 +703,6 @@ def get_build_status(build_url):
     return get_build_info(build_url)["result"]
 
 
-def get_build_info(build_url):
-    """
-    This function takes a build url and fetches it from Jenkins. If the build is
-    not still running, it will insert it into the (Redis) cache for future use.
-    """
-
-    url = build_url + '/api/json'
-    if cache.get(url):
-        return cache.get(url)
-
-    context = ssl._create_unverified_context()
-    data = urllib2.urlopen(url, context=context).read()
-    parsed = json.loads(data)
-
-    # This will break with non-build requests
-    if not parsed['building']:
-        cache.set(url, parsed, 0)
-
-    return parsed
-
 def get_time_data(builds):
     """
     This function fetches build data and uses it to calculate how statistics on
@@ -305,60 +715,65 @@ def get_time_data(builds):
 
 def calculate_build_slices(builds):
     """
-    Given a list of builds, will calculate the time slices that they delineate.
+    Given a dict of builds keyed by number, will calculate the time slices
+    that they delineate.
     """
 
-    temp_builds = copy.deepcopy(builds)
-    build_nums = sorted(temp_builds.keys())
-
-    # Add a temporary build at the end so that the current slice is considered.
-    temp_num = build_nums[-1] + 10000
-    now_ut = 1000 * (datetime.datetime.now().utcnow() - \
-        datetime.datetime.utcfromtimestamp(0)).total_seconds()
-
-    temp_builds[temp_num] = {
-        'number': temp_num,
-        'timestamp': now_ut,
-        'result': 'NULL'
-    }
-
     build_slices = []
-    for i in range(0, len(build_nums) - 1):
-        curr_num = build_nums[i]
-        if temp_builds[curr_num]['result'] != 'SUCCESS' \
-              and temp_builds[curr_num]['result'] != 'FAILURE' \
-              and curr_num > 0:
-            temp_builds[curr_num]['result'] = temp_builds[build_nums[i - 1]]['result']
-
-        add_build_slice(build_slices, \
-            temp_builds[curr_num]['timestamp'], \
-            temp_builds[build_nums[i + 1]]['timestamp'], \
-            temp_builds[curr_num]['result'] \
-        )
+    pairs = ((builds[num]['timestamp'], builds[num]['result'])
+             for num in sorted(builds.keys()))
+    for start, end, result in iter_build_slices(pairs):
+        add_build_slice(build_slices, start, end, result)
 
     return build_slices
 
+def iter_build_slices(pairs):
+    """
+    Given an iterable of (timestamp, result) pairs in build order, yield a
+    (start, end, result) slice from each build to the next. Builds that
+    did not pass or fail inherit the result of the build before them.
+    """
+
+    previous = None
+    result = None
+    for timestamp, build_result in pairs:
+        if previous is not None:
+            yield previous, timestamp, result
+        if build_result in ('SUCCESS', 'FAILURE') or result is None:
+            result = build_result
+        previous = timestamp
+
 def process_time_data(build_slices):
     """
     When given a list of time slices between builds, this calculates general
     statistics for the entire time span.
     """
 
-    timedata = {
-        'build_slices': build_slices
-    }
-    if len(build_slices) > 0:
-        timedata['earliest'] = datetime.datetime.fromtimestamp(build_slices[0]['start'])\
-            .strftime('%A, %d %b %Y, at %H:%M:%S')
-
     gts = 0.0
     rts = 0.0
-    for build_slice in timedata['build_slices']:
+    for build_slice in build_slices:
         if build_slice['result'] == 'SUCCESS':
             gts += float(build_slice['duration'])
         elif build_slice['result'] == 'FAILURE':
             rts += float(build_slice['duration'])
 
+    earliest = build_slices[0]['start'] if len(build_slices) > 0 else None
+
+    return format_time_data(build_slices, gts, rts, earliest)
+
+def format_time_data(build_slices, gts, rts, earliest):
+    """
+    Given time slices, the total seconds spent green and red, and the start
+    of the earliest slice, build the time data shown on the pipeline page.
+    """
+
+    timedata = {
+        'build_slices': build_slices
+    }
+    if earliest is not None:
+        timedata['earliest'] = datetime.datetime.fromtimestamp(earliest)\
+            .strftime('%A, %d %b %Y, at %H:%M:%S')
+
     timedata['green'] = calculate_hms(gts)
     timedata['green']['ts'] = gts
 
@@ -404,45 +819,119 @@ def calculate_hms(total_sec):
 
     return {'h': hours, 'm': minutes, 's': seconds, 'formatted': formatted}
 
-def auto_update_builds():
+def auto_update_builds(pipelines, wait, lock):
     """
-    Runs get_all_builds for every pipeline in PIPELINES, then
-    schedules itself to run again later.
+    Runs sync_builds concurrently for every pipeline in `pipelines` if we
+    hold the worker's leader `lock`, then schedules itself to run again
+    `wait` seconds later.
     """
 
-    for pipeline in PIPELINES.keys():
-        get_all_builds(pipeline)
+    if lock.acquire():
+        sync_all_builds(pipelines.keys())
+    else:
+        print 'Another worker holds the leader lock - not polling'
 
     if continuous:
-        t = threading.Timer(WAIT_S, auto_update_builds)
+        t = threading.Timer(wait, auto_update_builds, (pipelines, wait, lock))
         t.daemon = True
         t.start()
 
+def auto_ingest_builds(wait, lock):
+    """
+    Ingests queued build notifications for as long as `continuous` is
+    true and we hold the worker's leader `lock`, waiting up to `wait`
+    seconds for each.
+    """
+
+    while continuous:
+        try:
+            if lock.acquire():
+                process_build_queue(wait)
+            else:
+                time.sleep(wait)
+        except Exception as error: # pylint: disable=W0703
+            print 'Build notifications failed to ingest:', error
+            time.sleep(wait)
+
 def generate_build_csv(builds):
     """
-    Given a list of builds, output it to a CSV format.
+    Given a dict of builds, output it to a CSV format.
     """
 
-    date_format = '%Y-%m-%d %H:%M:%S'
+    return ''.join(iter_build_csv(builds.itervalues()))
 
-    out_build_str = 'number,result,start,duration,description\n'
-    for k in builds:
-        b = builds[k]
-        build_desc = ''
-        if b['description'] is not None:
-            build_desc = ''.join(c for c in b['description'] if 0 < ord(c) < 128)
+def iter_build_csv(builds, fields=CSV_FIELDS):
+    """
+    Given an iterable of builds, yield the lines of a CSV file with the
+    given columns, starting with the header.
+    """
 
-        out_build_str += '%s,%s,%s,%s,%s\n' % ( \
-            b['number'], \
-            b['result'], \
-            datetime.datetime.fromtimestamp(b['timestamp'] / 1000)\
-                .strftime(date_format), \
-            b['duration'], \
-            build_desc)
+    date_format = '%Y-%m-%d %H:%M:%S'
 
-    return out_build_str
+    buf = StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+
+    def flush(row):
+        """
+        Write one row and return it as a line.
+        """
+
+        buf.seek(0)
+        buf.truncate()
+        writer.writerow(row)
+        return buf.getvalue()
+
+    yield flush(fields)
+    for b in builds:
+        values = {
+            'number': b['number'],
+            'result': b['result'],
+            'start': datetime.datetime.fromtimestamp(b['timestamp'] / 1000)\
+                .strftime(date_format),
+            'duration': b['duration'],
+            'description': (b['description'] or '').encode('utf-8')
+        }
+        yield flush([values[field] for field in fields])
+
+def parse_csv_time(value, end=False):
+    """
+    Parse a `since`/`until` query parameter, either a date (YYYY-MM-DD) or a
+    local time as written in the CSV, into milliseconds since the epoch.
+    With `end`, as for `until`, a date means the whole of that day: the
+    last millisecond before the next midnight.
+    """
+
+    for date_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            parsed = datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+        if end and date_format == '%Y-%m-%d':
+            next_day = parsed + datetime.timedelta(days=1)
+            return int(time.mktime(next_day.timetuple())) * 1000 - 1
+        return int(time.mktime(parsed.timetuple())) * 1000
+
+    raise ValueError('Unrecognised time: %s' % value)
 
 if __name__ == '__main__':
-    auto_update_builds()
-    app.run(host='0.0.0.0', debug=True)
+    dev_app = create_app()
+    # Without the embedded poller, butlercam_worker.py keeps Redis updated.
+    # With it, this process polls only while it holds the worker's leader
+    # lock. The worker is imported here so that web processes don't
+    # register its metrics.
+    leader = None
+    if dev_app.config['EMBEDDED_POLLER']:
+        from butlercam_worker import INGEST_WAIT_S, LEADER_KEY, LeaderLock
+        leader = LeaderLock(jenkins_persistence.db, LEADER_KEY,
+                            dev_app.config['WORKER_LOCK_TTL_S'])
+        auto_update_builds(dev_app.config['PIPELINES'], dev_app.config['UPDATE_INTERVAL_S'],
+                           leader)
+        ingester = threading.Thread(target=auto_ingest_builds, args=(INGEST_WAIT_S, leader))
+        ingester.daemon = True
+        ingester.start()
+    try:
+        dev_app.run(host='0.0.0.0', debug=True)
+    finally:
+        if leader is not None:
+            leader.release()
     continuous = False
@@ -1,17 +1,29 @@
 import butlercam
+import build_summary
+import custom_charts
+import jenkins_persistence
 import unittest
 import datetime
+import time
 import json
 import collections
+import sys
+import request_timing
 
 from collections import OrderedDict
+from jenkins_stub import StubJenkins
+from page_cache import PageCache
+from redis_stub import StubRedis
+from redis.exceptions import ConnectionError
 
 class butlercamTestCase(unittest.TestCase):
 
     def setUp(self):
-        # butlercam.app.config['REDIS_HOST'] = 'localhost'
-        butlercam.app.config['TESTING'] = True
-        self.app = butlercam.app.test_client()
+        # Nothing listens on port 1, so Redis calls fail even if a Redis
+        # server is running locally.
+        app = butlercam.create_app({'TESTING': True, 'REDIS_PORT': 1})
+        self.app = app.test_client()
+        self.flask_app = app
         with open('all_builds_test.json') as json_file:
             temp_builds = json.load(json_file)
         self.test_builds = {}
@@ -21,10 +33,204 @@ class butlercamTestCase(unittest.TestCase):
 
     # def tearDown(self):
 
+    def test_create_app_sets_up_clients(self):
+        assert jenkins_persistence.config is self.flask_app.config
+        assert jenkins_persistence.PIPELINES is self.flask_app.config['PIPELINES']
+        assert self.flask_app.extensions['page_cache'].database is jenkins_persistence.db
+
     def test_no_config(self):
         rv = self.app.get('/')
         assert 'BUTLERCAM Dashboard' in rv.data
 
+    def test_jenkins_hook_rejects_bad_notifications(self):
+        self.flask_app.config['HOOK_TOKEN'] = 'secret'
+        url = '/hooks/jenkins?token=secret'
+        assert self.app.post(url, data='not json').status_code == 400
+        rv = self.app.post(url, data=json.dumps(
+            {'url': 'job/unknown/', 'build': {'number': 1, 'phase': 'STARTED'}}))
+        assert rv.status_code == 404
+
+    def test_jenkins_hook_requires_token(self):
+        notification = json.dumps({'url': 'job/unknown/', 'build': {'number': 1}})
+        assert self.flask_app.config['HOOK_TOKEN'] is None
+        assert self.app.post('/hooks/jenkins', data=notification).status_code == 403
+        self.flask_app.config['HOOK_TOKEN'] = 'secret'
+        assert self.app.post('/hooks/jenkins', data=notification).status_code == 403
+        assert self.app.post('/hooks/jenkins?token=wrong', data=notification).status_code == 403
+        assert self.app.post('/hooks/jenkins?token=secret', data=notification).status_code == 404
+
+    def test_embedded_poller_needs_leader_lock(self):
+        class StubLock(object):
+            held = False
+
+            def acquire(self):
+                return self.held
+
+        synced = []
+        sync_all_builds, continuous = butlercam.sync_all_builds, butlercam.continuous
+        butlercam.sync_all_builds = synced.append
+        butlercam.continuous = False
+        try:
+            lock = StubLock()
+            butlercam.auto_update_builds({'churro': ('jenkins1', 'http://j/job/churro')},
+                                         60, lock)
+            assert synced == []
+            lock.held = True
+            butlercam.auto_update_builds({'churro': ('jenkins1', 'http://j/job/churro')},
+                                         60, lock)
+            assert synced == [['churro']]
+        finally:
+            butlercam.sync_all_builds, butlercam.continuous = sync_all_builds, continuous
+        assert self.flask_app.config['EMBEDDED_POLLER'] is False
+
+    def test_metrics(self):
+        self.app.get('/')
+        rv = self.app.get('/metrics')
+        assert rv.status_code == 200
+        assert rv.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+        assert 'butlercam_http_requests_total{route="/",method="GET",status="200"}' \
+            in rv.data
+        assert 'butlercam_build_cache_lookups_total' in rv.data
+
+    def test_metrics_count_errors(self):
+        key = ('/events', 'GET', '500')
+        before = butlercam.HTTP_REQUESTS.values.get(key, 0)
+        # There is no Redis to subscribe to, so the view raises.
+        self.assertRaises(ConnectionError, self.app.get, '/events')
+        assert butlercam.HTTP_REQUESTS.values[key] == before + 1
+
+    def test_server_timing(self):
+        rv = self.app.get('/')
+        timing = rv.headers['Server-Timing']
+        assert timing.startswith('jenkins;dur=')
+        assert 'template;dur=' in timing and 'total;dur=' in timing
+
+    def test_profile(self):
+        rv = self.app.get('/?profile=1')
+        assert 'BUTLERCAM Dashboard' in rv.data
+        self.flask_app.config['PROFILE_REQUESTS'] = True
+        rv = self.app.get('/?profile=1')
+        assert rv.mimetype == 'text/plain'
+        assert 'cumulative' in rv.data and 'show_home' in rv.data
+
+    def test_profile_error(self):
+        self.flask_app.config['PROFILE_REQUESTS'] = True
+        self.assertRaises(ConnectionError, self.app.get, '/events?profile=1')
+        assert sys.getprofile() is None
+        assert request_timing.stop() is None
+
+    def test_event_streams_capped(self):
+        streams = self.flask_app.extensions['event_streams']
+        # There is no Redis to subscribe to, so the stream is released again.
+        self.assertRaises(ConnectionError, self.app.get, '/events')
+        for _ in range(self.flask_app.config['SSE_MAX_STREAMS']):
+            assert streams.acquire(False)
+        try:
+            rv = self.app.get('/events')
+            assert rv.status_code == 503
+            assert rv.headers['Retry-After'] == '5'
+        finally:
+            for _ in range(self.flask_app.config['SSE_MAX_STREAMS']):
+                streams.release()
+
+    def test_iter_status_events(self):
+        times = iter([0, 5, 20])
+        snapshot = {'churro': {'result': 'SUCCESS'}, 'empty': None}
+        changes = [None, {'pipeline': 'churro', 'status': {'result': 'FAILURE'}}, None]
+        events = list(butlercam.iter_status_events(snapshot, iter(changes), 10,
+                                                   clock=lambda: next(times)))
+        assert events[0] == 'retry: 5000\n\n'
+        assert events[1] == butlercam.format_event(
+            'status', {'pipeline': 'churro', 'status': {'result': 'SUCCESS'}})
+        assert events[2] == ': keepalive\n\n'
+        assert events[3].startswith('event: status\ndata: ')
+        assert json.loads(events[3].split('data: ')[1]) == changes[1]
+        assert len(events) == 4
+
+    def test_chart_etag(self):
+        today = datetime.date(2016, 7, 1)
+        assert butlercam.chart_etag('churro', 'buildtime', 7, today) == 'churro-buildtime-7'
+        assert butlercam.chart_etag('churro', 'week', 7, today) == \
+            'churro-week-7-2016-07-01'
+        assert butlercam.chart_etag('churro', 'failures', 7, today, days=30) == \
+            'churro-failures-7-30d-2016-07-01'
+
+    def test_pipeline_page_rerendered_for_new_build(self):
+        # The page lists the latest builds in four columns, so it needs at
+        # least four of them.
+        builds = dict((n, self.test_builds[n]) for n in (213, 214))
+        for number in (211, 212):
+            builds[number] = dict(self.test_builds[213], number=number,
+                                  timestamp=self.test_builds[213]['timestamp'] -
+                                  (213 - number) * 3600000)
+        jenkins = StubJenkins(builds).start()
+        jenkins_persistence.db = StubRedis()
+        cache = PageCache(jenkins_persistence.db, 10)
+        self.flask_app.extensions['page_cache'] = cache
+        self.flask_app.config['PIPELINES']['churro'] = ('jenkins1', jenkins.job_url)
+        try:
+            jenkins_persistence.sync_builds('churro')
+            first = self.app.get('/pipeline/churro').data
+            version = jenkins_persistence.get_versions(['churro'])[0]
+            assert cache.lookup('pipeline:churro:%d' % version) == first.decode('utf-8')
+            assert self.app.get('/pipeline/churro').data == first
+
+            jenkins.builds[215] = self.test_builds[215]
+            jenkins_persistence.sync_builds('churro')
+            assert jenkins_persistence.get_versions(['churro'])[0] != version
+            second = self.app.get('/pipeline/churro').data
+            assert second != first
+            assert '215' in second and '215' not in first
+        finally:
+            del self.flask_app.config['PIPELINES']['churro']
+            jenkins.stop()
+
+    def test_chart_etag_changes_when_later_build_completes(self):
+        builds = dict(self.test_builds)
+        for number in (213, 215):
+            builds[number] = dict(builds[number], building=True, result=None,
+                                  duration=0)
+        jenkins = StubJenkins(builds).start()
+        jenkins_persistence.db = StubRedis()
+        self.flask_app.config['PIPELINES']['churro'] = ('jenkins1', jenkins.job_url)
+        try:
+            jenkins_persistence.sync_builds('churro')
+            url = '/api/pipeline/churro/charts/buildtime'
+            first = self.app.get(url)
+            etag = first.headers['ETag']
+            assert self.app.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+            # 215 finishes while 213 is still building, so the stats can't
+            # move past 213 and the high-water mark stays at 215.
+            jenkins.builds[215] = dict(self.test_builds[215], duration=30 * 60 * 1000)
+            jenkins_persistence.sync_builds('churro')
+            assert jenkins_persistence.get_stats('churro')['last_number'] == 0
+            second = self.app.get(url, headers={'If-None-Match': etag})
+            assert second.status_code == 200
+            assert second.headers['ETag'] != etag
+            assert second.data != first.data
+        finally:
+            del self.flask_app.config['PIPELINES']['churro']
+            jenkins.stop()
+
+    def test_unknown_chart(self):
+        rv = self.app.get('/api/pipeline/churro/charts/percentage')
+        assert rv.status_code == 404
+
+    def test_csv_rejects_negative_limit(self):
+        pipelines = self.flask_app.config['PIPELINES']
+        pipelines['churro'] = ('jenkins1', 'http://jenkins1/job/churro')
+        try:
+            assert self.app.get('/pipeline/churro/csv?limit=-1').status_code == 400
+            rv = self.app.get('/pipeline/churro/csv?limit=0')
+            assert rv.data == 'number,result,start,duration,description\n'
+        finally:
+            del pipelines['churro']
+
+    def test_unknown_pipeline_pages(self):
+        for url in ('/pipeline/churro', '/pipeline/churro/213', '/pipeline/churro/csv'):
+            assert self.app.get(url).status_code == 404
+
     def test_ms_to_time(self):
         assert butlercam.ms_to_time(1000) == "1s"
         assert butlercam.ms_to_time(5233543) == "1h:27m:13s"
@@ -36,6 +242,51 @@ class butlercamTestCase(unittest.TestCase):
         assert top_failing_jobs[0] == (1, 'job3')
         assert top_failing_jobs[1] == (1, 'job1')
 
+    def test_get_top_failing_jobs_summaries(self):
+        summaries = OrderedDict()
+        for number, build in self.test_builds.iteritems():
+            summaries[number] = build_summary.summarize_build(build)
+        top_failing_jobs = butlercam.get_top_failing_jobs(summaries, 'churro')
+        assert top_failing_jobs == butlercam.get_top_failing_jobs(
+            OrderedDict(self.test_builds), 'churro')
+
+    def test_build_summary_round_trip(self):
+        build = self.test_builds[213]
+        summary = build_summary.summarize_build(build)
+        assert summary['result'] == build['result']
+        assert summary.get('display_name') == build['displayName']
+        assert summary.failures == ('job3',)
+        assert build_summary.BuildSummary.from_json(summary.to_json()) == summary
+
+    def test_build_summary_get_only_fields(self):
+        summary = build_summary.summarize_build(self.test_builds[213])
+        assert summary.get('count') is None
+        assert summary.get('index', 'missing') == 'missing'
+        self.assertRaises(KeyError, summary.__getitem__, 'count')
+
+    def test_build_summary_from_old_json(self):
+        summary = build_summary.summarize_build(self.test_builds[213])
+        old_json = json.dumps(list(summary)[:-1])
+        loaded = build_summary.BuildSummary.from_json(old_json)
+        assert loaded.failure_paths == (('job3',),)
+
+    def test_find_failure_paths(self):
+        build = [{'jobName': 'phase1', 'result': 'FAILURE',
+                  'build': {'subBuilds': [{'jobName': 'unit', 'result': 'SUCCESS'},
+                                          {'jobName': 'lint', 'result': 'FAILURE'}]}},
+                 {'jobName': 'deploy', 'result': 'FAILURE'}]
+        assert build_summary.find_failure_paths(build) == \
+            [('phase1', 'lint'), ('deploy',)]
+
+    def test_find_failure_paths_deep_nesting(self):
+        build = {'jobName': 'leaf', 'result': 'FAILURE'}
+        for depth in range(5000):
+            build = {'jobName': 'job%d' % depth, 'result': 'FAILURE', 'subBuilds': [build]}
+        paths = build_summary.find_failure_paths(build)
+        assert len(paths) == 1
+        assert len(paths[0]) == 5001
+        assert paths[0][-1] == 'leaf'
+
     def test_get_build_failure(self):
         acc = collections.defaultdict(int)
         butlercam.get_build_failure(self.test_builds[self.test_builds.keys()[0]], acc)
@@ -43,7 +294,28 @@ class butlercamTestCase(unittest.TestCase):
         assert acc['job3'] == 1
 
     def test_get_build_lights(self):
-        assert len(butlercam.get_build_lights()) == len(butlercam.app.config['PIPELINES'])
+        pipelines = self.flask_app.config['PIPELINES']
+        assert len(butlercam.get_build_lights(pipelines)) == len(pipelines)
+
+    def test_get_build_lights_from_snapshot(self):
+        pipelines = {'churro': ('jenkins1', 'http://jenkins1/job/churro')}
+        lights = butlercam.get_build_lights(pipelines, {'churro': {
+            'result': None, 'building': True, 'duration': 0,
+            'last_complete_result': 'SUCCESS',
+            'last_complete_duration': 1000, 'updated': 0}})
+        assert lights == [('churro', None, 'SUCCESS', True, 'jenkins1', '', False)]
+
+    def test_get_build_lights_stale(self):
+        pipelines = {'churro': ('jenkins1', 'http://jenkins1/job/churro')}
+        lights = butlercam.get_build_lights(pipelines, {'churro': {
+            'result': 'FAILURE', 'building': False, 'duration': 1000,
+            'last_complete_result': 'FAILURE', 'stale': True, 'updated': 0}})
+        assert lights[0][6]
+
+    def test_get_status_age(self):
+        assert butlercam.get_status_age({'churro': None}) is None
+        age = butlercam.get_status_age({'churro': {'updated': time.time() - 30}})
+        assert 29 <= age <= 31
 
     def test_calculate_build_slices(self):
         assert len(self.test_build_slices) == 2
@@ -56,6 +328,37 @@ class butlercamTestCase(unittest.TestCase):
         assert self.test_build_slices[1]['end'] == 1473265188
         assert self.test_build_slices[1]['result'] == 'SUCCESS'
 
+    def test_get_time_percentages_multiple_midnights(self):
+        today = datetime.date(2016, 9, 10)
+        midnights = custom_charts.get_day_boundaries(3, today)
+        time_data = {'build_slices': [
+            {'start': midnights[0] + 12 * 3600, 'end': midnights[1] + 18 * 3600,
+             'result': 'SUCCESS'},
+            {'start': midnights[1] + 18 * 3600, 'end': midnights[2] + 6 * 3600,
+             'result': 'FAILURE'}
+        ]}
+        passing, failing = custom_charts.get_time_percentages(time_data, 3, today)
+        assert passing['data'] == [100.0, 75.0, 0.0]
+        assert failing['data'] == [0.0, 25.0, 100.0]
+
+    def test_make_week_chart_includes_build_before_week(self):
+        week_start = custom_charts.get_day_boundaries(7)[0]
+        before = {1: {'timestamp': (week_start - 3600) * 1000, 'result': 'FAILURE'}}
+        during = OrderedDict([
+            (2, {'timestamp': (week_start + 3600) * 1000, 'result': 'SUCCESS'}),
+            (3, {'timestamp': (week_start + 7200) * 1000, 'result': 'SUCCESS'})])
+        get_builds_between = butlercam.get_builds_between
+        get_build_before = butlercam.get_build_before
+        butlercam.get_builds_between = lambda pipeline, start, end: OrderedDict(during)
+        butlercam.get_build_before = lambda pipeline, timestamp: dict(before)
+        try:
+            passing, failing = butlercam.make_week_chart('churro')['series']
+        finally:
+            butlercam.get_builds_between = get_builds_between
+            butlercam.get_build_before = get_build_before
+        assert passing['data'][0] == 50.0
+        assert failing['data'][0] == 50.0
+
     def test_process_time_data(self):
         time_data = butlercam.process_time_data(self.test_build_slices)
         assert time_data['green']['h'] == 0
@@ -111,6 +414,39 @@ class butlercamTestCase(unittest.TestCase):
         else:
             assert first_row[4] == first_build['description']
 
+    def test_iter_build_csv_fields_and_quoting(self):
+        build = dict(self.test_builds[self.test_builds.keys()[0]],
+                     description=u'caf\xe9, "quoted"')
+        lines = list(butlercam.iter_build_csv([build], ('number', 'description')))
+        assert lines[0] == 'number,description\n'
+        assert lines[1] == '%d,"caf\xc3\xa9, ""quoted"""\n' % build['number']
+
+    def test_parse_csv_time(self):
+        day = butlercam.parse_csv_time('2016-07-01')
+        assert butlercam.parse_csv_time('2016-07-01 00:00:10') == day + 10000
+        self.assertRaises(ValueError, butlercam.parse_csv_time, 'yesterday')
+
+    def test_parse_csv_time_until_end_of_day(self):
+        next_day = butlercam.parse_csv_time('2016-07-02')
+        assert butlercam.parse_csv_time('2016-07-01', end=True) == next_day - 1
+        assert butlercam.parse_csv_time('2016-07-01 00:00:10', end=True) == \
+            butlercam.parse_csv_time('2016-07-01 00:00:10')
+
+    def test_csv_until_date_includes_the_day(self):
+        jenkins_persistence.db = StubRedis()
+        pipe = jenkins_persistence.db.pipeline()
+        jenkins_persistence.store_summaries(
+            pipe, 'churro', [build_summary.summarize_build(b) for b in self.test_builds.values()])
+        pipe.execute()
+        day = datetime.datetime.fromtimestamp(self.test_builds[215]['timestamp'] / 1000)
+        self.flask_app.config['PIPELINES']['churro'] = ('jenkins1', 'http://jenkins1/job/churro')
+        try:
+            rv = self.app.get('/pipeline/churro/csv?fields=number&until=' +
+                              day.strftime('%Y-%m-%d'))
+        finally:
+            del self.flask_app.config['PIPELINES']['churro']
+        assert rv.data.splitlines() == ['number', '213', '214', '215']
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,207 @@
+"""
+A standalone worker that owns all of the Jenkins polling for a Butlercam
+deployment. Any number of workers can be run; only the one holding the
+leader lock in Redis polls, and another takes over if it goes away.
+"""
+# pylint: disable=C0103
+
+import random
+import time
+import urlparse
+import uuid
+
+from flask import Flask
+
+from jenkins_persistence import compact_all, get_status_snapshot, init_app, \
+    load_config, process_build_queue, sync_all_builds
+import jenkins_persistence
+import metrics
+from poll_scheduler import PollScheduler
+
+LEADER_KEY = 'worker:leader'
+
+POLL_SECONDS = metrics.registry.histogram(
+    'butlercam_poll_seconds',
+    'Time taken by each round of polling the pipelines that are due.')
+POLLED = metrics.registry.counter(
+    'butlercam_pipelines_polled_total',
+    'Pipeline polls, by whether they found new builds, found none or failed.',
+    ('outcome',))
+
+# The longest the worker blocks waiting for build notifications before
+# renewing its lock.
+INGEST_WAIT_S = 30
+
+# Extend the lock only if we still hold it.
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Delete the lock only if we still hold it.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaderLock(object):
+    """
+    A lock in Redis that expires after `ttl` seconds unless it is renewed
+    by the worker holding it.
+    """
+
+    def __init__(self, database, key, ttl):
+        self.database = database
+        self.key = key
+        self.ttl_ms = int(ttl * 1000)
+        self.token = uuid.uuid4().hex
+        self.renew_script = database.register_script(RENEW_SCRIPT)
+        self.release_script = database.register_script(RELEASE_SCRIPT)
+
+    def acquire(self):
+        """
+        Take the lock if nobody holds it, or extend it if we already do.
+        Returns True if we hold the lock afterwards.
+        """
+
+        if self.renew_script(keys=[self.key], args=[self.token, self.ttl_ms]):
+            return True
+        return bool(self.database.set(self.key, self.token, px=self.ttl_ms, nx=True))
+
+    def release(self):
+        """
+        Give up the lock if we hold it.
+        """
+
+        return bool(self.release_script(keys=[self.key], args=[self.token]))
+
+
+def next_delay(started, interval, jitter, now=None):
+    """
+    Return how long to sleep so that the next tick starts `interval`
+    seconds after `started`, plus up to `jitter` random seconds so that
+    several workers don't wake up in lockstep.
+    """
+
+    if now is None:
+        now = time.time()
+
+    return max(0.0, started + interval - now) + random.uniform(0, jitter)
+
+
+def make_scheduler(config, now):
+    """
+    Create the PollScheduler for the PIPELINES in `config`.
+    """
+
+    hosts = dict((name, urlparse.urlsplit(url).netloc)
+                 for name, (_, url) in config['PIPELINES'].iteritems())
+
+    return PollScheduler(hosts,
+                         interval=config['UPDATE_INTERVAL_S'],
+                         max_interval=config['POLL_MAX_INTERVAL_S'],
+                         building_interval=config['POLL_BUILDING_INTERVAL_S'],
+                         backoff=config['POLL_BACKOFF'],
+                         host_budget=config['HOST_REQUESTS_PER_MINUTE'],
+                         now=now)
+
+
+def poll_due(scheduler, now):
+    """
+    Sync the pipelines that the scheduler says are due and tell it what
+    each poll found.
+    """
+
+    due = scheduler.pop_due(now)
+    if not due:
+        return
+
+    before = jenkins_persistence.jenkins.requests_by_host()
+    with POLL_SECONDS.time():
+        written = sync_all_builds(due)
+    requests = requests_since(before)
+    snapshot = get_status_snapshot(due)
+
+    finished = time.time()
+    scheduler.settle(due, requests, finished)
+    for name in due:
+        changed = written.get(name)
+        POLLED.inc(outcome='failed' if changed is None else
+                   'changed' if changed else 'unchanged')
+        building = (snapshot.get(name) or {}).get('building', False)
+        scheduler.record(name, None if changed is None else changed > 0,
+                         building, finished)
+
+
+def ingest_notified(scheduler, wait):
+    """
+    Ingest the build notifications that arrive within `wait` seconds,
+    charge the Jenkins requests made for them to their hosts' budgets, and
+    have the pipelines they were for polled soon.
+    """
+
+    before = jenkins_persistence.jenkins.requests_by_host()
+    ingested = process_build_queue(wait)
+    now = time.time()
+    scheduler.charge(requests_since(before), now)
+    for name in ingested:
+        scheduler.poke(name, now)
+
+
+def requests_since(before):
+    """
+    Given the requests that the Jenkins client had made to each host, as
+    returned by `requests_by_host`, return how many it has made since.
+    """
+
+    after = jenkins_persistence.jenkins.requests_by_host()
+    return dict((host, count - before.get(host, 0)) for host, count in after.iteritems())
+
+
+def run():
+    """
+    While holding the leader lock, poll each pipeline in PIPELINES when the
+    scheduler says it is due, ingest queued build notifications as they
+    arrive, and apply the retention settings once per COMPACT_INTERVAL_S.
+    The worker's metrics are served on WORKER_METRICS_PORT if it is set.
+    """
+
+    app = Flask(__name__)
+    load_config(app)
+    init_app(app)
+    config = app.config
+
+    if config['WORKER_METRICS_PORT']:
+        metrics.serve(config['WORKER_METRICS_PORT'])
+
+    lock = LeaderLock(jenkins_persistence.db, LEADER_KEY, config['WORKER_LOCK_TTL_S'])
+    scheduler = make_scheduler(config, time.time())
+    last_compacted = 0
+
+    try:
+        while True:
+            now = time.time()
+            if not lock.acquire():
+                print 'Another worker holds', LEADER_KEY, '- standing by'
+                time.sleep(next_delay(now, INGEST_WAIT_S, config['WORKER_JITTER_S']))
+                continue
+
+            poll_due(scheduler, now)
+            if now - last_compacted >= config['COMPACT_INTERVAL_S']:
+                print 'Compaction reclaimed', compact_all(config['PIPELINES'].keys()), 'bytes'
+                last_compacted = now
+
+            next_due = scheduler.next_due()
+            wait = INGEST_WAIT_S if next_due is None else next_due - time.time()
+            ingest_notified(scheduler, min(wait, INGEST_WAIT_S))
+    finally:
+        lock.release()
+
+
+if __name__ == '__main__':
+    run()
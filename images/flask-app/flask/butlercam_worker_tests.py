@@ -0,0 +1,64 @@
+import butlercam_worker
+import jenkins_persistence
+import time
+import unittest
+
+from poll_scheduler import PollScheduler
+
+
+class CountingJenkins(object):
+    """
+    Stands in for the Jenkins client, counting the requests made to it.
+    """
+
+    def __init__(self):
+        self.requests = {}
+
+    def get_json(self, url):
+        host = url.split('/')[2]
+        self.requests[host] = self.requests.get(host, 0) + 1
+        return {}
+
+    def requests_by_host(self):
+        return dict(self.requests)
+
+
+class butlercamWorkerTestCase(unittest.TestCase):
+
+    def test_next_delay(self):
+        assert butlercam_worker.next_delay(100, 60, 0, now=130) == 30
+        assert butlercam_worker.next_delay(100, 60, 0, now=200) == 0
+
+    def test_next_delay_jitter(self):
+        delay = butlercam_worker.next_delay(100, 60, 5, now=130)
+        assert 30 <= delay <= 35
+
+    def test_ingest_notified_charges_hosts(self):
+        now = time.time()
+        scheduler = PollScheduler({'churro': 'jenkins1'}, interval=60, max_interval=300,
+                                  building_interval=10, host_budget=60, now=now)
+        scheduler.pop_due(now)
+        scheduler.record('churro', False, False, now)
+        client = CountingJenkins()
+
+        def process_build_queue(_):
+            for _ in range(60):
+                client.get_json('http://jenkins1/job/churro/1/api/json')
+            return ['churro']
+
+        jenkins = jenkins_persistence.jenkins
+        process = butlercam_worker.process_build_queue
+        jenkins_persistence.jenkins = client
+        butlercam_worker.process_build_queue = process_build_queue
+        try:
+            butlercam_worker.ingest_notified(scheduler, 0)
+        finally:
+            jenkins_persistence.jenkins = jenkins
+            butlercam_worker.process_build_queue = process
+        assert scheduler.budgets['jenkins1'].tokens < 0
+        # The notified pipeline is poked, but has to wait for its host.
+        assert scheduler.pop_due(scheduler.next_due()) == []
+
+
+if __name__ == '__main__':
+    unittest.main()
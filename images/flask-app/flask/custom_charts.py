@@ -3,16 +3,18 @@ A set of functions that configure the HighCharts objects used in
 butlercam-app.
 """
 
+import bisect
 import datetime
-import copy
+import time
 
-def percentage_chart(builds):
+from build_summary import BuildSummary
+
+def percentage_chart(percentages):
     """
     Configure the chart showing the percentage of builds that succeed,
-    fail, or are aborted.
+    fail, or are aborted, given the list from `get_percentages`.
     """
 
-    percentages = get_percentages(builds)
     chart = {
         "backgroundColor": 'rgba(255, 255, 255, 0)',
         "plotBackgroundColor": 'none',
@@ -167,7 +169,7 @@ def get_percentages(builds):
 
     for k in builds:
         build = builds[k]
-        if isinstance(build, dict):
+        if isinstance(build, (dict, BuildSummary)):
             if build['result'] == 'SUCCESS':
                 passing_builds += 1
             elif build['result'] == 'FAILURE':
@@ -175,7 +177,17 @@ def get_percentages(builds):
             else:
                 aborted_builds += 1
 
+    return get_count_percentages(passing_builds, failing_builds, aborted_builds)
+
+def get_count_percentages(passing_builds, failing_builds, aborted_builds):
+    """
+    Calculates the percentages of builds that pass, fail, or are
+    aborted from the number of each.
+    """
+
     total_builds = passing_builds + failing_builds + aborted_builds
+    if total_builds == 0:
+        return [0, 0, 0]
 
     passing_percent = passing_builds * 100 / total_builds
     failing_percent = failing_builds * 100 / total_builds
@@ -183,10 +195,10 @@ def get_percentages(builds):
 
     return [passing_percent, failing_percent, aborted_percent]
 
-def week_chart(time_data):
+def week_chart(time_data, days=7):
     """
     Configures the chart that shows the percentage of time spent red
-    and green on each day in the past week.
+    and green on each of the last `days` days (a week by default).
     """
 
     colors = ["#00d000", "#c00000"]
@@ -198,7 +210,7 @@ def week_chart(time_data):
     }
     x_axis = {
         "gridLineWidth": 0,
-        "categories": ["6d ago", "5d ago", "4d ago", "3d ago", "2d ago", "yesterday", "today"],
+        "categories": get_day_labels(days),
         "labels": {
             "style": {
                 "color": "#ffffff"
@@ -216,7 +228,7 @@ def week_chart(time_data):
             "color": "#ffffff"
         }
     }
-    series = get_time_percentages(time_data)
+    series = get_time_percentages(time_data, days)
     chart_dict = {
         "colors": colors,
         "chart": chart,
@@ -227,49 +239,60 @@ def week_chart(time_data):
     }
     return chart_dict
 
-def get_time_percentages(time_data):
+def get_day_labels(days):
     """
-    Analyzes the given time data to produce percentages of time spent
-    red and green on each day in the last week.
+    Labels for the last `days` days, oldest first.
     """
 
-    dates = [0, 0, 0, 0, 0, 0, datetime.date.today()]
+    labels = ["%dd ago" % i for i in range(days - 1, 1, -1)]
+    return labels + ["yesterday", "today"][-days:]
 
-    diff = datetime.timedelta(days=1)
-    for i in reversed(range(0, 6)):
-        dates[i] = dates[i + 1] - diff
-
-    green = [0, 0, 0, 0, 0, 0, 0]
-    red = [0, 0, 0, 0, 0, 0, 0]
-
-    for build_slice in copy.deepcopy(time_data["build_slices"]):
-        start_date = datetime.datetime.fromtimestamp(build_slice["start"]).date()
-        end_date = datetime.datetime.fromtimestamp(build_slice["end"]).date()
+def get_day_boundaries(days, today=None):
+    """
+    Returns the local midnights (in seconds since the epoch) that start
+    each of the last `days` days, followed by the midnight that ends today.
+    """
 
-        if start_date != end_date:
-            almost_midnight = datetime.time(23, 59, 59)
-            newend = (datetime.datetime.combine(start_date, almost_midnight) - \
-                datetime.datetime.fromtimestamp(0)).total_seconds()
-            build_slice["extra_duration"] = build_slice["end"] - newend
-            build_slice["end"] = newend
-            build_slice["duration"] = build_slice["end"] - build_slice["start"]
+    if today is None:
+        today = datetime.date.today()
 
-        build_date = datetime.datetime.fromtimestamp(build_slice["start"]).date()
+    boundaries = []
+    for i in range(days, -1, -1):
+        day = today - datetime.timedelta(days=i - 1)
+        boundaries.append(int(time.mktime(day.timetuple())))
 
-        for i in range(0, 7):
-            if build_date == dates[i]:
-                if build_slice["result"] == "SUCCESS":
-                    green[i] += build_slice["duration"]
-                elif build_slice["result"] == "FAILURE":
-                    red[i] += build_slice["duration"]
+    return boundaries
 
-                if i < 6 and "extra_duration" in build_slice:
-                    if build_slice["result"] == "SUCCESS":
-                        green[i + 1] += build_slice["extra_duration"]
-                    elif build_slice["result"] == "FAILURE":
-                        red[i + 1] += build_slice["extra_duration"]
+def get_time_percentages(time_data, days=7, today=None):
+    """
+    Analyzes the given time data to produce percentages of time spent
+    red and green on each of the last `days` days. Slices are split at
+    every midnight they cross.
+    """
 
-    for i in range(0, 7):
+    boundaries = get_day_boundaries(days, today)
+
+    green = [0] * days
+    red = [0] * days
+
+    for build_slice in time_data["build_slices"]:
+        if build_slice["result"] == "SUCCESS":
+            totals = green
+        elif build_slice["result"] == "FAILURE":
+            totals = red
+        else:
+            continue
+
+        start = max(build_slice["start"], boundaries[0])
+        end = min(build_slice["end"], boundaries[-1])
+        day = bisect.bisect_right(boundaries, start) - 1
+        while start < end:
+            day_end = min(end, boundaries[day + 1])
+            totals[day] += day_end - start
+            start = day_end
+            day += 1
+
+    for i in range(0, days):
         green_t = float(green[i])
         red_t = float(red[i])
         total = float(green_t + red_t)
@@ -1,5 +1,38 @@
 REDIS_HOST = 'localhost'
+REDIS_PORT = 6379
 CACHE_TIMEOUT = 600
+BUILD_CACHE_SIZE = 256
+PAGE_CACHE_SIZE = 1000
+UPDATE_INTERVAL_S = 300
+POLL_MAX_INTERVAL_S = 1800
+POLL_BUILDING_INTERVAL_S = 30
+POLL_BACKOFF = 2
+HOST_REQUESTS_PER_MINUTE = 120
+EMBEDDED_POLLER = False
+WORKER_JITTER_S = 5
+WORKER_LOCK_TTL_S = 900
+WORKER_METRICS_PORT = None
+JENKINS_CONNECTIONS_PER_HOST = 4
+JENKINS_TIMEOUT_S = 30
+JENKINS_CONNECT_TIMEOUT_S = 5
+JENKINS_BREAKER_FAILURES = 5
+JENKINS_BREAKER_RESET_S = 60
+SUBBUILD_DEPTH = 8
+POLL_WORKERS = 8
+PIPELINE_TIMEOUT_S = 120
+DOC_RETENTION_BUILDS = 500
+DOC_RETENTION_DAYS = 30
+HISTORY_HORIZON_DAYS = 730
+PIPELINE_RETENTION = {}
+COMPACT_INTERVAL_S = 3600
+HOOK_TOKEN = None
+SSE_HEARTBEAT_S = 15
+SSE_MAX_AGE_S = 600
+SSE_MAX_STREAMS = 12
+PROFILE_REQUESTS = False
+METRICS_DIR = None
+METRICS_FLUSH_S = 5
+PROFILE_TOP_FUNCTIONS = 40
 PIPELINES = {}
 # Example Pipeline dict
 #PIPELINES = {
@@ -0,0 +1,254 @@
+"""
+Exports the saved build history of a pipeline to a file, and imports it
+back, so that a dashboard can be backed up, moved or seeded with builds
+that Jenkins no longer holds.
+
+    python history_io.py export <pipeline> <file> [--format ndjson|columnar]
+    python history_io.py import <pipeline> <file>
+
+Two formats are supported: NDJSON, one build summary object per line, and
+a compact columnar binary format holding the number, timestamp, duration,
+result and building fields as packed arrays with the remaining fields in
+a compressed trailer. Imports detect the format from the file itself.
+"""
+# pylint: disable=C0103
+
+import argparse
+import itertools
+import json
+import struct
+import sys
+import zlib
+
+from flask import Flask
+
+from build_summary import BuildSummary, SUMMARY_FIELDS
+from jenkins_persistence import init_app, iter_builds, load_config, rebuild_stats, \
+    store_summaries
+import jenkins_persistence
+
+# The first bytes of a columnar history file, including the format version.
+COLUMNAR_MAGIC = 'BCH1'
+
+# How many summaries to write to Redis in a single pipelined round trip.
+IMPORT_CHUNK_SIZE = 1000
+
+
+def encode_ndjson(summaries):
+    """
+    Given an iterable of BuildSummary records, yield them as NDJSON lines.
+    """
+
+    for summary in summaries:
+        yield json.dumps(dict(zip(SUMMARY_FIELDS, summary)), sort_keys=True) + '\n'
+
+
+def decode_ndjson(lines):
+    """
+    Given an iterable of NDJSON lines written by `encode_ndjson`, yield
+    the BuildSummary records. Blank lines are skipped.
+    """
+
+    for line in lines:
+        if not line.strip():
+            continue
+        fields = json.loads(line)
+        fields['causes'] = tuple(fields.get('causes') or ())
+        fields['failures'] = tuple(fields.get('failures') or ())
+        paths = fields.get('failure_paths') or [[name] for name in fields['failures']]
+        fields['failure_paths'] = tuple(tuple(path) for path in paths)
+        yield BuildSummary(**fields)
+
+
+def encode_columnar(summaries):
+    """
+    Given an iterable of BuildSummary records, return them packed into the
+    columnar binary format: the magic and a count, then little-endian
+    arrays of numbers, timestamps, durations (-1 for none), result codes
+    and building flags, then a length-prefixed zlib-compressed JSON
+    trailer with the result names and the text fields of each build.
+    """
+
+    summaries = list(summaries)
+    count = len(summaries)
+
+    results = []
+    codes = []
+    for summary in summaries:
+        if summary.result not in results:
+            results.append(summary.result)
+        codes.append(results.index(summary.result))
+
+    trailer = zlib.compress(json.dumps({
+        'results': results,
+        'text': [[s.description, s.display_name, s.causes, s.failures,
+                  s.failure_paths] for s in summaries]
+    }))
+
+    return ''.join([
+        struct.pack('<4sI', COLUMNAR_MAGIC, count),
+        struct.pack('<%dq' % count, *[s.number for s in summaries]),
+        struct.pack('<%dq' % count, *[s.timestamp for s in summaries]),
+        struct.pack('<%dq' % count,
+                    *[-1 if s.duration is None else s.duration for s in summaries]),
+        struct.pack('<%dB' % count, *codes),
+        struct.pack('<%dB' % count, *[bool(s.building) for s in summaries]),
+        struct.pack('<I', len(trailer)),
+        trailer
+    ])
+
+
+def decode_columnar(data):
+    """
+    Given a string in the format written by `encode_columnar`, return the
+    list of BuildSummary records.
+    """
+
+    magic, count = struct.unpack_from('<4sI', data, 0)
+    if magic != COLUMNAR_MAGIC:
+        raise ValueError('Not a columnar history file')
+
+    offset = struct.calcsize('<4sI')
+    columns = []
+    for code in ('q', 'q', 'q', 'B', 'B'):
+        layout = '<%d%s' % (count, code)
+        columns.append(struct.unpack_from(layout, data, offset))
+        offset += struct.calcsize(layout)
+    numbers, timestamps, durations, codes, building = columns
+
+    length, = struct.unpack_from('<I', data, offset)
+    offset += struct.calcsize('<I')
+    trailer = json.loads(zlib.decompress(data[offset:offset + length]))
+
+    summaries = []
+    for i in range(count):
+        description, display_name, causes, failures = trailer['text'][i][:4]
+        paths = trailer['text'][i][4:] or [[[name] for name in failures]]
+        summaries.append(BuildSummary(number=numbers[i],
+                                      result=trailer['results'][codes[i]],
+                                      timestamp=timestamps[i],
+                                      duration=None if durations[i] < 0 else durations[i],
+                                      building=bool(building[i]),
+                                      description=description,
+                                      display_name=display_name,
+                                      causes=tuple(causes),
+                                      failures=tuple(failures),
+                                      failure_paths=tuple(tuple(path)
+                                                          for path in paths[0])))
+
+    return summaries
+
+
+def export_history(pipeline, out, fmt='ndjson'):
+    """
+    Given the name of a pipeline, a file open for writing and a format,
+    write every saved build summary of the pipeline to the file. Returns
+    the number of builds written.
+    """
+
+    count = 0
+    if fmt == 'columnar':
+        summaries = list(iter_builds(pipeline))
+        out.write(encode_columnar(summaries))
+        count = len(summaries)
+    else:
+        for line in encode_ndjson(iter_builds(pipeline)):
+            out.write(line)
+            count += 1
+
+    return count
+
+
+def read_history(history_file):
+    """
+    Given a file open for reading, yield the build summaries in it,
+    whichever format it was exported in.
+    """
+
+    head = history_file.read(len(COLUMNAR_MAGIC))
+    if head == COLUMNAR_MAGIC:
+        for summary in decode_columnar(head + history_file.read()):
+            yield summary
+    else:
+        lines = itertools.chain([head + history_file.readline()], history_file)
+        for summary in decode_ndjson(lines):
+            yield summary
+
+
+def import_history(pipeline, summaries):
+    """
+    Given the name of a pipeline and an iterable of build summaries, save
+    the summaries in IMPORT_CHUNK_SIZE batches of pipelined writes, move
+    the high-water mark forward if needed and recompute the pipeline's
+    statistics. Builds that are already saved are overwritten. Returns
+    the number of builds imported.
+    """
+
+    count = 0
+    highest = 0
+    chunk = []
+    for summary in summaries:
+        chunk.append(summary)
+        if len(chunk) == IMPORT_CHUNK_SIZE:
+            highest = max(highest, _write_chunk(pipeline, chunk))
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        highest = max(highest, _write_chunk(pipeline, chunk))
+        count += len(chunk)
+
+    db = jenkins_persistence.db
+    if highest > int(db.get(pipeline + ':high_water') or 0):
+        db.set(pipeline + ':high_water', highest)
+    rebuild_stats(pipeline)
+    db.incr(pipeline + ':version')
+
+    return count
+
+
+def _write_chunk(pipeline, summaries):
+    """
+    Save one batch of summaries in a single round trip and return the
+    highest build number in it.
+    """
+
+    pipe = jenkins_persistence.db.pipeline(transaction=False)
+    store_summaries(pipe, pipeline, summaries)
+    pipe.execute()
+    return max(summary.number for summary in summaries)
+
+
+def main(argv):
+    """
+    Run the export or import command given on the command line.
+    """
+
+    parser = argparse.ArgumentParser(description='Export or import the saved '
+                                     'build history of a pipeline.')
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export')
+    export_parser.add_argument('pipeline')
+    export_parser.add_argument('file')
+    export_parser.add_argument('--format', choices=('ndjson', 'columnar'),
+                               default='ndjson')
+    import_parser = commands.add_parser('import')
+    import_parser.add_argument('pipeline')
+    import_parser.add_argument('file')
+    args = parser.parse_args(argv)
+
+    app = Flask(__name__)
+    load_config(app)
+    init_app(app)
+
+    if args.command == 'export':
+        with open(args.file, 'wb') as out:
+            count = export_history(args.pipeline, out, args.format)
+        print 'Builds for pipeline', args.pipeline, 'exported:', count
+    else:
+        with open(args.file, 'rb') as history_file:
+            count = import_history(args.pipeline, read_history(history_file))
+        print 'Builds for pipeline', args.pipeline, 'imported:', count
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
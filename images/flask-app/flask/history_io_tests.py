@@ -0,0 +1,39 @@
+import history_io
+import unittest
+import json
+
+from StringIO import StringIO
+from build_summary import summarize_build
+
+
+class historyIoTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with open('all_builds_test.json') as json_file:
+            builds = json.load(json_file)
+        self.summaries = [summarize_build(builds[k]) for k in sorted(builds)]
+        self.summaries[0] = self.summaries[0]._replace(
+            duration=None, building=True, result=None, description=u'caf\xe9')
+
+    def test_ndjson_round_trip(self):
+        lines = list(history_io.encode_ndjson(self.summaries))
+        assert len(lines) == len(self.summaries)
+        assert list(history_io.decode_ndjson(lines)) == self.summaries
+
+    def test_columnar_round_trip(self):
+        data = history_io.encode_columnar(self.summaries)
+        assert data.startswith(history_io.COLUMNAR_MAGIC)
+        assert history_io.decode_columnar(data) == self.summaries
+
+    def test_read_history_detects_format(self):
+        ndjson = StringIO(''.join(history_io.encode_ndjson(self.summaries)))
+        columnar = StringIO(history_io.encode_columnar(self.summaries))
+        assert list(history_io.read_history(ndjson)) == self.summaries
+        assert list(history_io.read_history(columnar)) == self.summaries
+
+    def test_decode_columnar_rejects_other_files(self):
+        self.assertRaises(ValueError, history_io.decode_columnar, '{"number": 1}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,354 @@
+"""
+A small client for the Jenkins JSON API that keeps a pool of keep-alive
+connections to each Jenkins host and limits how many requests can be in
+flight against a host at once. A circuit breaker per host stops requests
+to a host that keeps failing, so callers fail fast instead of waiting on
+it.
+"""
+# pylint: disable=C0103
+
+import httplib
+import json
+import socket
+import ssl
+import threading
+import time
+import urlparse
+
+import request_timing
+from metrics import registry
+
+# Our Jenkins masters use self-signed certificates, so one unverified
+# context is shared by every connection.
+SSL_CONTEXT = ssl._create_unverified_context()
+
+JENKINS_REQUESTS = registry.counter(
+    'butlercam_jenkins_requests_total',
+    'Requests made to Jenkins, by host and HTTP status.', ('host', 'status'))
+JENKINS_ERRORS = registry.counter(
+    'butlercam_jenkins_errors_total',
+    'Requests to Jenkins that failed to connect, timed out or were refused '
+    'by an open circuit breaker.', ('host', 'error'))
+# Redirects that are followed, as Jenkins answers for a renamed or moved job
+# or behind a proxy that redirects to HTTPS, and how many in a row.
+REDIRECT_STATUSES = (301, 302, 307)
+MAX_REDIRECTS = 3
+
+JENKINS_SECONDS = registry.histogram(
+    'butlercam_jenkins_request_seconds',
+    'Time taken by requests to Jenkins, by host.', ('host',))
+
+
+class JenkinsError(Exception):
+    """
+    Raised when Jenkins answers a request with anything other than 200 (or
+    304 to a conditional request).
+    """
+
+    def __init__(self, url, status):
+        Exception.__init__(self, 'GET %s returned HTTP %s' % (url, status))
+        self.url = url
+        self.status = status
+
+
+class HostUnavailable(JenkinsError):
+    """
+    Raised instead of making a request to a host whose circuit breaker is
+    open.
+    """
+
+    def __init__(self, url):
+        Exception.__init__(self, 'GET %s not sent: host is unavailable' % url)
+        self.url = url
+        self.status = None
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the health of one host. After `failures` requests in a row have
+    failed the breaker opens and requests are refused; `reset_s` seconds
+    later it half-opens and lets a single probe through, which closes it
+    again if it succeeds and reopens it if it fails.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failures=5, reset_s=60, clock=time.time):
+        self.failures = failures
+        self.reset_s = reset_s
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failed_count = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Return whether a request may be made now.
+        """
+
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if self.clock() - self.opened_at < self.reset_s:
+                    return False
+                self.state = self.HALF_OPEN
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def succeeded(self):
+        """
+        Record a request that got an answer from the host.
+        """
+
+        with self.lock:
+            self.state = self.CLOSED
+            self.failed_count = 0
+            self.probing = False
+
+    def failed(self):
+        """
+        Record a request that failed, opening the breaker if there have
+        been too many failures or the probe failed.
+        """
+
+        with self.lock:
+            self.failed_count += 1
+            self.probing = False
+            if self.state == self.HALF_OPEN or self.failed_count >= self.failures:
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+
+class HostPool(object):
+    """
+    The idle keep-alive connections to one Jenkins host, a semaphore that
+    bounds the number of concurrent requests made to it and its circuit
+    breaker. Connecting times out after `connect_timeout` seconds, and
+    each read from an open connection after `timeout` seconds.
+    """
+
+    def __init__(self, scheme, netloc, size, timeout, connect_timeout, breaker):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.breaker = breaker
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.idle = []
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def connect(self):
+        """
+        Open a new connection to the host.
+        """
+
+        if self.scheme == 'https':
+            conn = httplib.HTTPSConnection(self.netloc, timeout=self.connect_timeout,
+                                           context=SSL_CONTEXT)
+        else:
+            conn = httplib.HTTPConnection(self.netloc, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.timeout)
+        return conn
+
+    def checkout(self):
+        """
+        Take an idle connection, or open one. Returns the connection and
+        whether it was reused.
+        """
+
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.connect(), False
+
+    def checkin(self, conn):
+        """
+        Return a connection to the idle list.
+        """
+
+        with self.lock:
+            self.idle.append(conn)
+
+    def request(self, path, headers=None):
+        """
+        GET `path` from the host and return the response and its body. A
+        reused connection that the server has since closed is retried once
+        on a fresh connection. Raises HostUnavailable without sending
+        anything if the host's circuit breaker is open.
+        """
+
+        if not self.breaker.allow():
+            JENKINS_ERRORS.inc(host=self.netloc, error='unavailable')
+            raise HostUnavailable('%s://%s%s' % (self.scheme, self.netloc, path))
+
+        with self.lock:
+            self.requests += 1
+
+        started = time.time()
+        try:
+            response, body = self.send_pooled(path, headers)
+        except Exception as error:
+            self.breaker.failed()
+            JENKINS_ERRORS.inc(host=self.netloc,
+                               error='timeout' if isinstance(error, socket.timeout)
+                               else 'connection')
+            raise
+        finally:
+            elapsed = time.time() - started
+            JENKINS_SECONDS.observe(elapsed, host=self.netloc)
+            request_timing.record('jenkins', elapsed)
+
+        JENKINS_REQUESTS.inc(host=self.netloc, status=response.status)
+        if response.status >= 500:
+            self.breaker.failed()
+        else:
+            self.breaker.succeeded()
+
+        return response, body
+
+    def send_pooled(self, path, headers):
+        """
+        Send one request on a pooled connection and read the whole
+        response.
+        """
+
+        with self.semaphore:
+            conn, reused = self.checkout()
+            try:
+                response, body = self.send(conn, path, headers)
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                conn = self.connect()
+                response, body = self.send(conn, path, headers)
+
+            if response.will_close:
+                conn.close()
+            else:
+                self.checkin(conn)
+
+            return response, body
+
+    @staticmethod
+    def send(conn, path, headers):
+        """
+        Send one request on `conn` and read the whole response.
+        """
+
+        try:
+            conn.request('GET', path, headers=headers or {})
+            response = conn.getresponse()
+            return response, response.read()
+        except Exception:
+            conn.close()
+            raise
+
+
+class JenkinsClient(object):
+    """
+    Fetches JSON from Jenkins through a HostPool per host. `timeout` is
+    the read timeout and `connect_timeout` (by default the same) the
+    connect timeout, in seconds. A host's breaker opens after
+    `breaker_failures` failed requests in a row and probes it again after
+    `breaker_reset_s` seconds.
+    """
+
+    def __init__(self, connections_per_host=4, timeout=30, connect_timeout=None,
+                 breaker_failures=5, breaker_reset_s=60):
+        self.connections_per_host = connections_per_host
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout or timeout
+        self.breaker_failures = breaker_failures
+        self.breaker_reset_s = breaker_reset_s
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def pool_for(self, url):
+        """
+        Return the HostPool for the host of `url`, creating it if needed.
+        """
+
+        parsed = urlparse.urlsplit(url)
+        key = (parsed.scheme, parsed.netloc)
+        with self.lock:
+            if key not in self.pools:
+                breaker = CircuitBreaker(self.breaker_failures, self.breaker_reset_s)
+                self.pools[key] = HostPool(parsed.scheme, parsed.netloc,
+                                           self.connections_per_host,
+                                           self.timeout, self.connect_timeout,
+                                           breaker)
+            return self.pools[key]
+
+    def requests_by_host(self):
+        """
+        Return how many requests have been made to each host, keyed by
+        `host:port` as it appears in URLs.
+        """
+
+        with self.lock:
+            pools = self.pools.values()
+        return dict((pool.netloc, pool.requests) for pool in pools)
+
+    def host_states(self):
+        """
+        Return the state of each host's circuit breaker, keyed like
+        `requests_by_host`.
+        """
+
+        with self.lock:
+            pools = self.pools.values()
+        return dict((pool.netloc, pool.breaker.state) for pool in pools)
+
+    def get_json(self, url):
+        """
+        GET `url` and return the decoded JSON body.
+        """
+
+        body, _ = self.get_json_if_changed(url)
+        return body
+
+    def get_json_if_changed(self, url, validators=None):
+        """
+        GET `url` conditionally on the `etag` and `last_modified` values in
+        `validators`, as returned by an earlier call. Returns the decoded
+        JSON body, or None if Jenkins answered 304 Not Modified, along with
+        the validators of the response. Up to MAX_REDIRECTS redirects are
+        followed.
+        """
+
+        headers = {}
+        validators = validators or {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        for _ in range(MAX_REDIRECTS + 1):
+            parsed = urlparse.urlsplit(url)
+            path = parsed.path or '/'
+            if parsed.query:
+                path += '?' + parsed.query
+
+            response, body = self.pool_for(url).request(path, headers)
+            location = response.getheader('Location')
+            if response.status not in REDIRECT_STATUSES or not location:
+                break
+            url = urlparse.urljoin(url, location)
+
+        if response.status == 304:
+            return None, validators
+        if response.status != 200:
+            raise JenkinsError(url, response.status)
+
+        return json.loads(body), {'etag': response.getheader('ETag'),
+                                  'last_modified': response.getheader('Last-Modified')}
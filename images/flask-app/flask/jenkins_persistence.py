@@ -5,61 +5,1143 @@ stopped holding onto them.
 """
 # pylint: disable=C0103
 
-import urllib2
+import urllib
+import urlparse
+import httplib
 import json
 import os
-import ssl
-from collections import OrderedDict
+import socket
+import time
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict, defaultdict
 from flask import Flask
-from walrus import Database
+from redis.exceptions import WatchError
+from build_cache import BuildCache
+from build_summary import BuildSummary, get_failed_jobs, summarize_build
+from jenkins_client import JenkinsClient, JenkinsError
+from metrics import Counter, Gauge, registry
+from redis_metrics import InstrumentedDatabase
+from status_fanout import CLOSED, StatusFanout
 import default_settings
 
-app = Flask(__name__)
-app.config.from_object(default_settings)
-if 'BUTLERCAM_SETTINGS_FILE' in os.environ:
-    app.config.from_envvar('BUTLERCAM_SETTINGS_FILE')
-PIPELINES = app.config['PIPELINES']
+# The settings and the Redis database, caches and Jenkins client configured
+# from them, all set up by `init_app` so that importing this module neither
+# reads the settings nor creates any clients.
+config = None
+PIPELINES = {}
+db = None
+cache = None
+jenkins = None
+build_cache = None
+status_fanout = None
 
-db = Database(host=app.config['REDIS_HOST'], db=0)
-cache = db.cache(default_timeout=app.config['CACHE_TIMEOUT'])
+BUILDS_INGESTED = registry.counter(
+    'butlercam_builds_ingested_total',
+    'Build summaries saved from Jenkins, by pipeline.', ('pipeline',))
+INGEST_LAG = registry.histogram(
+    'butlercam_ingest_lag_seconds',
+    'Time from a build finishing in Jenkins to its summary being saved, by '
+    'pipeline.', ('pipeline',),
+    buckets=(5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200))
 
-def get_all_builds(pipeline):
+# The pipelines currently being synced by sync_all_builds, so a pipeline
+# that is still syncing from a previous tick isn't started again, and the
+# per-pipeline locks handed out by pipeline_lock.
+_syncing = set()
+_syncing_lock = threading.Lock()
+_pipeline_locks = {}
+
+# The thread pool that sync_all_builds runs syncs on, created on first use
+# so that web processes that never poll don't start its threads.
+_sync_pool = None
+
+# How many build documents to request from Redis in a single HMGET.
+LOAD_CHUNK_SIZE = 500
+
+# How many of the latest saved builds to look through for the last
+# completed build when refreshing the status snapshot.
+STATUS_RECENT_BUILDS = 10
+
+# The integer fields of a pipeline's running statistics.
+STATS_FIELDS = ('passing', 'failing', 'aborted', 'green_s', 'red_s',
+                'earliest', 'last_number', 'last_timestamp')
+
+# How many builds to request from Jenkins in a single page.
+BUILD_PAGE_SIZE = 100
+
+# The Jenkins `tree=` projection used to check whether a job has new builds.
+JOB_CHECK_TREE = 'lastBuild[number]'
+
+# The retention settings that can be overridden per pipeline in
+# PIPELINE_RETENTION.
+RETENTION_FIELDS = ('DOC_RETENTION_BUILDS', 'DOC_RETENTION_DAYS',
+                    'HISTORY_HORIZON_DAYS')
+
+
+def summary_tree(depth):
     """
-    Given the name of a pipeline, the saved builds for that pipeline are
-    retrieved, Jenkins is queried, and the combined results are returned.
+    Return the Jenkins `tree=` projection of the build fields that
+    BuildSummary uses, following sub-builds `depth` levels deep so that
+    failures are traced to the failing leaf job.
     """
 
-    pref_url = PIPELINES[pipeline][1]
-    api_url = pref_url + '/api/json'
-    context = ssl._create_unverified_context()
-    data = urllib2.urlopen(api_url, context=context).read()
-    parsed = json.loads(data)
+    sub_builds = 'subBuilds[jobName,result]'
+    for _ in range(depth - 1):
+        sub_builds = 'subBuilds[jobName,result,build[%s]]' % sub_builds
 
-    builds = get_saved_builds(pipeline)
-    print 'Builds for pipeline', pipeline, 'previously saved:', len(builds)
+    return 'number,result,timestamp,duration,building,description,displayName,' \
+        'actions[causes[shortDescription]],' + sub_builds
+
+
+# The projection of BuildSummary fields, for a single build and for a page
+# of a job's builds, following sub-builds SUBBUILD_DEPTH levels deep; set by
+# `init_app`.
+BUILD_SUMMARY_TREE = None
+SUMMARY_TREE = None
+
+# The prefix of the Redis pub/sub channel that each pipeline's status
+# changes are published on.
+STATUS_CHANNEL = 'status:changes:'
+
+# The Redis list of build notifications waiting to be ingested.
+INGEST_QUEUE = 'ingest:queue'
+
+
+def load_config(app):
+    """
+    Configure `app` from default_settings, overridden by the settings file
+    named in BUTLERCAM_SETTINGS_FILE if it is set. This is the one place
+    the settings are read.
+    """
+
+    app.config.from_object(default_settings)
+    if 'BUTLERCAM_SETTINGS_FILE' in os.environ:
+        app.config.from_envvar('BUTLERCAM_SETTINGS_FILE')
+
+
+def init_app(app):
+    """
+    Set up the Redis database, the caches and the Jenkins client from the
+    config of `app`, which every function in this module then uses.
+    """
+
+    global config, PIPELINES, db, cache, jenkins, build_cache, status_fanout, \
+        BUILD_SUMMARY_TREE, SUMMARY_TREE # pylint: disable=W0603
 
-    for build in parsed['builds']:
-        builds[build['number']] = get_build_info(build['url'])
-    builds = OrderedDict(sorted(builds.iteritems(), key=lambda k: k))
+    config = app.config
+    PIPELINES = config['PIPELINES']
 
-    save_builds(pipeline, builds)
+    db = InstrumentedDatabase(host=config['REDIS_HOST'], port=config['REDIS_PORT'], db=0)
+    cache = db.cache(default_timeout=config['CACHE_TIMEOUT'])
+    status_fanout = StatusFanout(db, STATUS_CHANNEL)
+
+    jenkins = JenkinsClient(connections_per_host=config['JENKINS_CONNECTIONS_PER_HOST'],
+                            timeout=config['JENKINS_TIMEOUT_S'],
+                            connect_timeout=config['JENKINS_CONNECT_TIMEOUT_S'],
+                            breaker_failures=config['JENKINS_BREAKER_FAILURES'],
+                            breaker_reset_s=config['JENKINS_BREAKER_RESET_S'])
+    build_cache = BuildCache(cache, jenkins.get_json, config['BUILD_CACHE_SIZE'],
+                             config['CACHE_TIMEOUT'])
+
+    BUILD_SUMMARY_TREE = summary_tree(config['SUBBUILD_DEPTH'])
+    SUMMARY_TREE = 'allBuilds[' + BUILD_SUMMARY_TREE + ']'
+
+def get_all_builds(pipeline):
+    """
+    Given the name of a pipeline, Jenkins is queried for new builds, the
+    saved builds are brought up to date and the combined results are
+    returned.
+    """
+
+    sync_builds(pipeline)
+    builds = get_saved_builds(pipeline)
     print 'Builds for pipeline', pipeline, 'after updating:', len(builds)
 
     return builds
 
 
+def sync_builds(pipeline):
+    """
+    Given the name of a pipeline, query Jenkins and store summaries of only
+    the builds that are newer than the pipeline's high-water mark or that
+    were still building during the previous sync. Unless a build is still
+    running, Jenkins is first asked for just the job's last build number,
+    conditionally on the validators of the previous check, and nothing
+    more is done if it hasn't moved. All writes are sent to Redis in a
+    single pipelined batch. Returns the number of builds written.
+    """
+
+    high_water, building = get_sync_state(pipeline)
+    saved_validators = db.hgetall(pipeline + ':job_check')
+    validators = saved_validators
+    if not building:
+        last_number, validators = check_job(PIPELINES[pipeline][1], saved_validators)
+        if last_number is None or last_number == high_water:
+            if validators != saved_validators:
+                save_validators(db, pipeline, validators)
+            if not db.exists(pipeline + ':stats'):
+                update_stats(pipeline)
+            return 0
+
+    jenkins_builds, exhausted = fetch_recent_builds(PIPELINES[pipeline][1],
+                                                    min([high_water] + list(building)))
+    new_builds, refreshed_builds, gone = select_builds_to_sync(jenkins_builds,
+                                                               high_water,
+                                                               building,
+                                                               exhausted)
+
+    if not new_builds and not refreshed_builds and not gone:
+        if validators != saved_validators:
+            save_validators(db, pipeline, validators)
+        if not db.exists(pipeline + ':stats'):
+            update_stats(pipeline)
+        return 0
+
+    closed = close_gone_builds(load_builds(pipeline, gone).values())
+
+    pipe = db.pipeline()
+    if validators != saved_validators:
+        save_validators(pipe, pipeline, validators)
+    store_summaries(pipe, pipeline,
+                    [summarize_build(build) for build in new_builds + refreshed_builds] +
+                    closed)
+    if gone:
+        pipe.srem(pipeline + ':building', *gone)
+    if new_builds:
+        pipe.set(pipeline + ':high_water',
+                 max(build['number'] for build in new_builds))
+    pipe.execute()
+    update_stats(pipeline)
+    db.incr(pipeline + ':version')
+    # On the first sync every build is old news, so the lag isn't recorded.
+    record_ingested(pipeline, new_builds + refreshed_builds, lag=high_water > 0)
+
+    print 'Builds for pipeline', pipeline, 'synced:', len(new_builds), \
+        'new,', len(refreshed_builds), 'updated'
+
+    return len(new_builds) + len(refreshed_builds)
+
+
+def close_gone_builds(summaries):
+    """
+    Given the saved summaries of builds that were still building when
+    Jenkins stopped listing them, return them as completed and ABORTED,
+    since they will never finish. Until then the running statistics can't
+    move past them.
+    """
+
+    return [summary._replace(building=False, result=summary.result or 'ABORTED')
+            for summary in summaries if summary.building]
+
+
+def find_notified_pipeline(notification, pipelines):
+    """
+    Given a Jenkins Notification plugin payload and the PIPELINES dict,
+    return the name of the pipeline, the build number and the phase
+    (STARTED, COMPLETED or FINALIZED) it is about, or None if it isn't a
+    build notification for a configured pipeline. The job URL of the
+    build's full URL must equal a pipeline's job URL or, failing that, the
+    job path must be the path of a pipeline's job below the Jenkins root,
+    so that a job in a folder is never taken for the folder.
+    """
+
+    build = notification.get('build') if isinstance(notification, dict) else None
+    if not isinstance(build, dict) or not isinstance(build.get('number'), int):
+        return None
+
+    # The build's URL is its job's URL followed by the build number.
+    build_job_url = normalize_job_url(build.get('full_url') or '').rpartition('/')[0]
+    job_path = urllib.unquote(notification.get('url') or '').strip('/')
+    for name, (_, job_url) in pipelines.iteritems():
+        job_url = normalize_job_url(job_url)
+        path = urlparse.urlsplit(job_url).path
+        root = path[:-len(job_path)] if job_path and path.endswith('/' + job_path) else None
+        if (build_job_url and build_job_url == job_url) or \
+                (root is not None and '/job/' not in root):
+            return name, build['number'], build.get('phase')
+
+    return None
+
+
+def normalize_job_url(url):
+    """
+    Given a Jenkins job or build URL, return it unquoted and without a
+    trailing slash, so that URLs of the same job compare equal.
+    """
+
+    return urllib.unquote(url).rstrip('/')
+
+
+def enqueue_build(pipeline, number, phase):
+    """
+    Given the name of a pipeline, a build number and a notification phase,
+    queue the build to be ingested by the worker.
+    """
+
+    db.lpush(INGEST_QUEUE, json.dumps({'pipeline': pipeline,
+                                       'number': number,
+                                       'phase': phase}))
+
+
+def process_build_queue(timeout):
+    """
+    Wait up to `timeout` seconds for a queued build notification and
+    ingest it, then ingest any others that are already waiting. Returns
+    the names of the pipelines that notifications were processed for.
+    """
+
+    item = db.brpop(INGEST_QUEUE, int(max(timeout, 1)))
+    data = item[1] if item else None
+    processed = []
+    while data is not None:
+        entry = json.loads(data)
+        try:
+            if entry['pipeline'] in PIPELINES:
+                ingest_build(entry['pipeline'], entry['number'])
+        except Exception as error: # pylint: disable=W0703
+            print 'Build', entry['number'], 'for pipeline', entry['pipeline'], \
+                'failed to ingest:', error
+        processed.append(entry['pipeline'])
+        data = db.rpop(INGEST_QUEUE)
+
+    return processed
+
+
+def ingest_build(pipeline, number):
+    """
+    Given the name of a pipeline and the number of a build that Jenkins
+    has told us about, fetch just that build's summary, store it and bring
+    the pipeline's statistics and status up to date. If builds before it
+    are missing, the pipeline is synced in full instead.
+    """
+
+    with pipeline_lock(pipeline):
+        high_water, _ = get_sync_state(pipeline)
+        if number > high_water + 1 or not db.exists(pipeline + ':stats'):
+            sync_builds(pipeline)
+        else:
+            url = '%s/%d/api/json?tree=%s' % (PIPELINES[pipeline][1].rstrip('/'), number,
+                                              urllib.quote(BUILD_SUMMARY_TREE, safe=',[]'))
+            build = jenkins.get_json(url)
+            pipe = db.pipeline()
+            store_summaries(pipe, pipeline, [summarize_build(build)])
+            if number > high_water:
+                pipe.set(pipeline + ':high_water', number)
+            pipe.execute()
+            update_stats(pipeline)
+            db.incr(pipeline + ':version')
+            record_ingested(pipeline, [build])
+
+        refresh_status(pipeline)
+    print 'Build', number, 'for pipeline', pipeline, 'ingested'
+
+
+def record_ingested(pipeline, builds, lag=True, now=None):
+    """
+    Given the name of a pipeline and the Jenkins builds just saved for it,
+    count them in the metrics along with how long after finishing each
+    completed one was saved, unless `lag` is false.
+    """
+
+    if now is None:
+        now = time.time()
+
+    BUILDS_INGESTED.inc(len(builds), pipeline=pipeline)
+    if not lag:
+        return
+
+    for build in builds:
+        if not build.get('building') and build.get('timestamp') and \
+                build.get('duration') is not None:
+            finished = (build['timestamp'] + build['duration']) / 1000.0
+            INGEST_LAG.observe(max(0.0, now - finished), pipeline=pipeline)
+
+
+def collect_client_metrics():
+    """
+    Return metrics read from the build cache behind get_build_info and the
+    Jenkins client's circuit breakers when the metrics are scraped. Each
+    process has its own cache and breakers, so the values are summed over
+    processes; the hit ratio is the share of lookups that aren't misses.
+    """
+
+    stats = build_cache.stats()
+    lookups = Counter('butlercam_build_cache_lookups_total',
+                      'Build document lookups, by whether they were served from '
+                      'the cache, fetched, or shared a fetch in progress.', ('result',))
+    lookups.inc(stats['hits'], result='hit')
+    lookups.inc(stats['misses'], result='miss')
+    lookups.inc(stats['coalesced'], result='coalesced')
+
+    local_size = Gauge('butlercam_build_cache_local_documents',
+                       'Build documents held in process.')
+    local_size.set(stats['local_size'])
+
+    breakers = Gauge('butlercam_jenkins_breaker_state',
+                     'How many processes have the circuit breaker of each Jenkins '
+                     'host in each state.', ('host', 'state'))
+    for host, state in jenkins.host_states().iteritems():
+        for candidate in ('closed', 'open', 'half-open'):
+            breakers.set(int(candidate == state), host=host, state=candidate)
+
+    return [lookups, local_size, breakers]
+
+
+registry.add_collector(collect_client_metrics)
+
+
+def update_stats(pipeline):
+    """
+    Given the name of a pipeline, fold the builds that have completed since
+    the last update into the pipeline's running statistics: result counts,
+    seconds spent green and red, the earliest build and per-job failure
+    counts. Builds are folded in number order, stopping at the first one
+    that is still building. Returns the number of builds folded in.
+
+    Several processes can fold at once (the worker, an embedded poller, a
+    history import), so the stats are WATCHed and the fold is retried if
+    they change before it is written; no build is ever counted twice.
+    """
+
+    with db.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(pipeline + ':stats')
+                stats = get_stats(pipeline, pipe)
+                numbers = [int(n) for n in db.zrangebyscore(pipeline + ':by_number',
+                                                            '(%d' % stats['last_number'],
+                                                            '+inf')]
+                builds = load_builds(pipeline, numbers).values()
+
+                folded, failures = accumulate_stats(stats, pipeline, builds)
+                if not folded:
+                    return 0
+
+                pipe.multi()
+                pipe.hmset(pipeline + ':stats', stats)
+                for job_name, count in failures.iteritems():
+                    pipe.zincrby(pipeline + ':failure_counts', job_name, count)
+                pipe.incr(pipeline + ':version')
+                pipe.execute()
+                return folded
+            except WatchError:
+                continue
+
+
+def accumulate_stats(stats, pipeline, builds):
+    """
+    Given a stats dict (see `get_stats`), the name of its pipeline and a
+    list of build summaries ordered by number, update the stats in place
+    with each completed build, stopping at the first one still building.
+    Time is counted from each build to the next with the result of the
+    earlier build; builds that neither passed nor failed inherit the
+    result before them. Returns how many builds were folded in and a dict
+    of failure counts to add per job.
+    """
+
+    failures = defaultdict(int)
+    folded = 0
+    for build in builds:
+        if build['building']:
+            break
+
+        if build['result'] == 'SUCCESS':
+            stats['passing'] += 1
+        elif build['result'] == 'FAILURE':
+            stats['failing'] += 1
+            for job_name in get_failed_jobs(build) or [pipeline]:
+                failures[job_name] += 1
+        else:
+            stats['aborted'] += 1
+
+        if stats['last_result'] == 'SUCCESS':
+            stats['green_s'] += build['timestamp'] / 1000 - stats['last_timestamp'] / 1000
+        elif stats['last_result'] == 'FAILURE':
+            stats['red_s'] += build['timestamp'] / 1000 - stats['last_timestamp'] / 1000
+
+        if build['result'] in ('SUCCESS', 'FAILURE') or not stats['last_result']:
+            stats['last_result'] = build['result'] or ''
+        if not stats['earliest']:
+            stats['earliest'] = build['timestamp']
+        stats['last_timestamp'] = build['timestamp']
+        stats['last_number'] = build['number']
+        folded += 1
+
+    return folded, failures
+
+
+def get_stats(pipeline, client=None):
+    """
+    Given the name of a pipeline, load its running statistics, through
+    `client` if given (such as a pipeline that is WATCHing them).
+    Timestamps are in milliseconds and green/red time in seconds.
+    """
+
+    if client is None:
+        client = db
+
+    saved = client.hgetall(pipeline + ':stats')
+    stats = {}
+    for field in STATS_FIELDS:
+        stats[field] = int(saved.get(field, 0))
+    stats['last_result'] = saved.get('last_result', '')
+
+    return stats
+
+
+def get_versions(pipelines):
+    """
+    Given a list of pipeline names, return their version counters in a
+    single read. A pipeline's version goes up whenever its builds, stats
+    or status change, so anything rendered from that data can be cached
+    under it.
+    """
+
+    if not pipelines:
+        return []
+
+    return [int(version or 0) for version in
+            db.mget([name + ':version' for name in pipelines])]
+
+
+def get_top_failures(pipeline, since=None, until='+inf'):
+    """
+    Given the name of a pipeline, return the jobs that caused its builds to
+    fail as an ordered list of (failures, job name), most failures first.
+    Without `since` the running all-time counts are used; with it, only
+    builds that started between `since` and `until` (in milliseconds) are
+    counted, from the failure index.
+    """
+
+    if since is None:
+        failures = db.zrevrange(pipeline + ':failure_counts', 0, -1, withscores=True)
+        return [(int(count), name) for name, count in failures]
+
+    numbers = [int(n) for n in db.zrangebyscore(pipeline + ':by_time', since, until)]
+    entries = []
+    for i in range(0, len(numbers), LOAD_CHUNK_SIZE):
+        chunk = numbers[i:i + LOAD_CHUNK_SIZE]
+        entries.extend(json.loads(paths) for paths in
+                       db.hmget(pipeline + ':failure_index', chunk) if paths is not None)
+
+    return count_failures(pipeline, entries)
+
+
+def count_failures(pipeline, entries):
+    """
+    Given the name of a pipeline and the failure paths of each of its
+    failed builds, return the (failures, job name) list of
+    `get_top_failures`. A failed build with no failing job is counted
+    against the pipeline itself.
+    """
+
+    counts = defaultdict(int)
+    for paths in entries:
+        for job_name in [path[-1] for path in paths] or [pipeline]:
+            counts[job_name] += 1
+
+    return sorted([(count, name) for name, count in counts.iteritems()], reverse=True)
+
+
+def get_failure_paths(pipeline, number):
+    """
+    Given the name of a pipeline and a build number, return the paths of
+    job names down to each job that caused the build to fail, or None if
+    the build isn't a saved failure.
+    """
+
+    paths = db.hget(pipeline + ':failure_index', number)
+    return [tuple(path) for path in json.loads(paths)] if paths is not None else None
+
+
+def close_stuck_builds(pipeline):
+    """
+    Given the name of a pipeline, close the builds that are saved as
+    building but are no longer in its set of building builds, because
+    they went away before sync_builds closed gone builds, and bring the
+    statistics past them. Returns the number of builds closed.
+    """
+
+    building = set(int(number) for number in db.smembers(pipeline + ':building'))
+    last_number = get_stats(pipeline)['last_number']
+    numbers = [int(n) for n in db.zrangebyscore(pipeline + ':by_number',
+                                                '(%d' % last_number, '+inf')]
+    stuck = close_gone_builds([build for build in load_builds(pipeline, numbers).values()
+                               if build.number not in building])
+    if stuck:
+        pipe = db.pipeline()
+        store_summaries(pipe, pipeline, stuck)
+        pipe.execute()
+        update_stats(pipeline)
+
+    return len(stuck)
+
+
+def index_failures(pipeline):
+    """
+    Given the name of a pipeline, rebuild its failure index from every
+    saved build summary. Returns the number of failed builds indexed.
+    """
+
+    db.delete(pipeline + ':failure_index')
+    numbers = [int(n) for n in db.zrange(pipeline + ':by_number', 0, -1)]
+    indexed = 0
+    for i in range(0, len(numbers), LOAD_CHUNK_SIZE):
+        pipe = db.pipeline()
+        indexed += index_summaries(pipe, pipeline,
+                                   load_builds(pipeline, numbers[i:i + LOAD_CHUNK_SIZE]).values())
+        pipe.execute()
+
+    return indexed
+
+
+def index_summaries(pipe, pipeline, summaries):
+    """
+    Given a Redis pipeline, the name of a pipeline and a list of
+    BuildSummary records, queue the writes that add the failed builds to
+    the pipeline's failure index. Returns the number of builds indexed.
+    """
+
+    index = {}
+    for summary in summaries:
+        if summary.result == 'FAILURE':
+            index[summary.number] = json.dumps(summary.failure_paths)
+    if index:
+        pipe.hmset(pipeline + ':failure_index', index)
+
+    return len(index)
+
+
+def rebuild_stats(pipeline):
+    """
+    Given the name of a pipeline, throw away its running statistics and
+    recompute them from every saved build.
+    """
+
+    db.delete(pipeline + ':stats', pipeline + ':failure_counts')
+    return update_stats(pipeline)
+
+
+def sync_all_builds(pipelines):
+    """
+    Given a list of pipeline names, run sync_builds for each of them on a
+    long-lived pool of POLL_WORKERS threads, waiting at most
+    PIPELINE_TIMEOUT_S for the whole round. A pipeline that isn't done by
+    then keeps syncing in the background and is skipped until it finishes. Returns a dict of the number of
+    builds written for each pipeline, or None for those that timed out,
+    failed or were skipped.
+    """
+
+    written = dict.fromkeys(pipelines)
+
+    with _syncing_lock:
+        pipelines = [name for name in pipelines if name not in _syncing]
+        _syncing.update(pipelines)
+
+    pool = get_sync_pool()
+    results = {}
+    for name in pipelines:
+        results[name] = pool.apply_async(_sync_pipeline, (name,))
+
+    deadline = time.time() + config['PIPELINE_TIMEOUT_S']
+    for name, result in results.iteritems():
+        try:
+            written[name] = result.get(max(0, deadline - time.time()))
+        except multiprocessing.TimeoutError:
+            print 'Builds for pipeline', name, 'timed out'
+        except Exception as error: # pylint: disable=W0703
+            print 'Builds for pipeline', name, 'failed to sync:', error
+
+    return written
+
+
+def get_sync_pool():
+    """
+    Return the thread pool that pipelines are synced on.
+    """
+
+    global _sync_pool # pylint: disable=W0603
+    with _syncing_lock:
+        if _sync_pool is None:
+            _sync_pool = ThreadPool(config['POLL_WORKERS'])
+        return _sync_pool
+
+
+def _sync_pipeline(pipeline):
+    """
+    Run sync_builds and refresh_status for one pipeline and mark it as no
+    longer syncing. If Jenkins can't be reached, the pipeline's last known
+    status is marked as stale.
+    """
+
+    try:
+        with pipeline_lock(pipeline):
+            written = sync_builds(pipeline)
+            refresh_status(pipeline)
+        return written
+    except (JenkinsError, httplib.HTTPException, socket.error):
+        mark_stale(pipeline)
+        raise
+    finally:
+        with _syncing_lock:
+            _syncing.discard(pipeline)
+
+
+def pipeline_lock(pipeline):
+    """
+    Return the lock that serializes the polling and the ingestion of
+    notifications for a pipeline within this process, so that the
+    running statistics aren't updated twice for the same builds.
+    """
+
+    with _syncing_lock:
+        if pipeline not in _pipeline_locks:
+            _pipeline_locks[pipeline] = threading.Lock()
+        return _pipeline_locks[pipeline]
+
+
+def refresh_status(pipeline):
+    """
+    Given the name of a pipeline, work out its build light from the most
+    recent saved builds and store it in the status snapshot along with the
+    time it was taken. Jenkins is only asked for the last completed build
+    if none of the recent saved builds has completed.
+    """
+
+    recent = get_last_builds(pipeline, STATUS_RECENT_BUILDS).values()
+    if recent:
+        current = recent[-1]
+    else:
+        current = get_latest_build_status(PIPELINES[pipeline][1])
+
+    completed = [build for build in recent if not build['building']]
+    if completed:
+        last_complete = completed[-1]
+    else:
+        last_complete = get_last_complete_status(PIPELINES[pipeline][1])
+
+    status = {
+        'result': current['result'],
+        'building': current['building'],
+        'duration': current['duration'],
+        'last_complete_result': last_complete['result'],
+        'last_complete_duration': last_complete['duration'],
+        'stale': False,
+        'updated': time.time()
+    }
+    previous = db.hget('status:snapshot', pipeline)
+    pipe = db.pipeline()
+    pipe.hset('status:snapshot', pipeline, json.dumps(status))
+    if status_changed(previous, status):
+        pipe.incr(pipeline + ':version')
+        pipe.publish(STATUS_CHANNEL + pipeline,
+                     json.dumps({'pipeline': pipeline, 'status': status}))
+    pipe.execute()
+
+    return status
+
+
+def mark_stale(pipeline):
+    """
+    Given the name of a pipeline whose Jenkins couldn't be reached, mark
+    its entry in the status snapshot as stale, keeping the last known
+    status and the time it was taken. The next successful refresh_status
+    clears the mark.
+    """
+
+    previous = db.hget('status:snapshot', pipeline)
+    if previous is None:
+        return
+
+    status = json.loads(previous)
+    if status.get('stale'):
+        return
+
+    status['stale'] = True
+    pipe = db.pipeline()
+    pipe.hset('status:snapshot', pipeline, json.dumps(status))
+    pipe.incr(pipeline + ':version')
+    pipe.publish(STATUS_CHANNEL + pipeline,
+                 json.dumps({'pipeline': pipeline, 'status': status}))
+    pipe.execute()
+
+
+def status_changed(previous, status):
+    """
+    Given a pipeline's previous snapshot entry (as JSON, or None) and its
+    new status, return whether anything other than the update time has
+    changed.
+    """
+
+    if previous is None:
+        return True
+
+    previous = json.loads(previous)
+    return any(previous.get(field) != value
+               for field, value in status.iteritems() if field != 'updated')
+
+
+def subscribe_status_changes(pipeline=None):
+    """
+    Subscribe to the status changes published by `refresh_status`, for one
+    pipeline or for all of them, and return the subscription for
+    `iter_status_changes`. Subscribing before reading the snapshot means
+    no change in between is missed. Every subscription of a process
+    shares one Redis connection.
+    """
+
+    return status_fanout.subscribe(pipeline)
+
+
+def iter_status_changes(subscription, heartbeat):
+    """
+    Given a subscription from `subscribe_status_changes`, yield each change
+    as a dict with the pipeline's name and its status, or None when
+    `heartbeat` seconds pass without one. Ends if the connection to Redis
+    is lost. The subscription is closed when the generator is.
+    """
+
+    try:
+        while True:
+            change = subscription.get(heartbeat)
+            if change is CLOSED:
+                return
+            yield change
+    finally:
+        subscription.close()
+
+
+def get_status_snapshot(pipelines):
+    """
+    Given a list of pipeline names, load their entries from the status
+    snapshot in a single read. Pipelines that have no entry yet map to
+    None.
+    """
+
+    if not pipelines:
+        return {}
+
+    snapshot = {}
+    for name, status in zip(pipelines, db.hmget('status:snapshot', pipelines)):
+        snapshot[name] = json.loads(status) if status is not None else None
+
+    return snapshot
+
+
+def get_latest_build_status(pipeline_url):
+    """
+    Get the status and result of the latest build.
+    """
+
+    url = pipeline_url + "/lastBuild/api/json?tree=result[*],building[*],duration[*]"
+    return jenkins.get_json(url)
+
+
+def get_last_complete_status(pipeline_url):
+    """
+    Get the result of the latest completed build (inherently it is complete).
+    """
+
+    url = pipeline_url + "/lastCompletedBuild/api/json?tree=result[*],duration[*]"
+    return jenkins.get_json(url)
+
+
+def check_job(job_url, validators=None):
+    """
+    Given the URL of a Jenkins job and the validators saved from the last
+    check (see `JenkinsClient.get_json_if_changed`), ask Jenkins for the
+    number of the job's last build. Returns the number, or None if
+    Jenkins reports that the job hasn't changed, and the validators to
+    save for the next check.
+    """
+
+    url = job_url.rstrip('/') + '/api/json?tree=' + urllib.quote(JOB_CHECK_TREE, safe=',[]')
+    job, validators = jenkins.get_json_if_changed(url, validators)
+    validators = dict((k, v) for k, v in validators.iteritems() if v)
+    if job is None:
+        return None, validators
+
+    last_build = job.get('lastBuild')
+    return (last_build['number'] if last_build else 0), validators
+
+
+def save_validators(pipe, pipeline, validators):
+    """
+    Given a Redis pipeline (or the database), the name of a pipeline and
+    the validators from `check_job`, replace the pipeline's saved ones.
+    """
+
+    pipe.delete(pipeline + ':job_check')
+    if validators:
+        pipe.hmset(pipeline + ':job_check', validators)
+
+
+def fetch_build_summaries(job_url, start, end):
+    """
+    Given the URL of a Jenkins job and a range of positions in its build
+    history (newest first), fetch the summary fields of those builds in a
+    single request using a `tree=` projection.
+    """
+
+    tree = SUMMARY_TREE + '{%d,%d}' % (start, end)
+    api_url = job_url.rstrip('/') + '/api/json?tree=' + urllib.quote(tree, safe=',[]')
+
+    return jenkins.get_json(api_url).get('allBuilds', [])
+
+
+def fetch_recent_builds(job_url, threshold):
+    """
+    Given the URL of a Jenkins job and a build number, page through the
+    job's build summaries until a build at or below that number is seen.
+    Returns the builds and whether the whole history was read.
+    """
+
+    builds = []
+    start = 0
+    while True:
+        page = fetch_build_summaries(job_url, start, start + BUILD_PAGE_SIZE)
+        builds.extend(page)
+        if len(page) < BUILD_PAGE_SIZE:
+            return builds, True
+        if page[-1]['number'] <= threshold:
+            return builds, False
+        start += BUILD_PAGE_SIZE
+
+
+def select_builds_to_sync(jenkins_builds, high_water, building, exhausted=True):
+    """
+    Given build summaries from a Jenkins job (newest first), the pipeline's
+    high-water build number and the numbers of saved builds that were still
+    building, return the new builds, the builds to refresh, and the numbers
+    of building builds that Jenkins no longer knows about. Unless the whole
+    history was listed, only numbers newer than the oldest listed build
+    can be known to be gone.
+    """
+
+    new_builds = []
+    refreshed_builds = []
+    listed = set()
+    for build in jenkins_builds:
+        listed.add(build['number'])
+        if build['number'] > high_water:
+            new_builds.append(build)
+        elif build['number'] in building:
+            refreshed_builds.append(build)
+
+    oldest = min(listed) if listed else 0
+    gone = [number for number in building
+            if number not in listed and (exhausted or number > oldest)]
+
+    return new_builds, refreshed_builds, gone
+
+
+def get_sync_state(pipeline):
+    """
+    Given the name of a pipeline, return its high-water build number and
+    the set of saved build numbers that were still building. Pipelines
+    saved in the old array format are migrated first.
+    """
+
+    high_water = db.get(pipeline + ':high_water')
+    if high_water is None:
+        migrate_array_builds(pipeline)
+        high_water = db.get(pipeline + ':high_water') or 0
+    elif db.hlen(pipeline + ':summaries') < db.zcard(pipeline + ':by_number'):
+        backfill_summaries(pipeline)
+
+    building = set(int(number) for number in db.smembers(pipeline + ':building'))
+
+    return int(high_water), building
+
+
+def store_builds(pipe, pipeline, builds):
+    """
+    Given a Redis pipeline, the name of a pipeline and a list of full build
+    documents, queue the writes that save each document along with its
+    summary.
+    """
+
+    if not builds:
+        return
+
+    docs = {}
+    for build in builds:
+        docs[build['number']] = json.dumps(build)
+
+    pipe.hmset(pipeline + ':build_docs', docs)
+    store_summaries(pipe, pipeline, [summarize_build(build) for build in builds])
+
+
+def store_summaries(pipe, pipeline, summaries):
+    """
+    Given a Redis pipeline, the name of a pipeline and a list of
+    BuildSummary records, queue the writes that save each summary, index
+    it by build number and timestamp and record the paths to the jobs
+    that failed it.
+    """
+
+    if not summaries:
+        return
+
+    # walrus uses the legacy redis-py client, so ZADD takes member, score
+    # pairs.
+    serialized = {}
+    by_number = []
+    by_time = []
+    for summary in summaries:
+        serialized[summary.number] = summary.to_json()
+        by_number.extend([summary.number, summary.number])
+        by_time.extend([summary.number, summary.timestamp])
+        if summary.building:
+            pipe.sadd(pipeline + ':building', summary.number)
+        else:
+            pipe.srem(pipeline + ':building', summary.number)
+
+    pipe.hmset(pipeline + ':summaries', serialized)
+    pipe.zadd(pipeline + ':by_number', *by_number)
+    pipe.zadd(pipeline + ':by_time', *by_time)
+    index_summaries(pipe, pipeline, summaries)
+
+
+def load_builds(pipeline, numbers):
+    """
+    Given the name of a pipeline and a list of build numbers, load the
+    summaries of those builds from Redis in chunks and return them in an
+    OrderedDict keyed by build number, preserving the order of the given
+    numbers.
+    """
+
+    builds = OrderedDict()
+    for i in range(0, len(numbers), LOAD_CHUNK_SIZE):
+        chunk = numbers[i:i + LOAD_CHUNK_SIZE]
+        summaries = db.hmget(pipeline + ':summaries', chunk)
+        for summary in summaries:
+            if summary is not None:
+                build = BuildSummary.from_json(summary)
+                builds[build.number] = build
+
+    return builds
+
+
+def get_build_document(pipeline, number):
+    """
+    Given the name of a pipeline and a build number, return the full
+    Jenkins document for that build, asking Jenkins only if it has not
+    been saved. Nothing else about the pipeline is read or synced. If
+    Jenkins no longer has the build, or can't be reached, the build's
+    saved BuildSummary is returned instead, or None if there is none.
+    Returns the build and whether it is stale, that is whether Jenkins
+    couldn't be reached and may have more up to date data.
+    """
+
+    doc = db.hget(pipeline + ':build_docs', number)
+    if doc is not None:
+        return json.loads(doc), False
+
+    try:
+        build = get_build_info(PIPELINES[pipeline][1].rstrip('/') + '/' + str(number) + '/')
+    except (JenkinsError, httplib.HTTPException, socket.error) as error:
+        print 'Build', number, 'for pipeline', pipeline, 'not fetched:', error
+        stale = not isinstance(error, JenkinsError) or error.status != 404
+        return load_builds(pipeline, [number]).get(number), stale
+
+    if not build['building']:
+        db.hset(pipeline + ':build_docs', number, json.dumps(build))
+
+    return build, False
+
+
 def get_saved_builds(pipeline):
     """
-    Given the name of a pipeline, load the saved builds from the local
-    Redis database.
+    Given the name of a pipeline, load the summaries of all of the saved
+    builds from the local Redis database, ordered by build number.
     """
 
-    redis_builds = db.Array(pipeline + ':builds')
-    saved_builds = OrderedDict()
-    for i in range(0, len(redis_builds)):
-        curr_build = json.loads(redis_builds[i])
-        saved_builds[curr_build['number']] = curr_build
-    return saved_builds
+    numbers = [int(n) for n in db.zrange(pipeline + ':by_number', 0, -1)]
+    return load_builds(pipeline, numbers)
+
+
+def get_last_builds(pipeline, count):
+    """
+    Given the name of a pipeline, load the summaries of the `count` most
+    recent saved builds, ordered by build number.
+    """
+
+    numbers = [int(n) for n in db.zrange(pipeline + ':by_number', -count, -1)]
+    return load_builds(pipeline, numbers)
+
+
+def get_builds_between(pipeline, start, end):
+    """
+    Given the name of a pipeline and two timestamps in milliseconds, load
+    the summaries of the saved builds that started between them, ordered
+    by timestamp.
+    """
+
+    numbers = [int(n) for n in db.zrangebyscore(pipeline + ':by_time', start, end)]
+    return load_builds(pipeline, numbers)
+
+
+def get_build_before(pipeline, timestamp):
+    """
+    Given the name of a pipeline and a timestamp in milliseconds, load the
+    summary of the last saved build that started before it, keyed by
+    number like `get_builds_between`; empty if there is none.
+    """
+
+    numbers = [int(n) for n in db.zrevrangebyscore(pipeline + ':by_time', '(%d' % timestamp,
+                                                    '-inf', start=0, num=1)]
+    return load_builds(pipeline, numbers)
+
+
+def iter_builds(pipeline, since='-inf', until='+inf', limit=None):
+    """
+    Given the name of a pipeline, yield the summaries of its saved builds in
+    build number order, reading LOAD_CHUNK_SIZE builds from Redis at a
+    time. Only builds that started between `since` and `until` (timestamps
+    in milliseconds) are yielded, and with `limit` only the most recent
+    `limit` of those, so none if it is 0 or less.
+    """
+
+    if limit is not None and limit <= 0:
+        return
+
+    first = db.zrangebyscore(pipeline + ':by_time', since, until, start=0, num=1)
+    last = db.zrevrangebyscore(pipeline + ':by_time', until, since, start=0, num=1)
+    if not first or not last:
+        return
+
+    lowest, highest = int(first[0]), int(last[0])
+    if limit is not None:
+        oldest = db.zrevrangebyscore(pipeline + ':by_time', until, since,
+                                     start=limit - 1, num=1)
+        if oldest:
+            lowest = max(lowest, int(oldest[0]))
+
+    cursor = lowest
+    while True:
+        numbers = [int(n) for n in db.zrangebyscore(pipeline + ':by_number',
+                                                    cursor, highest,
+                                                    start=0, num=LOAD_CHUNK_SIZE)]
+        if not numbers:
+            return
+
+        for build in load_builds(pipeline, numbers).itervalues():
+            if _in_range(build['timestamp'], since, until):
+                yield build
+
+        cursor = '(%d' % numbers[-1]
+
+
+def _in_range(timestamp, since, until):
+    """
+    Whether a timestamp lies between two Redis score bounds.
+    """
+
+    return (since == '-inf' or timestamp >= since) and \
+        (until == '+inf' or timestamp <= until)
 
 
 def save_builds(pipeline, builds):
@@ -69,10 +1151,12 @@ def save_builds(pipeline, builds):
     builds in their place.
     """
 
-    redis_builds = db.Array(pipeline + ':builds')
     clear_saved_builds(pipeline)
-    for key in builds:
-        redis_builds.append(json.dumps(builds[key]))
+    pipe = db.pipeline()
+    store_builds(pipe, pipeline, builds.values())
+    if builds:
+        pipe.set(pipeline + ':high_water', max(builds.keys()))
+    pipe.execute()
 
 
 def clear_saved_builds(pipeline):
@@ -81,26 +1165,197 @@ def clear_saved_builds(pipeline):
     for that pipeline.
     """
 
+    db.delete(pipeline + ':build_docs',
+              pipeline + ':summaries',
+              pipeline + ':stats',
+              pipeline + ':failure_counts',
+              pipeline + ':by_number',
+              pipeline + ':by_time',
+              pipeline + ':high_water',
+              pipeline + ':building',
+              pipeline + ':job_check',
+              pipeline + ':failure_index')
+    db.incr(pipeline + ':version')
+
+
+def migrate_array_builds(pipeline):
+    """
+    Given the name of a pipeline, move builds saved in the old
+    `<pipeline>:builds` array into the per-build hash and sorted sets,
+    then remove the array. Returns the number of builds migrated.
+    """
+
     redis_builds = db.Array(pipeline + ':builds')
-    while len(redis_builds) > 0:
-        redis_builds.pop()
+    builds = OrderedDict()
+    for i in range(0, len(redis_builds)):
+        curr_build = json.loads(redis_builds[i])
+        builds[curr_build['number']] = curr_build
+
+    pipe = db.pipeline()
+    store_builds(pipe, pipeline, builds.values())
+    pipe.set(pipeline + ':high_water', max(builds.keys()) if builds else 0)
+    pipe.delete(pipeline + ':builds')
+    pipe.execute()
+
+    print 'Builds for pipeline', pipeline, 'migrated:', len(builds)
+
+    return len(builds)
 
 
 def get_build_info(build_url):
     """
-    Given the base URL of a build, query Jenkins to get more detailed
-    data about that build.
+    Given the URL of a build, with or without a trailing slash, return its
+    Jenkins document through the shared build cache.
+    """
+
+    return build_cache.get(build_url.rstrip('/') + '/api/json')
+
+
+def backfill_summaries(pipeline):
+    """
+    Given the name of a pipeline, extract a summary for every saved build
+    document that does not have one yet. Returns the number of summaries
+    written.
+    """
+
+    numbers = [int(n) for n in db.zrange(pipeline + ':by_number', 0, -1)]
+    missing = set(numbers) - set(int(n) for n in db.hkeys(pipeline + ':summaries'))
+    missing = sorted(missing)
+
+    for i in range(0, len(missing), LOAD_CHUNK_SIZE):
+        chunk = missing[i:i + LOAD_CHUNK_SIZE]
+        summaries = {}
+        for doc in db.hmget(pipeline + ':build_docs', chunk):
+            if doc is not None:
+                summary = summarize_build(json.loads(doc))
+                summaries[summary.number] = summary
+        if summaries:
+            pipe = db.pipeline()
+            pipe.hmset(pipeline + ':summaries',
+                       dict((n, summary.to_json()) for n, summary in summaries.iteritems()))
+            index_summaries(pipe, pipeline, summaries.values())
+            pipe.execute()
+
+    return len(missing)
+
+
+def get_retention(pipeline):
+    """
+    Given the name of a pipeline, return its retention settings: the
+    defaults from the config with any PIPELINE_RETENTION overrides.
+    """
+
+    retention = dict((field, config[field]) for field in RETENTION_FIELDS)
+    retention.update(config['PIPELINE_RETENTION'].get(pipeline, {}))
+    return retention
+
+
+def select_expired(builds, retention, now=None):
+    """
+    Given a list of (build number, timestamp in ms) pairs ordered by
+    number, retention settings (see `get_retention`) and the current time
+    in seconds, return the build numbers whose full documents should be
+    dropped and the build numbers that are past the history horizon and
+    should be dropped completely. The horizon applies to every build, and
+    a horizon of 0 keeps history forever. Of the builds left, full
+    documents are kept for the last DOC_RETENTION_BUILDS builds and for
+    builds from the last DOC_RETENTION_DAYS days.
+    """
+
+    if now is None:
+        now = time.time()
+
+    doc_cutoff = (now - retention['DOC_RETENTION_DAYS'] * 86400) * 1000
+    horizon = retention['HISTORY_HORIZON_DAYS']
+    horizon_cutoff = (now - horizon * 86400) * 1000 if horizon else None
+
+    keep_docs_from = len(builds) - retention['DOC_RETENTION_BUILDS']
+    strip_docs = []
+    drop = []
+    for index, (number, timestamp) in enumerate(builds):
+        if horizon_cutoff is not None and timestamp < horizon_cutoff:
+            drop.append(number)
+        elif index < keep_docs_from and timestamp < doc_cutoff:
+            strip_docs.append(number)
+
+    return strip_docs, drop
+
+
+def compact_pipeline(pipeline, now=None):
+    """
+    Given the name of a pipeline, apply its retention settings: drop the
+    full documents of old builds, keeping their summaries, and drop builds
+    past the history horizon completely. Returns the number of bytes of
+    stored values reclaimed.
+    """
+
+    retention = get_retention(pipeline)
+    builds = [(int(number), int(timestamp)) for number, timestamp in
+              db.zrange(pipeline + ':by_time', 0, -1, withscores=True)]
+    builds.sort()
+    strip_docs, drop = select_expired(builds, retention, now)
+
+    # Builds whose documents were stripped before are selected again, so
+    # only the documents actually deleted are counted.
+    reclaimed = 0
+    stripped = 0
+    for i in range(0, len(strip_docs), LOAD_CHUNK_SIZE):
+        chunk = strip_docs[i:i + LOAD_CHUNK_SIZE]
+        reclaimed += _stored_size(pipeline + ':build_docs', chunk)
+        stripped += db.hdel(pipeline + ':build_docs', *chunk)
+
+    for i in range(0, len(drop), LOAD_CHUNK_SIZE):
+        chunk = drop[i:i + LOAD_CHUNK_SIZE]
+        reclaimed += _stored_size(pipeline + ':build_docs', chunk)
+        reclaimed += _stored_size(pipeline + ':summaries', chunk)
+        pipe = db.pipeline()
+        pipe.hdel(pipeline + ':build_docs', *chunk)
+        pipe.hdel(pipeline + ':summaries', *chunk)
+        pipe.hdel(pipeline + ':failure_index', *chunk)
+        pipe.zrem(pipeline + ':by_number', *chunk)
+        pipe.zrem(pipeline + ':by_time', *chunk)
+        pipe.srem(pipeline + ':building', *chunk)
+        pipe.incr(pipeline + ':version')
+        pipe.execute()
+
+    print 'Builds for pipeline', pipeline, 'compacted:', stripped, \
+        'documents and', len(drop), 'builds dropped,', reclaimed, 'bytes reclaimed'
+
+    return reclaimed
+
+
+def _stored_size(key, fields):
+    """
+    Return the total length of the values of `fields` in the hash `key`.
+    """
+
+    return sum(len(value) for value in db.hmget(key, fields) if value is not None)
+
+
+def compact_all(pipelines):
+    """
+    Given a list of pipeline names, compact each of them and return the
+    total number of bytes reclaimed.
     """
 
-    url = build_url + 'api/json'
-    if cache.get(url):
-        return cache.get(url)
+    reclaimed = 0
+    for name in pipelines:
+        try:
+            reclaimed += compact_pipeline(name)
+        except Exception as error: # pylint: disable=W0703
+            print 'Builds for pipeline', name, 'failed to compact:', error
 
-    context = ssl._create_unverified_context()
-    data = urllib2.urlopen(url, context=context).read()
-    parsed = json.loads(data)
+    return reclaimed
 
-    if not parsed['building']:
-        cache.set(url, parsed, 0)
 
-    return parsed
+if __name__ == '__main__':
+    maintenance_app = Flask(__name__)
+    load_config(maintenance_app)
+    init_app(maintenance_app)
+    for name in PIPELINES.keys():
+        if db.exists(name + ':builds'):
+            migrate_array_builds(name)
+        backfill_summaries(name)
+        close_stuck_builds(name)
+        index_failures(name)
+        compact_pipeline(name)
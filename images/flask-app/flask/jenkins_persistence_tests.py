@@ -0,0 +1,418 @@
+import jenkins_client
+import jenkins_persistence
+import unittest
+import json
+import socket
+import sys
+import time
+
+from StringIO import StringIO
+from flask import Flask
+
+from build_summary import summarize_build
+
+from jenkins_client import CircuitBreaker, HostUnavailable, JenkinsClient, JenkinsError
+from jenkins_stub import StubJenkins
+from redis_stub import StubRedis
+
+
+class jenkinsPersistenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        app = Flask(__name__)
+        jenkins_persistence.load_config(app)
+        jenkins_persistence.init_app(app)
+        with open('all_builds_test.json') as json_file:
+            temp_builds = json.load(json_file)
+        self.test_builds = {}
+        for k, build in temp_builds.iteritems():
+            self.test_builds[int(k)] = build
+        self.jenkins = StubJenkins(self.test_builds).start()
+        self.jenkins_builds = [
+            {'number': 215},
+            {'number': 214},
+            {'number': 213}
+        ]
+
+    def tearDown(self):
+        self.jenkins.stop()
+
+    def test_select_builds_to_sync_new(self):
+        new_builds, refreshed_builds, gone = jenkins_persistence.select_builds_to_sync(
+            self.jenkins_builds, 213, set())
+        assert [b['number'] for b in new_builds] == [215, 214]
+        assert refreshed_builds == []
+        assert gone == []
+
+    def test_select_builds_to_sync_building(self):
+        new_builds, refreshed_builds, gone = jenkins_persistence.select_builds_to_sync(
+            self.jenkins_builds, 215, set([214, 200]))
+        assert new_builds == []
+        assert [b['number'] for b in refreshed_builds] == [214]
+        assert gone == [200]
+
+    def test_sync_build_gone_while_building(self):
+        summaries = [summarize_build(self.test_builds[n]) for n in sorted(self.test_builds)]
+        summaries[1] = summaries[1]._replace(building=True, result=None)
+        listing = [{'number': 215}, {'number': 213}]
+        _, _, gone = jenkins_persistence.select_builds_to_sync(listing, 215, set([214]))
+        assert gone == [214]
+
+        closed = jenkins_persistence.close_gone_builds([summaries[1]])
+        assert [(b.number, b.building, b.result) for b in closed] == [(214, False, 'ABORTED')]
+        summaries[1] = closed[0]
+
+        stats = dict.fromkeys(jenkins_persistence.STATS_FIELDS, 0)
+        stats['last_result'] = ''
+        folded, _ = jenkins_persistence.accumulate_stats(stats, 'churro', summaries)
+        assert folded == 3
+        assert stats['last_number'] == 215
+        assert stats['aborted'] == 1
+
+    def test_select_builds_to_sync_partial_listing(self):
+        _, _, gone = jenkins_persistence.select_builds_to_sync(
+            self.jenkins_builds, 215, set([200]), exhausted=False)
+        assert gone == []
+
+    def test_accumulate_stats(self):
+        stats = dict.fromkeys(jenkins_persistence.STATS_FIELDS, 0)
+        stats['last_result'] = ''
+        summaries = [summarize_build(self.test_builds[n]) for n in sorted(self.test_builds)]
+        folded, failures = jenkins_persistence.accumulate_stats(stats, 'churro', summaries)
+        assert folded == 3
+        assert (stats['passing'], stats['failing'], stats['aborted']) == (1, 2, 0)
+        assert stats['green_s'] == 2195
+        assert stats['red_s'] == 1860
+        assert stats['earliest'] == self.test_builds[213]['timestamp']
+        assert stats['last_number'] == 215
+        assert dict(failures) == {'job1': 1, 'job3': 1}
+
+    def test_accumulate_stats_stops_at_building(self):
+        stats = dict.fromkeys(jenkins_persistence.STATS_FIELDS, 0)
+        stats['last_result'] = ''
+        summaries = [summarize_build(self.test_builds[n]) for n in sorted(self.test_builds)]
+        summaries[1] = summaries[1]._replace(building=True, result=None)
+        folded, _ = jenkins_persistence.accumulate_stats(stats, 'churro', summaries)
+        assert folded == 1
+        assert stats['last_number'] == 213
+
+    def test_sync_all_builds_round_deadline(self):
+        def slow_sync(name):
+            try:
+                time.sleep(0.5)
+                return 1
+            finally:
+                with jenkins_persistence._syncing_lock:
+                    jenkins_persistence._syncing.discard(name)
+
+        sync_pipeline = jenkins_persistence._sync_pipeline
+        timeout = jenkins_persistence.config['PIPELINE_TIMEOUT_S']
+        jenkins_persistence._sync_pipeline = slow_sync
+        jenkins_persistence.config['PIPELINE_TIMEOUT_S'] = 0.2
+        try:
+            started = time.time()
+            written = jenkins_persistence.sync_all_builds(['a', 'b', 'c'])
+            elapsed = time.time() - started
+        finally:
+            jenkins_persistence._sync_pipeline = sync_pipeline
+            jenkins_persistence.config['PIPELINE_TIMEOUT_S'] = timeout
+        assert written == {'a': None, 'b': None, 'c': None}
+        assert elapsed < 0.4
+        assert jenkins_persistence.get_sync_pool() is jenkins_persistence.get_sync_pool()
+        time.sleep(0.5)
+
+    def test_migrate_array_builds(self):
+        db = jenkins_persistence.db = StubRedis()
+        db.Array('churro:builds').extend(
+            [json.dumps(self.test_builds[n]) for n in sorted(self.test_builds)])
+
+        high_water, building = jenkins_persistence.get_sync_state('churro')
+        assert (high_water, building) == (215, set())
+        assert not db.exists('churro:builds')
+        assert int(db.get('churro:high_water')) == 215
+        assert sorted(int(n) for n in db.hkeys('churro:summaries')) == [213, 214, 215]
+        assert json.loads(db.hget('churro:build_docs', 214)) == self.test_builds[214]
+        assert db.zrange('churro:by_number', 0, -1) == ['213', '214', '215']
+        assert jenkins_persistence.load_builds('churro', [215])[215] == \
+            summarize_build(self.test_builds[215])
+
+        assert jenkins_persistence.update_stats('churro') == 3
+        stats = jenkins_persistence.get_stats('churro')
+        assert (stats['passing'], stats['failing'], stats['aborted']) == (1, 2, 0)
+        assert (stats['red_s'], stats['green_s']) == (1860, 2195)
+        assert stats['earliest'] == self.test_builds[213]['timestamp']
+        assert stats['last_number'] == 215
+        assert stats['last_result'] == 'FAILURE'
+        assert db.zrange('churro:failure_counts', 0, -1, withscores=True) == \
+            [('job1', 1.0), ('job3', 1.0)]
+
+    def store_summaries(self, numbers):
+        pipe = jenkins_persistence.db.pipeline()
+        jenkins_persistence.store_summaries(
+            pipe, 'churro', [summarize_build(self.test_builds[n]) for n in numbers])
+        pipe.execute()
+
+    def test_update_stats_in_batches(self):
+        db = jenkins_persistence.db = StubRedis()
+        self.store_summaries([213, 214])
+        assert jenkins_persistence.update_stats('churro') == 2
+        self.store_summaries([215])
+        assert jenkins_persistence.update_stats('churro') == 1
+        assert jenkins_persistence.update_stats('churro') == 0
+        stats = jenkins_persistence.get_stats('churro')
+        failure_counts = db.zrange('churro:failure_counts', 0, -1, withscores=True)
+
+        assert jenkins_persistence.rebuild_stats('churro') == 3
+        assert jenkins_persistence.get_stats('churro') == stats
+        assert db.zrange('churro:failure_counts', 0, -1, withscores=True) == \
+            failure_counts
+
+    def test_update_stats_retries_on_conflict(self):
+        db = jenkins_persistence.db = StubRedis()
+        self.store_summaries([213, 214, 215])
+        # Another process folds the same builds between this one's read and
+        # write, so the write must be retried and must not count them again.
+        db.before_exec = lambda: jenkins_persistence.update_stats('churro')
+        assert jenkins_persistence.update_stats('churro') == 0
+        assert db.before_exec is None
+        stats = jenkins_persistence.get_stats('churro')
+        assert (stats['passing'], stats['failing'], stats['last_number']) == (1, 2, 215)
+        assert int(db.get('churro:version')) == 1
+
+    def test_compact_pipeline_counts_deleted_documents(self):
+        db = jenkins_persistence.db = StubRedis()
+        pipe = db.pipeline()
+        jenkins_persistence.store_builds(pipe, 'churro', self.test_builds.values())
+        pipe.execute()
+        jenkins_persistence.config['PIPELINE_RETENTION'] = {
+            'churro': {'DOC_RETENTION_BUILDS': 1, 'DOC_RETENTION_DAYS': 1,
+                       'HISTORY_HORIZON_DAYS': 0}}
+        now = self.test_builds[215]['timestamp'] / 1000 + 7 * 86400
+        output = StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            assert jenkins_persistence.compact_pipeline('churro', now) > 0
+            assert jenkins_persistence.compact_pipeline('churro', now) == 0
+        finally:
+            sys.stdout = stdout
+        assert db.hkeys('churro:build_docs') == ['215']
+        assert db.hlen('churro:summaries') == 3
+        lines = output.getvalue().splitlines()
+        assert lines[0].startswith('Builds for pipeline churro compacted: 2 documents')
+        assert lines[1].startswith('Builds for pipeline churro compacted: 0 documents')
+
+    def test_select_expired(self):
+        day_ms = 86400 * 1000
+        now = 100 * 86400
+        builds = [(1, 5 * day_ms), (2, 50 * day_ms), (3, 60 * day_ms),
+                  (4, 90 * day_ms), (5, 95 * day_ms), (6, 99 * day_ms)]
+        retention = {'DOC_RETENTION_BUILDS': 2, 'DOC_RETENTION_DAYS': 20,
+                     'HISTORY_HORIZON_DAYS': 60}
+        strip_docs, drop = jenkins_persistence.select_expired(builds, retention, now)
+        assert strip_docs == [2, 3]
+        assert drop == [1]
+
+    def test_select_expired_keeps_last_builds_and_forever(self):
+        builds = [(1, 0), (2, 1000)]
+        retention = {'DOC_RETENTION_BUILDS': 5, 'DOC_RETENTION_DAYS': 0,
+                     'HISTORY_HORIZON_DAYS': 0}
+        assert jenkins_persistence.select_expired(builds, retention, 10 ** 9) == ([], [])
+
+    def test_select_expired_horizon_applies_to_last_builds(self):
+        day_ms = 86400 * 1000
+        builds = [(1, 10 * day_ms), (2, 50 * day_ms), (3, 95 * day_ms)]
+        retention = {'DOC_RETENTION_BUILDS': 5, 'DOC_RETENTION_DAYS': 0,
+                     'HISTORY_HORIZON_DAYS': 60}
+        strip_docs, drop = jenkins_persistence.select_expired(builds, retention, 100 * 86400)
+        assert strip_docs == []
+        assert drop == [1]
+
+    def test_iter_builds_no_limit(self):
+        # Nothing is read from Redis, which isn't running here.
+        assert list(jenkins_persistence.iter_builds('churro', limit=0)) == []
+        assert list(jenkins_persistence.iter_builds('churro', limit=-1)) == []
+
+    def test_record_ingested(self):
+        lag = jenkins_persistence.INGEST_LAG
+        builds = [{'number': 1, 'building': False, 'timestamp': 10000, 'duration': 5000},
+                  {'number': 2, 'building': True, 'timestamp': 20000, 'duration': 0}]
+        jenkins_persistence.record_ingested('metrics-test', builds, now=45)
+        assert jenkins_persistence.BUILDS_INGESTED.values[('metrics-test',)] == 2
+        assert lag.values[('metrics-test',)][-1] == 30
+        jenkins_persistence.record_ingested('metrics-test', builds[:1], lag=False, now=45)
+        assert lag.values[('metrics-test',)][-1] == 30
+
+    def test_status_changed(self):
+        status = {'result': 'SUCCESS', 'building': False, 'updated': 2}
+        assert jenkins_persistence.status_changed(None, status)
+        assert not jenkins_persistence.status_changed(
+            json.dumps(dict(status, updated=1)), status)
+        assert jenkins_persistence.status_changed(
+            json.dumps(dict(status, building=True)), status)
+
+    def test_find_notified_pipeline(self):
+        pipelines = {'churro': ('jenkins1', self.jenkins.job_url + '/'),
+                     'other': ('jenkins2', 'http://jenkins2/job/other')}
+        notification = {'name': 'churro', 'url': 'job/churro/',
+                        'build': {'full_url': self.jenkins.job_url + '/216/',
+                                  'number': 216, 'phase': 'COMPLETED'}}
+        assert jenkins_persistence.find_notified_pipeline(notification, pipelines) == \
+            ('churro', 216, 'COMPLETED')
+        del notification['build']['full_url']
+        notification['url'] = 'job/other/'
+        assert jenkins_persistence.find_notified_pipeline(notification, pipelines) == \
+            ('other', 216, 'COMPLETED')
+
+    def test_find_notified_pipeline_in_folder(self):
+        pipelines = {'folder': ('jenkins1', 'http://jenkins1/job/a/'),
+                     'b': ('jenkins1', 'http://jenkins1/jenkins/job/b')}
+        notification = {'url': 'job/a/job/b/',
+                        'build': {'full_url': 'http://jenkins1/job/a/job/b/7/',
+                                  'number': 7, 'phase': 'STARTED'}}
+        assert jenkins_persistence.find_notified_pipeline(notification, pipelines) is None
+        del notification['build']['full_url']
+        assert jenkins_persistence.find_notified_pipeline(notification, pipelines) is None
+        notification['url'] = 'job/b/'
+        assert jenkins_persistence.find_notified_pipeline(notification, pipelines) == \
+            ('b', 7, 'STARTED')
+        notification['build']['full_url'] = 'http://jenkins1/job/a/7/'
+        assert jenkins_persistence.find_notified_pipeline(notification, pipelines)[0] == \
+            'folder'
+
+    def test_find_notified_pipeline_unknown(self):
+        pipelines = {'churro': ('jenkins1', self.jenkins.job_url)}
+        notification = {'url': 'job/elsewhere/',
+                        'build': {'full_url': 'http://jenkins9/job/elsewhere/1/',
+                                  'number': 1}}
+        assert jenkins_persistence.find_notified_pipeline(notification, pipelines) is None
+        assert jenkins_persistence.find_notified_pipeline({'build': {}}, pipelines) is None
+        assert jenkins_persistence.find_notified_pipeline([], pipelines) is None
+
+    def test_summary_tree(self):
+        assert jenkins_persistence.summary_tree(1).endswith(
+            'actions[causes[shortDescription]],subBuilds[jobName,result]')
+        tree = jenkins_persistence.summary_tree(5)
+        assert tree.count('subBuilds[') == 5
+        assert tree.endswith('subBuilds[jobName,result]' + ']]' * 4)
+
+    def test_count_failures(self):
+        entries = [[['phase1', 'lint']], [['lint'], ['deploy']], []]
+        assert jenkins_persistence.count_failures('churro', entries) == \
+            [(2, 'lint'), (1, 'deploy'), (1, 'churro')]
+
+    def test_fetch_build_summaries(self):
+        builds = jenkins_persistence.fetch_build_summaries(self.jenkins.job_url, 0, 2)
+        assert [b['number'] for b in builds] == [215, 214]
+        assert len(self.jenkins.requests) == 1
+        assert 'tree=allBuilds[' in self.jenkins.requests[0]
+
+    def test_fetch_recent_builds_pages(self):
+        page_size = jenkins_persistence.BUILD_PAGE_SIZE
+        jenkins_persistence.BUILD_PAGE_SIZE = 1
+        try:
+            builds, exhausted = jenkins_persistence.fetch_recent_builds(
+                self.jenkins.job_url, 214)
+        finally:
+            jenkins_persistence.BUILD_PAGE_SIZE = page_size
+        assert [b['number'] for b in builds] == [215, 214]
+        assert not exhausted
+        assert len(self.jenkins.requests) == 2
+
+    def test_check_job(self):
+        last_number, validators = jenkins_persistence.check_job(self.jenkins.job_url)
+        assert last_number == 215
+        assert validators == {}
+        assert self.jenkins.requests[0].endswith('/api/json?tree=lastBuild[number]')
+
+    def test_check_job_not_modified(self):
+        jenkins = StubJenkins(self.test_builds, etags=True).start()
+        try:
+            last_number, validators = jenkins_persistence.check_job(jenkins.job_url)
+            assert last_number == 215
+            assert validators == {'etag': jenkins.etag()}
+            assert jenkins_persistence.check_job(jenkins.job_url, validators) == \
+                (None, validators)
+            jenkins.builds = dict(self.test_builds)
+            jenkins.builds[216] = dict(self.test_builds[215], number=216)
+            assert jenkins_persistence.check_job(jenkins.job_url, validators)[1] != validators
+        finally:
+            jenkins.stop()
+
+    def test_jenkins_client_reuses_connections(self):
+        client = JenkinsClient(connections_per_host=2, timeout=5)
+        first = client.get_json(self.jenkins.job_url + '/213/api/json')
+        second = client.get_json(self.jenkins.job_url + '/214/api/json')
+        assert first['number'] == 213
+        assert second['number'] == 214
+        assert len(self.jenkins.connections) == 1
+
+    def test_jenkins_client_requests_by_host(self):
+        client = JenkinsClient(timeout=5)
+        client.get_json(self.jenkins.job_url + '/213/api/json')
+        client.get_json(self.jenkins.job_url + '/214/api/json')
+        host = self.jenkins.job_url.split('/')[2]
+        assert client.requests_by_host() == {host: 2}
+
+    def test_jenkins_client_error_status(self):
+        client = JenkinsClient(timeout=5)
+        self.assertRaises(JenkinsError, client.get_json,
+                          self.jenkins.job_url + '/999/api/json')
+
+    def test_jenkins_client_follows_redirects(self):
+        jenkins = StubJenkins(self.test_builds, moved=['renamed']).start()
+        try:
+            client = JenkinsClient(timeout=5)
+            old_url = jenkins.job_url.replace('/job/churro', '/job/renamed')
+            assert client.get_json(old_url + '/213/api/json')['number'] == 213
+            assert jenkins.requests == ['/job/renamed/213/api/json', '/job/churro/213/api/json']
+
+            jenkins.moved.add('churro')
+            self.assertRaises(JenkinsError, client.get_json, old_url + '/213/api/json')
+            assert len(jenkins.requests) == 2 + 1 + jenkins_client.MAX_REDIRECTS
+        finally:
+            jenkins.stop()
+
+    def test_circuit_breaker(self):
+        now = [0]
+        breaker = CircuitBreaker(failures=2, reset_s=10, clock=lambda: now[0])
+        breaker.failed()
+        assert breaker.allow()
+        breaker.failed()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+
+        now[0] = 10
+        assert breaker.allow()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert not breaker.allow()
+        breaker.failed()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+
+        now[0] = 20
+        assert breaker.allow()
+        breaker.succeeded()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.allow()
+
+    def test_jenkins_client_fails_fast(self):
+        client = JenkinsClient(timeout=5, breaker_failures=2)
+        url = self.jenkins.job_url + '/213/api/json'
+        self.jenkins.stop()
+        for _ in range(2):
+            self.assertRaises(socket.error, client.get_json, url)
+        self.assertRaises(HostUnavailable, client.get_json, url)
+        host = self.jenkins.job_url.split('/')[2]
+        assert client.host_states() == {host: CircuitBreaker.OPEN}
+        assert client.requests_by_host() == {host: 2}
+        self.jenkins = StubJenkins(self.test_builds).start()
+
+    def test_jenkins_client_not_found_keeps_breaker_closed(self):
+        client = JenkinsClient(timeout=5, breaker_failures=1)
+        self.assertRaises(JenkinsError, client.get_json,
+                          self.jenkins.job_url + '/999/api/json')
+        assert client.get_json(self.jenkins.job_url + '/213/api/json')['number'] == 213
+
+
+if __name__ == '__main__':
+    unittest.main()
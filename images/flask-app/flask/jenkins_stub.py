@@ -0,0 +1,168 @@
+"""
+A stub Jenkins HTTP server for the tests. It serves a dict of build
+fixtures (such as all_builds_test.json) as the history of a single job.
+"""
+# pylint: disable=C0103
+
+import BaseHTTPServer
+import SocketServer
+import json
+import re
+import socket
+import threading
+import urlparse
+
+RANGE_RE = re.compile(r'\{(\d+),(\d+)\}$')
+
+
+class StubJenkinsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers the job and build `api/json` requests the dashboard makes,
+    keeping connections alive between requests.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        stub = self.server.stub
+        stub.requests.append(self.path)
+        stub.connections.add(self.client_address)
+        stub.sockets.add(self.connection)
+
+        parsed = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(parsed.query)
+        parts = [part for part in parsed.path.split('/') if part]
+
+        if parts[:1] == ['job'] and parts[1:2] and parts[1] in stub.moved:
+            location = self.path.replace('/job/%s/' % parts[1], '/job/%s/' % stub.job, 1)
+            return self.send_redirect(301, location)
+
+        if parts[:2] != ['job', stub.job] or parts[-2:] != ['api', 'json']:
+            return self.send_json(404, {})
+
+        if len(parts) == 5:
+            build = stub.builds.get(int(parts[2]))
+            if build is None:
+                return self.send_json(404, {})
+            return self.send_json(200, build)
+
+        etag = stub.etag()
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            return self.send_json(304, None)
+
+        return self.send_json(200, stub.job_json(query.get('tree', [''])[0]), etag)
+
+    def send_json(self, status, body, etag=None):
+        """
+        Write `body` as a JSON response with the given status, or no body
+        if it is None.
+        """
+
+        data = json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_redirect(self, status, location):
+        """
+        Redirect to `location`, a path on this server.
+        """
+
+        self.send_response(status)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubJenkinsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves each keep-alive connection on its own thread.
+    """
+
+    daemon_threads = True
+
+
+class StubJenkins(object):
+    """
+    A Jenkins job served from a background thread on a free local port.
+    Requests for the jobs named in `moved` are redirected to the job, as
+    Jenkins does for a renamed job.
+    """
+
+    def __init__(self, builds, job='churro', etags=False, moved=()):
+        self.builds = builds
+        self.job = job
+        self.etags = etags
+        self.moved = set(moved)
+        self.requests = []
+        self.connections = set()
+        self.sockets = set()
+        self.server = StubJenkinsServer(('127.0.0.1', 0), StubJenkinsHandler)
+        self.server.stub = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def job_url(self):
+        """
+        The URL of the stub job, as it would appear in PIPELINES.
+        """
+
+        return 'http://127.0.0.1:%d/job/%s' % (self.server.server_port, self.job)
+
+    def etag(self):
+        """
+        The ETag of the job documents, which changes with the set of
+        builds, or None if the stub was created without ETags.
+        """
+
+        if not self.etags:
+            return None
+        return '"%d-%d"' % (len(self.builds), max(self.builds or [0]))
+
+    def job_json(self, tree):
+        """
+        Build the job document, honouring an `allBuilds{from,to}` range.
+        """
+
+        newest_first = [self.builds[n] for n in sorted(self.builds, reverse=True)]
+        if tree.startswith('lastBuild'):
+            return {'lastBuild': {'number': newest_first[0]['number']} if newest_first else None}
+        if tree.startswith('allBuilds'):
+            match = RANGE_RE.search(tree)
+            if match:
+                newest_first = newest_first[int(match.group(1)):int(match.group(2))]
+            return {'allBuilds': newest_first}
+
+        return {'builds': [{'number': build['number'],
+                            'url': '%s/%d/' % (self.job_url, build['number'])}
+                           for build in newest_first]}
+
+    def start(self):
+        """
+        Start serving requests.
+        """
+
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving requests and close the sockets, including any
+        connections that clients are keeping alive.
+        """
+
+        self.server.shutdown()
+        self.server.server_close()
+        for sock in self.sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
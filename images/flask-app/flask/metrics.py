@@ -0,0 +1,428 @@
+"""
+In-process metrics, exposed in the Prometheus text format. Metrics are
+created once at import time and can then be updated from any thread;
+each one has its own lock, held only long enough to update a number.
+Values that already live elsewhere, such as the build cache counters,
+are read by collectors when the metrics are scraped instead.
+
+A server that runs several processes, such as gunicorn with more than one
+worker, shares a directory in which each process regularly saves its
+metrics; a scrape of any process then sums the metrics of all of them.
+"""
+# pylint: disable=C0103
+
+import bisect
+import errno
+import json
+import os
+import tempfile
+import threading
+import time
+import BaseHTTPServer
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a Redis read to a slow Jenkins.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    """
+    Format a sample value or bucket bound the way Prometheus expects.
+    """
+
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_sample(name, labels, value):
+    """
+    Format one sample line, given the sample name, a list of (label name,
+    value) pairs and the value.
+    """
+
+    if not labels:
+        return '%s %s' % (name, format_value(value))
+
+    pairs = ','.join('%s="%s"' % (label, str(label_value).replace('\\', r'\\')
+                                  .replace('"', r'\"').replace('\n', r'\n'))
+                     for label, label_value in labels)
+    return '%s{%s} %s' % (name, pairs, format_value(value))
+
+
+def render_family(name, kind, documentation, samples):
+    """
+    Return the lines of a metric in the text format, given its name, type,
+    help text and (name, labels, value) samples.
+    """
+
+    lines = ['# HELP %s %s' % (name, documentation.replace('\\', r'\\')
+                               .replace('\n', r'\n')),
+             '# TYPE %s %s' % (name, kind)]
+    for sample_name, labels, value in samples:
+        lines.append(format_sample(sample_name, labels, value))
+
+    return lines
+
+
+class Metric(object):
+    """
+    A named metric with a fixed set of label names and a value for each
+    combination of label values seen so far.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        """
+        Return the values of `labels` in label name order, checking that
+        exactly the metric's labels were given.
+        """
+
+        if len(labels) != len(self.labelnames) or \
+                any(name not in labels for name in self.labelnames):
+            raise ValueError('%s takes the labels %s, not %s'
+                             % (self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        Yield the (name, labels, value) of each sample.
+        """
+
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield self.name, zip(self.labelnames, key), value
+
+    def family(self):
+        """
+        Return the metric's name, type, help text and list of samples.
+        """
+
+        return self.name, self.kind, self.documentation, list(self.samples())
+
+    def render(self):
+        """
+        Return the lines of the metric in the text format.
+        """
+
+        return render_family(*self.family())
+
+
+class Counter(Metric):
+    """
+    A count that only goes up.
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """
+        Add `amount` to the count for `labels`.
+        """
+
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down.
+    """
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """
+        Set the value for `labels`.
+        """
+
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Counts of observations in cumulative buckets, with their sum.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+
+    def observe(self, value, **labels):
+        """
+        Count an observation of `value` for `labels`.
+        """
+
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket and one for +Inf, then the sum.
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe how many seconds the body of the `with` statement takes.
+        """
+
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, list(counts)) for key, counts in self.values.iteritems())
+
+        for key, counts in items:
+            labels = zip(self.labelnames, key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts[:-1]):
+                cumulative += count
+                yield self.name + '_bucket', labels + [('le', format_value(bound))], \
+                    cumulative
+            yield self.name + '_sum', labels, counts[-1]
+            yield self.name + '_count', labels, cumulative
+
+
+class MultiProcessStore(object):
+    """
+    The metrics of every process of a server, each saved by its process in
+    a JSON file named after its pid in `directory`. The directory must be
+    emptied when the server starts, but not when a process exits, so that
+    counters never go down.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+    def write(self, families):
+        """
+        Save this process's metric families, as returned by
+        `Registry.families`, replacing the ones it saved before.
+        """
+
+        path = os.path.join(self.directory, '%d.json' % os.getpid())
+        # Each write gets its own temporary file, since the flush thread and
+        # scrapes of this process write at the same time.
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as out:
+                json.dump(families, out)
+            os.rename(temporary, path)
+        except:
+            os.unlink(temporary)
+            raise
+
+    def read(self):
+        """
+        Return the metric families of every process, with the values of
+        samples that have the same name and labels summed.
+        """
+
+        merged = OrderedDict()
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as saved:
+                    families = json.load(saved)
+            except (IOError, ValueError):
+                continue
+
+            for name, kind, documentation, samples in families:
+                if name not in merged:
+                    merged[name] = (kind, documentation, OrderedDict())
+                values = merged[name][2]
+                for sample_name, labels, value in samples:
+                    key = (sample_name, tuple(tuple(label) for label in labels))
+                    values[key] = values.get(key, 0) + value
+
+        return [(name, kind, documentation,
+                 [(sample_name, list(labels), value)
+                  for (sample_name, labels), value in values.iteritems()])
+                for name, (kind, documentation, values) in merged.iteritems()]
+
+
+class Registry(object):
+    """
+    The metrics of a process, and the collectors that make metrics from
+    other sources each time they are scraped. Collectors added as
+    `shared` read state that every process sees the same way, such as
+    Redis, so they are only run by the process being scraped.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.shared_collectors = []
+        self.store = None
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add a metric and return it.
+        """
+
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+        Create and register a Counter.
+        """
+
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        """
+        Create and register a Gauge.
+        """
+
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        Create and register a Histogram.
+        """
+
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collect, shared=False):
+        """
+        Add a function that returns a list of metrics to include each time
+        the registry is rendered.
+        """
+
+        with self.lock:
+            if shared:
+                self.shared_collectors.append(collect)
+            else:
+                self.collectors.append(collect)
+
+    def share(self, directory, interval):
+        """
+        Save this process's metrics in `directory` every `interval`
+        seconds from a daemon thread, and render the metrics of every
+        process that saves them there. Does nothing if already sharing.
+        """
+
+        with self.lock:
+            if self.store is not None:
+                return
+            self.store = MultiProcessStore(directory)
+
+        def flush():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.store.write(self.families())
+                except Exception as error: # pylint: disable=W0703
+                    print 'Saving metrics to', directory, 'failed:', error
+
+        thread = threading.Thread(target=flush)
+        thread.daemon = True
+        thread.start()
+
+    def families(self, shared=False):
+        """
+        Return the name, type, help text and samples of each metric of
+        this process, or, if `shared`, of the shared collectors' metrics.
+        A collector that fails is skipped, so that the rest can still be
+        scraped.
+        """
+
+        with self.lock:
+            metrics = [] if shared else list(self.metrics)
+            collectors = list(self.shared_collectors if shared else self.collectors)
+
+        for collect in collectors:
+            try:
+                metrics.extend(collect())
+            except Exception as error: # pylint: disable=W0703
+                print 'Metrics collector', collect.__name__, 'failed:', error
+
+        return [metric.family() for metric in metrics]
+
+    def render(self):
+        """
+        Return every metric in the Prometheus text format, summed over
+        every process if sharing.
+        """
+
+        families = self.families()
+        if self.store is not None:
+            self.store.write(families)
+            families = self.store.read()
+
+        lines = []
+        for family in families + self.families(shared=True):
+            lines.extend(render_family(*family))
+
+        return '\n'.join(lines) + '\n'
+
+
+# The metrics of this process.
+registry = Registry()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers GET /metrics with the metrics of the process.
+    """
+
+    def do_GET(self): # pylint: disable=C0111
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args): # pylint: disable=W0221
+        pass
+
+
+def serve(port, host=''):
+    """
+    Serve /metrics on `port` from a daemon thread, for processes that
+    don't otherwise answer HTTP. Returns the server.
+    """
+
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,158 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+import metrics
+import redis_metrics
+
+
+class metricsTestCase(unittest.TestCase):
+
+    def test_counter(self):
+        counter = metrics.Counter('test_total', 'A test counter.', ('route',))
+        counter.inc(route='/')
+        counter.inc(2, route='/')
+        counter.inc(route='say "hi"\n')
+        assert counter.render() == [
+            '# HELP test_total A test counter.',
+            '# TYPE test_total counter',
+            'test_total{route="/"} 3',
+            'test_total{route="say \\"hi\\"\\n"} 1']
+
+    def test_labels_checked(self):
+        counter = metrics.Counter('test_total', 'A test counter.', ('route',))
+        self.assertRaises(ValueError, counter.inc)
+        self.assertRaises(ValueError, counter.inc, route='/', method='GET')
+
+    def test_gauge(self):
+        gauge = metrics.Gauge('test_ratio', 'A test gauge.')
+        gauge.set(0.5)
+        gauge.set(0.25)
+        assert gauge.render()[-1] == 'test_ratio 0.25'
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'A test histogram.', ('host',),
+                                      buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, host='jenkins1')
+        assert histogram.render()[2:] == [
+            'test_seconds_bucket{host="jenkins1",le="0.1"} 2',
+            'test_seconds_bucket{host="jenkins1",le="1.0"} 3',
+            'test_seconds_bucket{host="jenkins1",le="+Inf"} 4',
+            'test_seconds_sum{host="jenkins1"} 2.65',
+            'test_seconds_count{host="jenkins1"} 4']
+
+    def test_counter_threads(self):
+        counter = metrics.Counter('test_total', 'A test counter.')
+
+        def count():
+            for _ in range(1000):
+                counter.inc()
+
+        threads = [threading.Thread(target=count) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert counter.render()[-1] == 'test_total 8000'
+
+    def test_registry_skips_failed_collectors(self):
+        registry = metrics.Registry()
+        registry.counter('test_total', 'A test counter.').inc()
+
+        def collect_broken():
+            raise RedisConnectionError('Redis is down')
+
+        def collect_gauge():
+            gauge = metrics.Gauge('test_collected', 'A collected gauge.')
+            gauge.set(7)
+            return [gauge]
+
+        registry.add_collector(collect_broken)
+        registry.add_collector(collect_gauge)
+        text = registry.render()
+        assert 'test_total 1\n' in text
+        assert text.endswith('test_collected 7\n')
+
+    def test_multiprocess_store_sums_processes(self):
+        directory = tempfile.mkdtemp()
+        try:
+            registry = metrics.Registry()
+            counter = registry.counter('test_total', 'A test counter.', ('route',))
+            histogram = registry.histogram('test_seconds', 'A test histogram.',
+                                           buckets=(1,))
+            counter.inc(2, route='/')
+            histogram.observe(0.5)
+
+            def collect_shared():
+                gauge = metrics.Gauge('test_shared', 'Read from Redis.')
+                gauge.set(3)
+                return [gauge]
+
+            registry.add_collector(collect_shared, shared=True)
+            registry.store = metrics.MultiProcessStore(directory)
+
+            other = metrics.Registry()
+            other.counter('test_total', 'A test counter.', ('route',)).inc(route='/')
+            other.counter('test_total', 'A test counter.', ('route',))
+            other_histogram = other.histogram('test_seconds', 'A test histogram.',
+                                              buckets=(1,))
+            other_histogram.observe(5)
+            with open(os.path.join(directory, '1.json'), 'w') as out:
+                json.dump(other.families(), out)
+
+            lines = registry.render().splitlines()
+            assert 'test_total{route="/"} 3' in lines
+            assert 'test_seconds_bucket{le="1.0"} 1' in lines
+            assert 'test_seconds_bucket{le="+Inf"} 2' in lines
+            assert 'test_seconds_sum 5.5' in lines
+            assert lines.count('test_shared 3') == 1
+        finally:
+            shutil.rmtree(directory)
+
+    def test_multiprocess_store_concurrent_writes(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = metrics.MultiProcessStore(directory)
+            counter = metrics.Counter('test_total', 'A test counter.')
+            counter.inc()
+            errors = []
+
+            def write():
+                try:
+                    for _ in range(200):
+                        store.write([counter.family()])
+                except Exception as error: # pylint: disable=W0703
+                    errors.append(error)
+
+            threads = [threading.Thread(target=write) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert errors == []
+            assert os.listdir(directory) == ['%d.json' % os.getpid()]
+            assert store.read() == [counter.family()]
+        finally:
+            shutil.rmtree(directory)
+
+    def test_redis_metrics_count_errors(self):
+        database = redis_metrics.InstrumentedDatabase(host='127.0.0.1', port=1)
+        errors = dict(redis_metrics.REDIS_ERRORS.values)
+        self.assertRaises(RedisConnectionError, database.get, 'key')
+        pipe = database.pipeline(transaction=False)
+        pipe.hget('hash', 'field')
+        self.assertRaises(RedisConnectionError, pipe.execute)
+        assert redis_metrics.REDIS_ERRORS.values[('command',)] == \
+            errors.get(('command',), 0) + 1
+        assert redis_metrics.REDIS_ERRORS.values[('pipeline',)] == \
+            errors.get(('pipeline',), 0) + 1
+
+
+if __name__ == '__main__':
+    unittest.main()
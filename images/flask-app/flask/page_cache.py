@@ -0,0 +1,91 @@
+"""
+A cache of rendered pages and page fragments in Redis, shared by every
+web process. Keys include the version of the data they were rendered
+from, so entries never need invalidating; the least recently used ones
+are evicted once the cache holds more than its size.
+"""
+# pylint: disable=C0103
+
+import time
+
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+PAGES_KEY = 'pages:html'
+ACCESS_KEY = 'pages:lru'
+
+
+class PageCache(object):
+    """
+    Rendered pages in a Redis hash, with a sorted set of last access
+    times for eviction. If Redis can't be reached, pages are simply
+    rendered every time.
+    """
+
+    def __init__(self, database, size=1000):
+        self.database = database
+        self.size = size
+
+    def get(self, key):
+        """
+        Return the cached page for `key` and mark it as used, or None.
+        """
+
+        pipe = self.database.pipeline(transaction=False)
+        pipe.hget(PAGES_KEY, key)
+        pipe.zadd(ACCESS_KEY, key, time.time())
+        page, _ = pipe.execute()
+
+        return page.decode('utf-8') if page is not None else None
+
+    def set(self, key, page):
+        """
+        Cache a page under `key`, evicting the least recently used pages
+        if the cache is over its size.
+        """
+
+        pipe = self.database.pipeline(transaction=False)
+        pipe.hset(PAGES_KEY, key, page.encode('utf-8'))
+        pipe.zadd(ACCESS_KEY, key, time.time())
+        pipe.zcard(ACCESS_KEY)
+        count = pipe.execute()[-1]
+
+        if count > self.size:
+            evicted = self.database.zrange(ACCESS_KEY, 0, count - self.size - 1)
+            if evicted:
+                pipe = self.database.pipeline(transaction=False)
+                pipe.hdel(PAGES_KEY, *evicted)
+                pipe.zrem(ACCESS_KEY, *evicted)
+                pipe.execute()
+
+    def lookup(self, key):
+        """
+        Like `get`, but returns None if Redis can't be reached.
+        """
+
+        try:
+            return self.get(key)
+        except RedisConnectionError:
+            return None
+
+    def store(self, key, page):
+        """
+        Like `set`, but does nothing if Redis can't be reached.
+        """
+
+        try:
+            self.set(key, page)
+        except RedisConnectionError:
+            pass
+
+    def render(self, key, render):
+        """
+        Return the page cached under `key`, or call `render` to make it and
+        cache the result.
+        """
+
+        page = self.lookup(key)
+        if page is None:
+            page = render()
+            self.store(key, page)
+
+        return page
@@ -0,0 +1,68 @@
+import page_cache
+import time
+import unittest
+
+from walrus import Database
+
+from redis_stub import StubRedis
+
+
+class pageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Nothing listens on port 1, so every Redis call fails to connect.
+        self.cache = page_cache.PageCache(Database(host='127.0.0.1', port=1), size=2)
+        self.renders = []
+
+    def render(self):
+        self.renders.append(1)
+        return u'<p>caf\xe9</p>'
+
+    def test_renders_without_redis(self):
+        assert self.cache.render('pipeline:churro:1', self.render) == u'<p>caf\xe9</p>'
+        assert self.cache.render('pipeline:churro:1', self.render) == u'<p>caf\xe9</p>'
+        assert len(self.renders) == 2
+        assert self.cache.lookup('pipeline:churro:1') is None
+
+
+class storedPageCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.database = StubRedis()
+        self.cache = page_cache.PageCache(self.database, size=2)
+        # A clock that ticks on every read, so access times never tie.
+        self.now = 0
+        page_cache.time = self
+        self.renders = []
+
+    def tearDown(self):
+        page_cache.time = time
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+    def render(self, page):
+        def render():
+            self.renders.append(page)
+            return page
+        return render
+
+    def test_hit(self):
+        assert self.cache.render('pipeline:churro:1', self.render(u'caf\xe9')) == u'caf\xe9'
+        assert self.cache.render('pipeline:churro:1', self.render(u'other')) == u'caf\xe9'
+        assert self.renders == [u'caf\xe9']
+        assert self.database.hget(page_cache.PAGES_KEY, 'pipeline:churro:1') == 'caf\xc3\xa9'
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('a', u'A')
+        self.cache.set('b', u'B')
+        assert self.cache.get('a') == u'A'
+        self.cache.set('c', u'C')
+        assert self.database.zrange(page_cache.ACCESS_KEY, 0, -1) == ['a', 'c']
+        assert sorted(self.database.hkeys(page_cache.PAGES_KEY)) == ['a', 'c']
+        assert self.cache.get('b') is None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+"""
+Decides when the worker polls each pipeline. Pipelines that are building
+are polled often, idle ones less and less often, and every Jenkins host
+has a budget of requests per minute that polls must fit within.
+"""
+# pylint: disable=C0103
+
+import heapq
+
+
+class HostBudget(object):
+    """
+    A token bucket of `per_minute` requests to one Jenkins host, allowing
+    bursts of up to a minute's worth. Requests are charged after they are
+    made, so the balance can go negative and delay later polls.
+    """
+
+    def __init__(self, per_minute, now):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = now
+
+    def refill(self, now):
+        """
+        Add the tokens earned since the last refill.
+        """
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available_at(self, now):
+        """
+        Return the time at which at least one request can be made.
+        """
+
+        self.refill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def charge(self, requests, now):
+        """
+        Spend `requests` tokens.
+        """
+
+        self.refill(now)
+        self.tokens -= requests
+
+
+class PollScheduler(object):
+    """
+    A priority queue of the times at which each pipeline is next due to
+    be polled. After a poll, a pipeline that is building is polled again
+    after `building_interval` seconds; one that changed after `interval`;
+    and one that didn't change after its previous interval multiplied by
+    `backoff`, up to `max_interval`.
+    """
+
+    def __init__(self, hosts, interval, max_interval, building_interval,
+                 backoff=2.0, host_budget=60, now=0):
+        self.hosts = hosts
+        self.interval = interval
+        self.max_interval = max_interval
+        self.building_interval = building_interval
+        self.backoff = backoff
+        self.budgets = dict((host, HostBudget(host_budget, now))
+                            for host in set(hosts.values()))
+        self.intervals = {}
+        self.due_at = {}
+        self.heap = []
+        for name in sorted(hosts):
+            self.intervals[name] = interval
+            self.schedule(name, now)
+
+    def schedule(self, name, when):
+        """
+        Make `name` due at `when`, replacing any earlier schedule. Replaced
+        heap entries are skipped when they come up.
+        """
+
+        self.due_at[name] = when
+        heapq.heappush(self.heap, (when, name))
+
+    def pop_due(self, now):
+        """
+        Remove and return the pipelines that are due at `now`, in the order
+        they became due. Pipelines whose host is over its budget are
+        pushed back until the host has a request to spare.
+        """
+
+        due = []
+        deferred = []
+        while self.heap and self.heap[0][0] <= now:
+            when, name = heapq.heappop(self.heap)
+            if self.due_at.get(name) != when:
+                continue
+            available = self.budgets[self.hosts[name]].available_at(now)
+            if available > now:
+                deferred.append((name, available))
+            else:
+                del self.due_at[name]
+                due.append(name)
+                # Reserve the poll's first request so that one host's
+                # pipelines can't all start on the last token.
+                self.budgets[self.hosts[name]].charge(1, now)
+
+        for name, available in deferred:
+            self.schedule(name, available)
+
+        return due
+
+    def record(self, name, changed, building, now):
+        """
+        Schedule the next poll of `name` after a poll that finished at
+        `now`. `changed` is whether the poll found anything new, or None if
+        it failed, in which case the interval is kept.
+        """
+
+        idle_interval = max(self.intervals[name], self.interval)
+        if building:
+            interval = self.building_interval
+        elif changed:
+            interval = self.interval
+        elif changed is None:
+            interval = idle_interval
+        else:
+            interval = min(idle_interval * self.backoff, self.max_interval)
+
+        self.intervals[name] = interval
+        self.schedule(name, now + interval)
+
+    def poke(self, name, now):
+        """
+        Poll `name` as soon as its host allows and reset its backoff, for
+        when something is known to have happened to it.
+        """
+
+        if name in self.hosts:
+            self.intervals[name] = self.interval
+            self.schedule(name, now)
+
+    def settle(self, polled, requests_by_host, now):
+        """
+        Given the pipelines returned by `pop_due` and the number of
+        requests that polling them made to each host, charge each host for
+        the requests beyond the one per poll reserved by `pop_due`.
+        """
+
+        reserved = dict.fromkeys(self.budgets, 0)
+        for name in polled:
+            reserved[self.hosts[name]] += 1
+
+        for host in self.budgets:
+            extra = requests_by_host.get(host, 0) - reserved[host]
+            if extra:
+                self.budgets[host].charge(extra, now)
+
+    def charge(self, requests_by_host, now):
+        """
+        Charge each host for requests made to it outside of polls, such as
+        those made to ingest notified builds.
+        """
+
+        for host, requests in requests_by_host.iteritems():
+            if requests and host in self.budgets:
+                self.budgets[host].charge(requests, now)
+
+    def next_due(self):
+        """
+        Return the time the next pipeline is due, or None if none are
+        scheduled.
+        """
+
+        while self.heap and self.due_at.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
@@ -0,0 +1,76 @@
+import unittest
+
+from poll_scheduler import PollScheduler
+
+
+class pollSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = PollScheduler({'churro': 'jenkins1', 'other': 'jenkins1',
+                                        'elsewhere': 'jenkins2'},
+                                       interval=60, max_interval=300,
+                                       building_interval=10, backoff=2,
+                                       host_budget=60, now=0)
+
+    def test_all_due_at_start(self):
+        assert self.scheduler.pop_due(0) == ['churro', 'elsewhere', 'other']
+        assert self.scheduler.pop_due(0) == []
+        assert self.scheduler.next_due() is None
+
+    def test_building_polled_often(self):
+        self.scheduler.pop_due(0)
+        self.scheduler.record('churro', False, True, 0)
+        assert self.scheduler.next_due() == 10
+
+    def test_idle_backoff(self):
+        self.scheduler.pop_due(0)
+        intervals = []
+        now = 0
+        for _ in range(5):
+            self.scheduler.record('churro', False, False, now)
+            due = self.scheduler.next_due()
+            intervals.append(due - now)
+            now = due
+            assert self.scheduler.pop_due(now) == ['churro']
+        assert intervals == [120, 240, 300, 300, 300]
+
+        self.scheduler.record('churro', True, False, now)
+        assert self.scheduler.next_due() == now + 60
+
+    def test_failed_poll_keeps_interval(self):
+        self.scheduler.pop_due(0)
+        self.scheduler.record('churro', False, False, 0)
+        self.scheduler.pop_due(120)
+        self.scheduler.record('churro', None, False, 120)
+        assert self.scheduler.next_due() == 240
+
+    def test_poke(self):
+        self.scheduler.pop_due(0)
+        self.scheduler.record('churro', False, False, 0)
+        self.scheduler.record('other', False, False, 0)
+        self.scheduler.poke('churro', 5)
+        self.scheduler.poke('unknown', 5)
+        assert self.scheduler.pop_due(5) == ['churro']
+        assert self.scheduler.next_due() == 120
+
+    def test_host_budget_defers(self):
+        self.scheduler.pop_due(0)
+        self.scheduler.settle(['churro', 'other', 'elsewhere'],
+                              {'jenkins1': 61, 'jenkins2': 1}, 0)
+        self.scheduler.poke('churro', 1)
+        self.scheduler.poke('elsewhere', 1)
+        assert self.scheduler.pop_due(1) == ['elsewhere']
+        assert self.scheduler.next_due() == 2
+        assert self.scheduler.pop_due(2) == ['churro']
+
+    def test_charge_outside_polls(self):
+        self.scheduler.pop_due(0)
+        self.scheduler.record('churro', False, False, 0)
+        self.scheduler.charge({'jenkins1': 60, 'unknown': 5}, 0)
+        self.scheduler.poke('churro', 1)
+        assert self.scheduler.pop_due(1) == []
+        assert self.scheduler.next_due() == 3
+
+
+if __name__ == '__main__':
+    unittest.main()
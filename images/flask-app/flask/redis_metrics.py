@@ -0,0 +1,81 @@
+"""
+A walrus Database that counts and times every Redis command and pipeline
+it sends, for the /metrics endpoint and the Server-Timing header.
+"""
+# pylint: disable=C0103
+
+import time
+
+from redis.client import Pipeline
+from walrus import Database
+
+import request_timing
+from metrics import registry
+
+REDIS_COMMANDS = registry.counter(
+    'butlercam_redis_commands_total',
+    'Redis commands sent, including those sent in pipelines.', ('command',))
+REDIS_ERRORS = registry.counter(
+    'butlercam_redis_errors_total',
+    'Redis round trips that raised an error.', ('kind',))
+REDIS_SECONDS = registry.histogram(
+    'butlercam_redis_round_trip_seconds',
+    'Time taken by single Redis commands and by whole pipelines.', ('kind',))
+
+
+def observe_round_trip(kind, started, failed):
+    """
+    Record a round trip of `kind` (command or pipeline) that started at
+    `started`.
+    """
+
+    elapsed = time.time() - started
+    REDIS_SECONDS.observe(elapsed, kind=kind)
+    request_timing.record('redis', elapsed)
+    if failed:
+        REDIS_ERRORS.inc(kind=kind)
+
+
+class InstrumentedPipeline(Pipeline):
+    """
+    A pipeline that records its commands and round trip when executed.
+    """
+
+    def execute(self, raise_on_error=True):
+        if not self.command_stack:
+            return []
+
+        for args, _ in self.command_stack:
+            REDIS_COMMANDS.inc(command=args[0].upper())
+
+        started = time.time()
+        failed = True
+        try:
+            result = Pipeline.execute(self, raise_on_error)
+            failed = False
+            return result
+        finally:
+            observe_round_trip('pipeline', started, failed)
+
+
+class InstrumentedDatabase(Database):
+    """
+    A walrus Database whose commands and pipelines are recorded in the
+    Redis metrics.
+    """
+
+    def execute_command(self, *args, **options):
+        REDIS_COMMANDS.inc(command=args[0].upper())
+
+        started = time.time()
+        failed = True
+        try:
+            result = Database.execute_command(self, *args, **options)
+            failed = False
+            return result
+        finally:
+            observe_round_trip('command', started, failed)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks,
+                                    transaction, shard_hint)
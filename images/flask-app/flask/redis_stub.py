@@ -0,0 +1,373 @@
+"""
+A stub Redis for the tests. It is a walrus Database that keeps its data in
+memory and answers the commands the dashboard sends, including pipelines,
+WATCH/MULTI transactions and the walrus Array scripts, so that code that
+reads and writes Redis can be tested without a server.
+"""
+# pylint: disable=C0103
+
+import threading
+
+from redis.client import Pipeline
+from redis.exceptions import ResponseError, WatchError
+from walrus import Database
+
+# The commands that change the key they are given, so that WATCHers of the
+# key see the change.
+WRITE_COMMANDS = set(['SET', 'INCRBY', 'DEL', 'HSET', 'HMSET', 'HDEL', 'ZADD',
+                      'ZINCRBY', 'ZREM', 'SADD', 'SREM', 'LPUSH', 'RPOP'])
+
+
+def encode(value):
+    """
+    Convert a command argument to the string Redis would store.
+    """
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def parse_bound(bound):
+    """
+    Parse a ZRANGEBYSCORE bound into (score, exclusive).
+    """
+
+    if bound.startswith('('):
+        return float(bound[1:]), True
+    return float(bound), False
+
+
+def in_bounds(score, low, high):
+    """
+    Return whether `score` is within the parsed bounds `low` and `high`.
+    """
+
+    (low_score, low_exclusive), (high_score, high_exclusive) = low, high
+    above = score > low_score if low_exclusive else score >= low_score
+    below = score < high_score if high_exclusive else score <= high_score
+    return above and below
+
+
+class StubRedis(Database):
+    """
+    An in-memory Redis. `before_exec`, if set, is called just before a
+    transaction is executed, so that tests can change watched keys under
+    it.
+    """
+
+    def __init__(self):
+        # Nothing listens on port 1; commands never reach the connection.
+        Database.__init__(self, host='127.0.0.1', port=1)
+        self.data = {}
+        self.versions = {}
+        self.lock = threading.RLock()
+        self.before_exec = None
+
+    def execute_command(self, *args, **options):
+        with self.lock:
+            return self.run_command(args, options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return StubPipeline(self, transaction)
+
+    def run_script(self, script_name, keys=None, args=None):
+        key = keys[0]
+        with self.lock:
+            array = self.data.setdefault(key, {})
+            if script_name == 'array_get':
+                index = int(args[0])
+                if index < 0:
+                    index += len(array)
+                return array.get(str(index))
+            if script_name == 'array_extend':
+                offset = len(array)
+                for i, value in enumerate(args):
+                    array[str(offset + i)] = encode(value)
+                self.touch(key)
+                return None
+        raise NotImplementedError(script_name)
+
+    def touch(self, key):
+        """
+        Note that `key` has changed, for WATCH.
+        """
+
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def run_command(self, args, options):
+        """
+        Run one command and return its reply as redis-py would parse it.
+        """
+
+        name = args[0].upper()
+        args = [encode(arg) for arg in args[1:]]
+        handler = getattr(self, 'cmd_' + name.lower(), None)
+        if handler is None:
+            raise ResponseError('unknown command ' + name)
+        if name in WRITE_COMMANDS:
+            for key in (args if name == 'DEL' else args[:1]):
+                self.touch(key)
+        return handler(args, options)
+
+    def typed(self, key, kind):
+        """
+        Return the value of `key` if it is of type `kind`, or a new one.
+        """
+
+        value = self.data.get(key)
+        if value is None:
+            return kind()
+        if not isinstance(value, kind):
+            raise ResponseError('WRONGTYPE Operation against a key holding '
+                                'the wrong kind of value')
+        return value
+
+    def stored(self, key, kind):
+        """
+        Return the value of `key` of type `kind`, creating it if needed.
+        """
+
+        value = self.typed(key, kind)
+        self.data[key] = value
+        return value
+
+    def prune(self, key):
+        """
+        Delete `key` if it is an empty container, as Redis does.
+        """
+
+        if key in self.data and not self.data[key] and \
+                not isinstance(self.data[key], str):
+            del self.data[key]
+
+    # Strings
+
+    def cmd_get(self, args, _):
+        return self.typed(args[0], str) or None
+
+    def cmd_set(self, args, _):
+        self.data[args[0]] = args[1]
+        return True
+
+    def cmd_mget(self, args, _):
+        return [self.data.get(key) for key in args]
+
+    def cmd_incrby(self, args, _):
+        value = int(self.data.get(args[0], 0)) + int(args[1])
+        self.data[args[0]] = str(value)
+        return value
+
+    # Keys
+
+    def cmd_del(self, args, _):
+        deleted = [key for key in args if key in self.data]
+        for key in deleted:
+            del self.data[key]
+        return len(deleted)
+
+    def cmd_exists(self, args, _):
+        return args[0] in self.data
+
+    # Hashes
+
+    def cmd_hset(self, args, _):
+        values = self.stored(args[0], dict)
+        added = args[1] not in values
+        values[args[1]] = args[2]
+        return int(added)
+
+    def cmd_hmset(self, args, _):
+        values = self.stored(args[0], dict)
+        for i in range(1, len(args), 2):
+            values[args[i]] = args[i + 1]
+        return True
+
+    def cmd_hget(self, args, _):
+        return self.typed(args[0], dict).get(args[1])
+
+    def cmd_hmget(self, args, _):
+        values = self.typed(args[0], dict)
+        return [values.get(field) for field in args[1:]]
+
+    def cmd_hgetall(self, args, _):
+        return dict(self.typed(args[0], dict))
+
+    def cmd_hdel(self, args, _):
+        values = self.typed(args[0], dict)
+        deleted = [field for field in set(args[1:]) if field in values]
+        for field in deleted:
+            del values[field]
+        self.prune(args[0])
+        return len(deleted)
+
+    def cmd_hlen(self, args, _):
+        return len(self.typed(args[0], dict))
+
+    def cmd_hkeys(self, args, _):
+        return list(self.typed(args[0], dict))
+
+    # Sets
+
+    def cmd_sadd(self, args, _):
+        members = self.stored(args[0], set)
+        added = set(args[1:]) - members
+        members.update(added)
+        return len(added)
+
+    def cmd_srem(self, args, _):
+        members = self.typed(args[0], set)
+        removed = set(args[1:]) & members
+        members.difference_update(removed)
+        self.prune(args[0])
+        return len(removed)
+
+    def cmd_smembers(self, args, _):
+        return set(self.typed(args[0], set))
+
+    # Lists
+
+    def cmd_lpush(self, args, _):
+        values = self.stored(args[0], list)
+        for value in args[1:]:
+            values.insert(0, value)
+        return len(values)
+
+    def cmd_rpop(self, args, _):
+        values = self.typed(args[0], list)
+        value = values.pop() if values else None
+        self.prune(args[0])
+        return value
+
+    # Sorted sets, whose values are dicts of member to score.
+
+    def cmd_zadd(self, args, _):
+        scores = self.stored(args[0], SortedSet)
+        added = 0
+        # walrus uses the legacy client, which sends score, member pairs.
+        for i in range(1, len(args), 2):
+            added += args[i + 1] not in scores
+            scores[args[i + 1]] = float(args[i])
+        return added
+
+    def cmd_zincrby(self, args, _):
+        scores = self.stored(args[0], SortedSet)
+        scores[args[2]] = scores.get(args[2], 0.0) + float(args[1])
+        return scores[args[2]]
+
+    def cmd_zrem(self, args, _):
+        scores = self.typed(args[0], SortedSet)
+        removed = [member for member in set(args[1:]) if member in scores]
+        for member in removed:
+            del scores[member]
+        self.prune(args[0])
+        return len(removed)
+
+    def cmd_zcard(self, args, _):
+        return len(self.typed(args[0], SortedSet))
+
+    def cmd_zscore(self, args, _):
+        return self.typed(args[0], SortedSet).get(args[1])
+
+    def cmd_zrange(self, args, options, reverse=False):
+        items = self.typed(args[0], SortedSet).ordered(reverse)
+        start, stop = int(args[1]), int(args[2])
+        if start < 0:
+            start = max(len(items) + start, 0)
+        if stop < 0:
+            stop += len(items)
+        return self.reply(items[start:stop + 1], options)
+
+    def cmd_zrevrange(self, args, options):
+        return self.cmd_zrange(args, options, reverse=True)
+
+    def cmd_zrangebyscore(self, args, options, reverse=False):
+        low, high = parse_bound(args[1]), parse_bound(args[2])
+        if reverse:
+            low, high = high, low
+        items = [(member, score) for member, score in
+                 self.typed(args[0], SortedSet).ordered(reverse)
+                 if in_bounds(score, low, high)]
+        if 'LIMIT' in args:
+            offset = args.index('LIMIT')
+            start, num = int(args[offset + 1]), int(args[offset + 2])
+            items = items[start:start + num] if num >= 0 else items[start:]
+        return self.reply(items, options)
+
+    def cmd_zrevrangebyscore(self, args, options):
+        return self.cmd_zrangebyscore(args, options, reverse=True)
+
+    @staticmethod
+    def reply(items, options):
+        """
+        Return sorted set items as redis-py does, with or without scores.
+        """
+
+        if options.get('withscores'):
+            cast = options.get('score_cast_func', float)
+            return [(member, cast(score)) for member, score in items]
+        return [member for member, _ in items]
+
+
+class SortedSet(dict):
+    """
+    The members of a sorted set and their scores.
+    """
+
+    def ordered(self, reverse=False):
+        """
+        Return the (member, score) pairs in score, then member, order.
+        """
+
+        return sorted(self.iteritems(), key=lambda item: (item[1], item[0]),
+                      reverse=reverse)
+
+
+class StubPipeline(Pipeline):
+    """
+    A pipeline on a StubRedis. Commands run when executed, all at once,
+    and a transaction fails with WatchError if a key it WATCHed changed.
+    """
+
+    def __init__(self, database, transaction):
+        self.database = database
+        self.watched = {}
+        Pipeline.__init__(self, database.connection_pool, database.response_callbacks,
+                          transaction, None)
+
+    def reset(self):
+        Pipeline.reset(self)
+        self.watched = {}
+
+    def immediate_execute_command(self, *args, **options):
+        name = args[0].upper()
+        with self.database.lock:
+            if name == 'WATCH':
+                for key in args[1:]:
+                    self.watched[key] = self.database.versions.get(key, 0)
+                self.watching = True
+                return True
+            if name == 'UNWATCH':
+                self.watched = {}
+                self.watching = False
+                return True
+            return self.database.run_command(args, options)
+
+    def execute(self, raise_on_error=True):
+        stack = self.command_stack
+        try:
+            if not stack:
+                return []
+            if self.watched and self.database.before_exec is not None:
+                before_exec, self.database.before_exec = self.database.before_exec, None
+                before_exec()
+            with self.database.lock:
+                for key, version in self.watched.iteritems():
+                    if self.database.versions.get(key, 0) != version:
+                        raise WatchError('Watched variable changed.')
+                return [self.database.run_command(args, options)
+                        for args, options in stack]
+        finally:
+            self.reset()
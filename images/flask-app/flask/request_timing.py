@@ -0,0 +1,95 @@
+"""
+Breaks the time taken by a web request down into spans for its
+Server-Timing header: Jenkins I/O, Redis I/O, analytics and templating.
+Spans are kept per thread and only while a request is being timed, so the
+calls made by the worker or by streamed responses cost nothing. Time spent
+in a span nested in another one only counts towards the inner span.
+"""
+# pylint: disable=C0103
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# The spans, in header order, and their descriptions.
+SPANS = OrderedDict([('jenkins', 'Jenkins I/O'),
+                     ('redis', 'Redis I/O'),
+                     ('analytics', 'Analytics'),
+                     ('template', 'Templating')])
+
+_local = threading.local()
+
+
+def start():
+    """
+    Start timing a request on this thread.
+    """
+
+    _local.totals = dict.fromkeys(SPANS, 0.0)
+    _local.stack = []
+
+
+def stop():
+    """
+    Stop timing the request on this thread and return the seconds spent in
+    each span.
+    """
+
+    totals = getattr(_local, 'totals', None)
+    _local.totals = None
+    _local.stack = None
+    return totals
+
+
+def record(name, seconds):
+    """
+    Add `seconds` to the span `name`, for I/O that is timed by the caller.
+    """
+
+    totals = getattr(_local, 'totals', None)
+    if totals is None:
+        return
+
+    totals[name] += seconds
+    if _local.stack:
+        _local.stack[-1][1] += seconds
+
+
+@contextmanager
+def span(name):
+    """
+    Count the time taken by the body of the `with` statement, less any
+    time recorded in other spans within it, towards the span `name`.
+    """
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        yield
+        return
+
+    # The span's name and the time spent in the spans nested in it.
+    frame = [name, 0.0]
+    stack.append(frame)
+    started = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - started
+        stack.pop()
+        _local.totals[name] += elapsed - frame[1]
+        if stack:
+            stack[-1][1] += elapsed
+
+
+def header(totals, total):
+    """
+    Given the span totals returned by `stop` and the total time taken by
+    the request, in seconds, return the value of the Server-Timing header.
+    """
+
+    entries = ['%s;dur=%.1f;desc="%s"' % (name, totals[name] * 1000, description)
+               for name, description in SPANS.iteritems()]
+    entries.append('total;dur=%.1f' % (total * 1000))
+
+    return ', '.join(entries)
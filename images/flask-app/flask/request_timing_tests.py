@@ -0,0 +1,39 @@
+import time
+import unittest
+
+import request_timing
+
+
+class requestTimingTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        request_timing.stop()
+
+    def test_not_timing(self):
+        request_timing.record('redis', 1.0)
+        with request_timing.span('analytics'):
+            pass
+        assert request_timing.stop() is None
+
+    def test_nested_spans_are_exclusive(self):
+        request_timing.start()
+        with request_timing.span('template'):
+            with request_timing.span('analytics'):
+                request_timing.record('redis', 0.005)
+                time.sleep(0.03)
+        totals = request_timing.stop()
+        assert totals['redis'] == 0.005
+        assert 0.015 < totals['analytics'] < 0.5
+        assert totals['template'] < 0.015
+        assert totals['jenkins'] == 0.0
+
+    def test_header(self):
+        totals = {'jenkins': 0.0123, 'redis': 0.001, 'analytics': 0, 'template': 0.2}
+        assert request_timing.header(totals, 0.25) == \
+            'jenkins;dur=12.3;desc="Jenkins I/O", redis;dur=1.0;desc="Redis I/O", ' \
+            'analytics;dur=0.0;desc="Analytics", template;dur=200.0;desc="Templating", ' \
+            'total;dur=250.0'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+Times the build time-slice calculations used by the pipeline page on
+synthetic build histories of increasing size.
+
+    python slice_benchmark.py [sizes...]
+"""
+
+import random
+import sys
+import time
+from collections import OrderedDict
+
+from build_summary import BuildSummary
+from butlercam import calculate_build_slices, process_time_data
+from custom_charts import get_time_percentages
+
+RESULTS = ['SUCCESS'] * 7 + ['FAILURE'] * 2 + ['ABORTED']
+
+
+def make_builds(count):
+    """
+    Generate `count` build summaries, about an hour apart, ending now.
+    """
+
+    builds = OrderedDict()
+    timestamp = int((time.time() - count * 3600) * 1000)
+    for number in range(1, count + 1):
+        timestamp += random.randint(60, 7200) * 1000
+        builds[number] = BuildSummary(number, random.choice(RESULTS), timestamp,
+                                      600000, False, None, '#%d' % number, (), (), ())
+    return builds
+
+
+def timed(fn, *args):
+    """
+    Call `fn` and return its result and how long it took in milliseconds.
+    """
+
+    started = time.time()
+    result = fn(*args)
+    return result, (time.time() - started) * 1000
+
+
+def main(sizes):
+    print '%10s %12s %12s %12s' % ('builds', 'slices ms', 'totals ms', 'week ms')
+    for size in sizes:
+        builds = make_builds(size)
+        build_slices, slices_ms = timed(calculate_build_slices, builds)
+        time_data, totals_ms = timed(process_time_data, build_slices)
+        _, week_ms = timed(get_time_percentages, time_data)
+        print '%10d %12.1f %12.1f %12.1f' % (size, slices_ms, totals_ms, week_ms)
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,94 @@
+/*
+ * Keeps the build lights and the pipeline status up to date from the
+ * server-sent status events, without reloading the page.
+ */
+
+// The same format as the ms_to_time template filter.
+function msToTime(milliseconds) {
+  var remainder = Math.floor(milliseconds / 1000);
+  var parts = [[Math.floor(remainder / 86400), 'd:'],
+               [Math.floor(remainder / 3600) % 24, 'h:'],
+               [Math.floor(remainder / 60) % 60, 'm:'],
+               [remainder % 60, 's']];
+  var output = '';
+  for (var i = 0; i < parts.length; i++) {
+    if (parts[i][0]) {
+      output += parts[i][0] + parts[i][1];
+    }
+  }
+  return output;
+}
+
+function lightImage(result, blink) {
+  var image = result === 'SUCCESS' ? 'up' : 'down';
+  return '<img src="/static/images/' + image + '.png"' +
+    (blink ? ' class="blink"' : '') + ' alt=""> ';
+}
+
+// The same light as lights.html renders for a pipeline's status.
+function lightHtml(status) {
+  var stale = status.stale ? ' <span class="small stale">(last known)</span>' : '';
+  return baseLightHtml(status) + stale;
+}
+
+function baseLightHtml(status) {
+  if (status.result === null && !status.building) {
+    return '<bold>No status yet</bold>';
+  }
+  if (status.building) {
+    var passing = status.last_complete_result === 'SUCCESS';
+    return lightImage(status.last_complete_result, true) +
+      '<bold>' + (passing ? 'Passing' : 'Failing') + '</bold> | Building now...';
+  }
+  return lightImage(status.result, false) +
+    '<bold>' + (status.result === 'SUCCESS' ? 'Passing' : 'Failing') + '</bold> | ' +
+    msToTime(status.duration || 0);
+}
+
+// Browsers give up on a stream that is refused, e.g. with a 503 when the
+// server already has too many open, so try again after the retry delay.
+var STREAM_RETRY_MS = 5000;
+
+function onStatus(url, callback) {
+  if (!window.EventSource) {
+    return;
+  }
+  var source = new EventSource(url);
+  source.addEventListener('status', function (event) {
+    callback(JSON.parse(event.data));
+  });
+  source.addEventListener('error', function () {
+    if (source.readyState === EventSource.CLOSED) {
+      setTimeout(function () { onStatus(url, callback); }, STREAM_RETRY_MS);
+    }
+  });
+}
+
+// Update the build lights on the home page.
+function watchLights(url) {
+  onStatus(url, function (change) {
+    $('[data-pipeline]').filter(function () {
+      return $(this).data('pipeline') === change.pipeline;
+    }).find('.light').html(lightHtml(change.status));
+    $('#status-age').removeClass('stale').text('Last updated just now');
+  });
+}
+
+// Update the current status on a pipeline page, and reload the page when a
+// build finishes so that the charts include it.
+function watchStatus(url) {
+  onStatus(url, function (change) {
+    var element = $('#current-status');
+    var status = change.status;
+    var wasBuilding = element.attr('data-building') === 'true';
+    var result = status.building ? status.last_complete_result : status.result;
+    var duration = status.building ? status.last_complete_duration : status.duration;
+
+    element.attr('data-building', status.building ? 'true' : 'false');
+    element.html(lightImage(result, status.building) +
+                 '<bold>' + result + '</bold> | ' + msToTime(duration || 0));
+    if (wasBuilding && !status.building) {
+      window.location.reload();
+    }
+  });
+}
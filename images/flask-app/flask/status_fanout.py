@@ -0,0 +1,122 @@
+"""
+Status changes for the live event streams of a web process. Rather than
+each stream holding its own Redis subscription, one subscription per
+process receives every change and hands it to the queue of each stream
+that wants it, so an open stream costs a server thread but no Redis
+connection.
+"""
+# pylint: disable=C0103
+
+import json
+import threading
+import Queue
+
+# Handed to every subscription when the shared Redis subscription is lost,
+# so that their streams end and the browsers reconnect.
+CLOSED = object()
+
+
+class Subscription(object):
+    """
+    The changes for one stream: those of `pipeline`, or of every pipeline
+    if it is None, queued as they arrive.
+    """
+
+    def __init__(self, fanout, pipeline):
+        self.fanout = fanout
+        self.pipeline = pipeline
+        self.queue = Queue.Queue()
+
+    def get(self, timeout):
+        """
+        Return the next change, None if `timeout` seconds pass without
+        one, or CLOSED if the shared subscription was lost.
+        """
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def close(self):
+        """
+        Stop receiving changes.
+        """
+
+        self.fanout.unsubscribe(self)
+
+
+class StatusFanout(object):
+    """
+    A Redis subscription to every channel starting with `prefix`, shared by
+    the subscriptions of this process. The first subscriber opens it and a
+    daemon thread reads it; if it fails, every subscription is handed
+    CLOSED and the next subscriber opens a new one.
+    """
+
+    def __init__(self, database, prefix):
+        self.database = database
+        self.prefix = prefix
+        self.pubsub = None
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self, pipeline=None):
+        """
+        Return a Subscription to the changes of `pipeline`, or of every
+        pipeline if it is None. Changes published once this returns are
+        not missed. Raises the Redis client's errors if Redis can't be
+        reached.
+        """
+
+        subscription = Subscription(self, pipeline)
+        with self.lock:
+            if self.pubsub is None:
+                pubsub = self.database.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(self.prefix + '*')
+                self.pubsub = pubsub
+                thread = threading.Thread(target=self.listen, args=(pubsub,))
+                thread.daemon = True
+                thread.start()
+            self.subscriptions.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Stop handing changes to `subscription`.
+        """
+
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def listen(self, pubsub):
+        """
+        Hand each message of `pubsub` to the subscriptions until it fails.
+        """
+
+        try:
+            for message in pubsub.listen():
+                self.dispatch(json.loads(message['data']))
+        except Exception as error: # pylint: disable=W0703
+            print 'Status subscription failed:', error
+
+        with self.lock:
+            if self.pubsub is pubsub:
+                self.pubsub = None
+            subscriptions, self.subscriptions = self.subscriptions, set()
+        for subscription in subscriptions:
+            subscription.queue.put(CLOSED)
+        pubsub.close()
+
+    def dispatch(self, change):
+        """
+        Queue a change, a dict with the pipeline's name and its status, for
+        every subscription that wants it.
+        """
+
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            if subscription.pipeline in (None, change['pipeline']):
+                subscription.queue.put(change)
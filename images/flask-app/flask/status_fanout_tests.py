@@ -0,0 +1,89 @@
+import status_fanout
+import json
+import threading
+import unittest
+import Queue
+
+from redis.exceptions import ConnectionError
+
+
+class StubPubSub(object):
+    """
+    A Redis subscription whose messages are put on a queue by the test; an
+    exception on the queue is raised as if the connection failed.
+    """
+
+    def __init__(self):
+        self.patterns = []
+        self.messages = Queue.Queue()
+        self.closed = threading.Event()
+
+    def psubscribe(self, pattern):
+        self.patterns.append(pattern)
+
+    def listen(self):
+        while True:
+            message = self.messages.get()
+            if isinstance(message, Exception):
+                raise message
+            yield message
+
+    def close(self):
+        self.closed.set()
+
+    def publish(self, pipeline, status):
+        self.messages.put({'type': 'pmessage',
+                           'data': json.dumps({'pipeline': pipeline, 'status': status})})
+
+
+class StubDatabase(object):
+
+    def __init__(self):
+        self.subscriptions = []
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        assert ignore_subscribe_messages
+        self.subscriptions.append(StubPubSub())
+        return self.subscriptions[-1]
+
+
+class statusFanoutTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.database = StubDatabase()
+        self.fanout = status_fanout.StatusFanout(self.database, 'status:changes:')
+
+    def test_one_subscription_per_process(self):
+        churro = self.fanout.subscribe('churro')
+        every = self.fanout.subscribe()
+        assert len(self.database.subscriptions) == 1
+        pubsub = self.database.subscriptions[0]
+        assert pubsub.patterns == ['status:changes:*']
+
+        pubsub.publish('taco', {'result': 'FAILURE'})
+        pubsub.publish('churro', {'result': 'SUCCESS'})
+        assert every.get(5) == {'pipeline': 'taco', 'status': {'result': 'FAILURE'}}
+        assert every.get(5) == {'pipeline': 'churro', 'status': {'result': 'SUCCESS'}}
+        assert churro.get(5) == {'pipeline': 'churro', 'status': {'result': 'SUCCESS'}}
+        assert churro.get(0.01) is None
+
+        churro.close()
+        pubsub.publish('churro', {'result': 'FAILURE'})
+        assert every.get(5)['status'] == {'result': 'FAILURE'}
+        assert churro.get(0.01) is None
+
+    def test_lost_subscription_closes_streams(self):
+        first = self.fanout.subscribe()
+        pubsub = self.database.subscriptions[0]
+        pubsub.messages.put(ConnectionError('Redis went away'))
+        assert first.get(5) is status_fanout.CLOSED
+        assert pubsub.closed.wait(5)
+
+        second = self.fanout.subscribe('churro')
+        assert len(self.database.subscriptions) == 2
+        self.database.subscriptions[1].publish('churro', {'result': 'SUCCESS'})
+        assert second.get(5)['pipeline'] == 'churro'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,8 @@
+"""
+The WSGI entry point for serving Butlercam with a production server, e.g.
+`gunicorn wsgi:application`.
+"""
+
+from butlercam import create_app
+
+application = create_app()